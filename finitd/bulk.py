@@ -0,0 +1,389 @@
+###
+# Copyright (c) 2009, Juju, Inc.
+# All rights reserved.
+# 
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are
+# met:
+# 
+#     * Redistributions of source code must retain the above copyright
+#       notice, this list of conditions and the following disclaimer. 
+#     * Redistributions in binary form must reproduce the above
+#       copyright notice, this list of conditions and the following
+#       disclaimer in the documentation and/or other materials provided
+#       with the distribution.
+#     * Neither the name of the author of this software nor the names of
+#       the contributors to the software may be used to endorse or
+#       promote products derived from this software without specific
+#       prior written permission. 
+# 
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS
+# "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT
+# LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR
+# A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT
+# HOLDER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL,
+# SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT
+# LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE,
+# DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY
+# THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+# OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE. 
+###
+
+"""`finitd --all`: runs one command for many configuration files at once, on a
+bounded number of worker processes, and prints a table of the results."""
+
+import os
+import sys
+import time
+import glob
+import errno
+import signal
+
+import conf
+import util
+import commands
+from eventloop import EventLoop
+from main import openlog, runNamedCommand, exitStatus
+
+DEFAULT_JOBS = 16
+
+def runConfigFile(filename, commandName, args):
+    """Runs the given command for the given configuration file, as `finitd <filename>
+    <commandName> <args>` would, returning its exit status."""
+    def run():
+        config = conf.makeConfig()
+        try:
+            conf.readConfig(config, filename)
+        except EnvironmentError, e:
+            util.error('Could not open configuration file %r: %s' % (filename, e))
+        config.readenv()
+        openlog(filename)
+        runNamedCommand(config, commandName, args)
+    return exitStatus(run)
+
+
+# Commands whose jobs are ordered by finitd.child.requires and finitd.child.after,
+# mapped to whether the order is reversed (dependents first).
+ORDERED = {
+    'start': False,
+    'restart': False,
+    'stop': True,
+    'kill': True,
+}
+
+def serviceName(filename):
+    return os.path.splitext(os.path.basename(filename))[0]
+
+class Job(object):
+    def __init__(self, filename):
+        self.filename = filename
+        self.name = serviceName(filename)
+        self.config = None
+        self.waitsFor = [] # Jobs which must be resolved before this one runs.
+        self.requires = [] # Those of the above which must also have succeeded.
+        self.pid = None
+        self.fd = None
+        self.output = []
+        self.status = None
+        self.note = None
+        self.resolved = False
+        self.succeeded = False
+        self.seen = False # Whether we've seen its watcher running.
+
+    def done(self):
+        return self.fd is None and self.status is not None
+
+    def lines(self):
+        lines = [line for line in ''.join(self.output).splitlines() if line.strip()]
+        if self.note:
+            lines.append(self.note)
+        return lines
+
+
+class Runner(object):
+    def __init__(self, filenames, commandName, args, jobs=DEFAULT_JOBS):
+        self.jobs = [Job(filename) for filename in filenames]
+        self.pending = self.jobs[:]
+        self.running = 0
+        self.maxRunning = max(1, jobs)
+        self.commandName = commandName
+        self.args = args
+        self.loop = EventLoop()
+        if commandName in ORDERED:
+            self.loadDependencies(ORDERED[commandName])
+
+    def loadDependencies(self, reverse):
+        """Determines the order jobs run in.  Raises InvalidConfiguration if the
+        dependencies are cyclic or if a required service is neither in this group nor
+        running."""
+        byName = {}
+        for job in self.jobs:
+            byName[job.name] = job
+            job.config = loadConfig(job.filename) # Its worker reports any problem.
+        for job in self.jobs:
+            if job.config is None:
+                continue
+            for name in job.config.child.requires() or []:
+                if name in byName:
+                    if reverse:
+                        byName[name].waitsFor.append(job)
+                    else:
+                        job.waitsFor.append(byName[name])
+                        job.requires.append(byName[name])
+                elif not reverse and not self.externalRunning(job, name):
+                    raise commands.InvalidConfiguration(
+                        '%s requires %s, which is neither being started nor running.'
+                        % (job.name, name))
+            for name in job.config.child.after() or []:
+                if name in byName:
+                    if reverse:
+                        byName[name].waitsFor.append(job)
+                    else:
+                        job.waitsFor.append(byName[name])
+        checkCycles(self.jobs)
+
+    def externalRunning(self, job, name):
+        # Services outside the group are looked for next to the dependent's
+        # configuration file.
+        filename = os.path.join(os.path.dirname(job.filename), name + '.conf')
+        config = conf.makeConfig()
+        try:
+            config.read(filename)
+            conf.resolvePaths(config)
+            return bool(checkRunning(config))
+        except Exception:
+            return False
+
+    def run(self):
+        """Runs every job, returning once they've all finished."""
+        self.spawnPending()
+        if [job for job in self.jobs if not job.resolved]:
+            self.loop.run()
+        return self.jobs
+
+    def spawnPending(self):
+        changed = True
+        while changed:
+            changed = False
+            for job in self.pending[:]:
+                if self.running >= self.maxRunning:
+                    break
+                if [dep for dep in job.waitsFor if not dep.resolved]:
+                    continue
+                self.pending.remove(job)
+                changed = True
+                failed = [dep.name for dep in job.requires if not dep.succeeded]
+                if failed:
+                    job.note = 'skipped: %s failed to start' % ', '.join(failed)
+                    job.resolved = True
+                else:
+                    self.spawn(job)
+        if not [job for job in self.jobs if not job.resolved]:
+            self.loop.stop()
+
+    def spawn(self, job):
+        args = self.args
+        if self.waitsReady(job) and not [arg for arg in args
+                                         if arg.startswith('--wait-ready')]:
+            args = args + ['--wait-ready']
+        (r, w) = os.pipe()
+        sys.stdout.flush()
+        sys.stderr.flush()
+        pid = os.fork()
+        if not pid:
+            signal.signal(signal.SIGCHLD, signal.SIG_DFL)
+            os.close(r)
+            os.dup2(w, 1)
+            os.dup2(w, 2)
+            os.close(w)
+            os._exit(runConfigFile(job.filename, self.commandName, args))
+        os.close(w)
+        util.setCloexec(r)
+        util.setNonblocking(r)
+        self.running += 1
+        job.pid = pid
+        job.fd = r
+        self.loop.addReader(r, lambda fd: self.read(job))
+        self.loop.watchChild(pid, lambda pid, status: self.exited(job, status))
+
+    def read(self, job):
+        try:
+            s = os.read(job.fd, 4096)
+        except OSError, e:
+            if e.errno in (errno.EAGAIN, errno.EINTR):
+                return
+            s = ''
+        if s:
+            job.output.append(s)
+        else:
+            # EOF: the job (and anything it forked, like a watcher) closed its end.
+            self.loop.removeReader(job.fd)
+            os.close(job.fd)
+            job.fd = None
+            self.finished(job)
+
+    def exited(self, job, status):
+        if os.WIFEXITED(status):
+            job.status = os.WEXITSTATUS(status)
+        else:
+            job.status = 128 + os.WTERMSIG(status)
+        self.finished(job)
+
+    def waitsReady(self, job):
+        """Returns whether the given job's command itself waits for its service to be
+        ready, as it does when there are services which require it."""
+        return (self.commandName in ('start', 'restart') and
+                job.config is not None and job.config.watcher.wait() and
+                [other for other in self.jobs if job in other.requires])
+
+    def finished(self, job):
+        if not job.done():
+            return
+        self.running -= 1
+        hasDependents = [other for other in self.jobs if job in other.requires]
+        if self.waitsReady(job):
+            self.resolve(job, job.status == 0)
+        elif job.status == 0 and hasDependents and job.config is not None:
+            # Its dependents wait until it's actually running.
+            timeout = job.config.options.startWaitTime()
+            self.waitRunning(job, time.time() + timeout, 0.01)
+        else:
+            self.resolve(job, job.status == 0)
+
+    def waitRunning(self, job, deadline, delay):
+        watcherRunning = checkRunning(job.config, job.config.watcher.pidfile())
+        if checkRunning(job.config):
+            self.resolve(job, True)
+        elif job.seen and not watcherRunning:
+            job.note = 'exited after starting'
+            self.resolve(job, False)
+        elif time.time() > deadline:
+            job.note = 'not running after %s seconds' % \
+                       job.config.options.startWaitTime()
+            self.resolve(job, False)
+        else:
+            job.seen = job.seen or watcherRunning
+            self.loop.callLater(delay, self.waitRunning, job, deadline,
+                                min(delay * 2, 0.25))
+
+    def resolve(self, job, succeeded):
+        job.resolved = True
+        job.succeeded = succeeded
+        self.spawnPending()
+
+def loadConfig(filename):
+    """Returns the configuration in the given file, with its paths resolved, or None
+    if it can't be read."""
+    config = conf.makeConfig()
+    try:
+        conf.readConfig(config, filename)
+        config.readenv()
+        conf.resolvePaths(config)
+    except Exception:
+        return None
+    return config
+
+def checkRunning(config, pidfile=None):
+    if pidfile is None:
+        pidfile = config.options.pidfile()
+    if not pidfile:
+        return 0
+    (pid, identity) = util.readPidfile(pidfile)
+    return pid and util.checkProcessAlive(pid, identity)
+
+def checkStatus(filenames):
+    """Answers `status` for every given configuration file from a single pass over
+    the process table, rather than running the command for each.  Returns the
+    finished jobs, or None if some configuration needs the full command."""
+    jobs = [Job(filename) for filename in filenames]
+    for job in jobs:
+        job.config = loadConfig(job.filename)
+        if job.config is None or not job.config.options.pidfile():
+            return None
+    alive = util.checkPidfiles([job.config.options.pidfile() for job in jobs])
+    for job in jobs:
+        pid = alive[job.config.options.pidfile()]
+        if pid:
+            job.status = 0
+            job.output.append('Process is running at pid %s\n' % pid)
+        else:
+            job.status = 1
+            job.output.append('Process is not running.\n')
+    return jobs
+
+def checkCycles(jobs):
+    """Raises InvalidConfiguration if the jobs' dependencies are cyclic."""
+    (WHITE, GRAY, BLACK) = range(3)
+    colors = dict([(job, WHITE) for job in jobs])
+    def visit(job, path):
+        colors[job] = GRAY
+        for dep in job.waitsFor:
+            if colors[dep] == GRAY:
+                cycle = path[path.index(dep):] + [dep]
+                raise commands.InvalidConfiguration('Dependency cycle: %s' %
+                    ' -> '.join([job.name for job in cycle]))
+            elif colors[dep] == WHITE:
+                visit(dep, path + [dep])
+        colors[job] = BLACK
+    for job in jobs:
+        if colors[job] == WHITE:
+            visit(job, [job])
+
+def printResults(jobs, fp=sys.stdout):
+    width = max([len(job.filename) for job in jobs] + [len('SERVICE')])
+    fp.write('%-*s  %-8s  %s\n' % (width, 'SERVICE', 'RESULT', 'OUTPUT'))
+    for job in jobs:
+        if job.status == 0:
+            result = 'ok'
+        elif job.status is None:
+            result = 'skipped'
+        else:
+            result = 'exit %s' % job.status
+        lines = job.lines() or ['']
+        fp.write('%-*s  %-8s  %s\n' % (width, job.filename, result, lines[0]))
+        for line in lines[1:]:
+            fp.write('%-*s  %-8s  %s\n' % (width, '', '', line))
+
+def main(argv):
+    """Implements `finitd --all [--jobs N] <configfile>... <command> [args]`, returning
+    the exit status: 0 if the command succeeded for every configuration file, the
+    highest exit status among them otherwise."""
+    argv = argv[:]
+    jobs = DEFAULT_JOBS
+    if argv and argv[0].startswith('--jobs'):
+        option = argv.pop(0)
+        if '=' in option:
+            value = option.split('=', 1)[1]
+        elif argv:
+            value = argv.pop(0)
+        else:
+            value = ''
+        try:
+            jobs = int(value)
+        except ValueError:
+            util.error('--jobs expects a number of worker processes, not %r.' % value)
+    filenames = []
+    # Configuration files (or quoted glob patterns) run until the command name.
+    while argv and (os.path.exists(argv[0]) or glob.has_magic(argv[0])):
+        pattern = argv.pop(0)
+        if glob.has_magic(pattern):
+            filenames.extend(sorted(glob.glob(pattern)))
+        else:
+            filenames.append(pattern)
+    if not filenames:
+        util.error('At least one configuration file must be provided.')
+    if not argv:
+        util.error('A command must be provided.')
+    commandName = argv.pop(0)
+    results = None
+    if commandName == 'status' and not argv:
+        results = checkStatus(filenames)
+    if results is None:
+        try:
+            runner = Runner(filenames, commandName, argv, jobs)
+        except commands.InvalidConfiguration, e:
+            util.error('Invalid configuration: %s' % e)
+        results = runner.run()
+    printResults(results)
+    return max([job.status is None and 1 or job.status for job in results])
@@ -0,0 +1,99 @@
+###
+# Copyright (c) 2009, Juju, Inc.
+# All rights reserved.
+# 
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are
+# met:
+# 
+#     * Redistributions of source code must retain the above copyright
+#       notice, this list of conditions and the following disclaimer. 
+#     * Redistributions in binary form must reproduce the above
+#       copyright notice, this list of conditions and the following
+#       disclaimer in the documentation and/or other materials provided
+#       with the distribution.
+#     * Neither the name of the author of this software nor the names of
+#       the contributors to the software may be used to endorse or
+#       promote products derived from this software without specific
+#       prior written permission. 
+# 
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS
+# "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT
+# LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR
+# A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT
+# HOLDER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL,
+# SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT
+# LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE,
+# DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY
+# THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+# OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE. 
+###
+
+
+"""Places child processes in a cgroup v2 subtree, configured by finitd.limits.cgroup."""
+
+import os
+import errno
+
+ROOT = '/sys/fs/cgroup'
+CPU_PERIOD = 100000 # Microseconds; the kernel's default.
+
+def available():
+    # Only the unified (v2) hierarchy has cgroup.controllers at its root.
+    return os.path.exists(os.path.join(ROOT, 'cgroup.controllers'))
+
+def cpuMax(s):
+    """Converts a CPU limit, either a percentage of one CPU (e.g., 50% or 200%) or
+    cpu.max's own 'quota period' format, to cpu.max's format."""
+    s = s.strip()
+    if s == 'max':
+        return s
+    if s.endswith('%'):
+        percent = float(s[:-1])
+        if percent <= 0:
+            raise ValueError('CPU limit must be positive: %r' % s)
+        return '%d %d' % (percent * CPU_PERIOD / 100, CPU_PERIOD)
+    parts = s.split()
+    if len(parts) != 2 or not (parts[0] == 'max' or parts[0].isdigit()) or \
+       not parts[1].isdigit():
+        raise ValueError('Invalid CPU limit: %r' % s)
+    return s
+
+def write(path, name, value):
+    fp = open(os.path.join(path, name), 'w')
+    try:
+        fp.write('%s\n' % value)
+    finally:
+        fp.close()
+
+def create(name, memory=None, cpu=None):
+    """Creates the cgroup with the given name (a path relative to the root of the
+    hierarchy), enabling the controllers its limits need in each of its ancestors, and
+    sets its limits.  Returns the cgroup's path."""
+    path = os.path.join(ROOT, name.strip('/'))
+    controllers = []
+    if memory is not None:
+        controllers.append('memory')
+    if cpu is not None:
+        controllers.append('cpu')
+    parent = ROOT
+    for part in name.strip('/').split('/'):
+        if controllers:
+            try:
+                write(parent, 'cgroup.subtree_control',
+                      ' '.join(['+' + c for c in controllers]))
+            except IOError, e:
+                if e.errno != errno.EBUSY: # Already enabled, with processes in it.
+                    raise
+        parent = os.path.join(parent, part)
+        try:
+            os.mkdir(parent)
+        except OSError, e:
+            if e.errno != errno.EEXIST:
+                raise
+    if memory is not None:
+        write(path, 'memory.max', memory)
+    if cpu is not None:
+        write(path, 'cpu.max', cpuMax(cpu))
+    return path
@@ -33,30 +33,97 @@
 # start stop restart reload kill
 
 import os
+import re
 import sys
 import time
 import errno
 import signal
 
 import util
-import compat
 from util import error
 from OrderedDict import OrderedDict
 
-def waitFor(seconds):
-    until = time.time() + seconds
-    while time.time() < until:
-        time.sleep(1)
+# Modules only some commands need (the watcher and everything it uses, in
+# particular) are imported where they're used, so that commands like status, which
+# monitoring may run constantly, don't pay for them.
+
+def parseWaitArgument(args, option, default):
+    """Looks for the given option (e.g., '--wait') in args, removing it.  Returns None
+    if it wasn't given, the given default if it was given without a value, and its
+    value (as a number of seconds) if it was given as '--wait=SECONDS'."""
+    for arg in args[:]:
+        if arg == option:
+            args.remove(arg)
+            return default
+        elif arg.startswith(option + '='):
+            args.remove(arg)
+            value = arg[len(option)+1:]
+            try:
+                return float(value)
+            except ValueError:
+                error('%s expects a number of seconds, not %r.' % (option, value))
+    return None
+
+AGES = {'s': 1, 'm': 60, 'h': 3600, 'd': 86400}
+TIME_FORMATS = ['%Y-%m-%d %H:%M:%S', '%Y-%m-%dT%H:%M:%S', '%Y-%m-%d %H:%M',
+                '%Y-%m-%dT%H:%M', '%Y-%m-%d']
+
+def parseTime(value, now=None):
+    """Returns the time (in seconds since the epoch) given as seconds since the epoch,
+    a local date and time like '2009-06-01 12:30[:00]', or an age like '10m' (meaning
+    ten minutes ago), or None if it's none of those."""
+    if now is None:
+        now = time.time()
+    try:
+        return float(value)
+    except ValueError:
+        pass
+    if value and value[-1] in AGES:
+        try:
+            return now - float(value[:-1]) * AGES[value[-1]]
+        except ValueError:
+            pass
+    for format in TIME_FORMATS:
+        try:
+            return time.mktime(time.strptime(value, format))
+        except ValueError:
+            continue
+    return None
 
 class InvalidConfiguration(Exception):
     pass
 
+_simpleWord = r'[\w./:,@%+-]+'
+_simpleCommand = re.compile(r'^\s*%s(\s+[\w./:,@%%+=-]+)*\s*$' % _simpleWord)
+def simpleArgv(command):
+    """Returns the argv /bin/sh -c 'exec <command>' would execute if the command is
+    simple enough for the shell to have nothing to do but split it into words (no
+    quotes, variables, globs, redirections or assignments), or None."""
+    if _simpleCommand.match(command):
+        return command.split()
+    return None
+
+# What the shell searches when there's no PATH in the environment.  (Python's own
+# default, os.defpath, searches the current directory first.)
+DEFAULT_PATH = '/usr/local/sbin:/usr/local/bin:/usr/sbin:/usr/bin:/sbin:/bin'
+
+RLIMITS = { # The resource module's names for finitd.limits' limits.
+    'nofile': 'RLIMIT_NOFILE',
+    'nproc': 'RLIMIT_NPROC',
+    'as': 'RLIMIT_AS',
+    'core': 'RLIMIT_CORE',
+    'cpu': 'RLIMIT_CPU',
+    'memlock': 'RLIMIT_MEMLOCK',
+}
+
 class Command(object):
+    environment = True # Whether run uses the environment it's given.
     def __init__(self, config, name=None):
         if name is None:
             name = self.__class__.__name__.lower()
         self.name = name
         self.config = config
+        self.cgroupProcs = None
 
     def checkConfig(self, config):
         return # No checking performed by default.
@@ -69,11 +136,28 @@ class Command(object):
         raise NotImplementedError
 
     def checkProcessAlive(self, pid=None):
+        identity = None
         if pid is None:
-            pid = self.getPidFromFile()
+            pidfile = self.config.options.pidfile()
+            if pidfile is None:
+                error('finitd.options.pidfile is not configured.')
+            (pid, identity) = util.readPidfile(pidfile)
         if pid is None:
             return 0
-        return util.checkProcessAlive(pid)
+        return util.checkProcessAlive(pid, identity)
+
+    def controlRequest(self, line, timeout=5):
+        """Sends the given request to the watcher's control socket, returning its reply,
+        or None if there's no control socket or no watcher listening on it."""
+        path = self.config.watcher.socket()
+        if not path or not os.path.exists(path):
+            return None
+        import socket
+        import control
+        try:
+            return control.request(path, line, timeout)
+        except socket.error:
+            return None
 
     def getPidFromFile(self, pidfile=None):
         if pidfile is None:
@@ -82,21 +166,21 @@ class Command(object):
                 error('finitd.options.pidfile is not configured.')
         return util.getPidFromFile(pidfile)
 
-    def writePidfile(self, pid, pidfile=None):
+    def writePidfile(self, pid, pidfile=None, identity=None):
         if pidfile is None:
             pidfile = self.config.options.pidfile()
         if pidfile is not None:
-            fp = open(pidfile, 'w')
-            try:
-                fp.write('%s\n' % pid)
-            finally:
-                fp.close()
+            util.writePidfile(pidfile, pid, identity)
 
-    def removePidfile(self, pidfile=None):
+    def removePidfile(self, pidfile=None, pid=None):
+        """Removes the given pidfile (by default, finitd.options.pidfile).  If pid is
+        given, the pidfile is only removed if it still contains that pid."""
         if pidfile is None:
             pidfile = self.config.options.pidfile()
         if pidfile is not None:
-            os.remove(pidfile)
+            if pid is not None and util.getPidFromFile(pidfile) != pid:
+                return # Someone else has written (or removed) the pidfile since.
+            util.removePidfile(pidfile)
 
     def chdir(self):
         try:
@@ -108,9 +192,69 @@ class Command(object):
         if self.config.child.chroot():
             os.chroot(self.config.child.chdir())
 
+    def redirect(self, output=None):
+        """Opens the configured stdin, stdout and stderr as file descriptors 0, 1 and
+        2.  If output is given, it's a pair of file descriptors to use as stdout and
+        stderr instead of the configured files."""
+        child = self.config.child
+        fds = [os.open(child.stdin(), os.O_CREAT | os.O_RDONLY)]
+        if output is not None:
+            fds.extend(output)
+        else:
+            fds.append(os.open(child.stdout(), os.O_CREAT | os.O_WRONLY | os.O_APPEND))
+            if child.stderr() != child.stdout():
+                fds.append(os.open(child.stderr(),
+                                   os.O_CREAT | os.O_WRONLY | os.O_APPEND))
+            else:
+                fds.append(fds[1])
+        for (target, fd) in enumerate(fds):
+            if fd != target:
+                os.dup2(fd, target)
+        for fd in set(fds):
+            if fd > 2:
+                os.close(fd)
+
     def umask(self):
         os.umask(self.config.child.umask())
 
+    def setrlimits(self):
+        import resource
+        for (name, limit) in RLIMITS.iteritems():
+            value = self.config.limits.get(name)()
+            if value is not None:
+                resource.setrlimit(getattr(resource, limit), value)
+
+    def createCgroup(self):
+        """Creates the configured cgroup and opens it for joinCgroup, which might be
+        called from within a chroot, where the cgroup hierarchy isn't visible."""
+        name = self.config.limits.cgroup()
+        if name and self.cgroupProcs is None:
+            import cgroup
+            path = cgroup.create(name, self.config.limits.cgroup.memory(),
+                                 self.config.limits.cgroup.cpu())
+            fd = os.open(os.path.join(path, 'cgroup.procs'), os.O_WRONLY)
+            # Clear of stdio, which redirect replaces after a daemonize has closed it.
+            self.cgroupProcs = util.moveAbove(fd, 3)
+            util.setCloexec(self.cgroupProcs)
+
+    def joinCgroup(self):
+        if self.cgroupProcs is not None:
+            os.write(self.cgroupProcs, '%s\n' % os.getpid())
+
+    def schedule(self):
+        """Applies the configured CPU affinity, nice value, I/O priority and scheduling
+        policy to this process."""
+        import linux
+        child = self.config.child
+        if child.affinity():
+            linux.setAffinity(child.affinity())
+        if child.nice() is not None:
+            linux.setNice(child.nice())
+        if child.ionice():
+            linux.setIoPriority(child.ionice(), child.ionice.priority())
+        if child.scheduler():
+            linux.setScheduler(child.scheduler(), child.scheduler.priority())
+
     def setuid(self):
         uid = self.config.child.setuid()
         if uid is not None:
@@ -122,16 +266,61 @@ class Command(object):
             os.setgid(gid)
 
     def execute(self, environ, command=None):
+        """Executes the given command (by default, the child's), directly if it's
+        the child's argv or is simple enough, or by /bin/sh otherwise."""
+        argv = None
         if command is None:
             command = self.config.child.command()
+            argv = self.config.child.argv()
+        if not argv:
+            argv = simpleArgv(command)
+        if argv:
+            try:
+                self.executeArgv(argv, environ)
+            except OSError:
+                if not command:
+                    raise
+                # Otherwise, the shell reports what's wrong, as it always has.
         os.execle('/bin/sh', 'sh', '-c', 'exec ' + command, environ)
 
+    def executeArgv(self, argv, environ):
+        """Executes argv, searching the given environment's PATH (or DEFAULT_PATH) as
+        the shell would.  An executable without a #! line is run by /bin/sh, as the
+        shell would run it, too.  Raises OSError if argv[0] can't be executed."""
+        if '/' in argv[0]:
+            filenames = [argv[0]]
+        else:
+            filenames = [os.path.join(directory or '.', argv[0]) for directory in
+                         environ.get('PATH', DEFAULT_PATH).split(':')]
+        error = None
+        for filename in filenames:
+            try:
+                os.execve(filename, argv, environ)
+            except OSError, e:
+                if e.errno == errno.ENOEXEC:
+                    os.execve('/bin/sh', ['sh', filename] + argv[1:], environ)
+                if error is None or e.errno != errno.ENOENT:
+                    error = e # As execvp does, report a more interesting error.
+        raise error
+
 
 class start(Command):
-    """Starts the configured child process."""
+    """Starts the configured child process.  Given --wait-ready, waits (at most
+    finitd.options.startWaitTime seconds, or as many seconds as given by
+    --wait-ready=SECONDS) for it to be ready, as configured by finitd.watcher.ready,
+    exiting with a nonzero status if it isn't."""
     def checkConfig(self, config):
+        import cgroup
+        import sockets
+        import logfile
         if config.options.pidfile() is None:
             raise InvalidConfiguration('finitd.options.pidfile must be configured.')
+        if config.child.command() and config.child.argv():
+            raise InvalidConfiguration('finitd.child.command and finitd.child.argv '
+                                       'cannot be configured simultaneously.')
+        if not (config.child.command() or config.child.argv()):
+            raise InvalidConfiguration('finitd.child.command or finitd.child.argv '
+                                       'must be configured.')
         if config.watcher.restart() and not config.watcher.wait():
             raise InvalidConfiguration('finitd.watcher.wait must be set if '
                                        'finitd.watcher.restart is set.')
@@ -139,100 +328,303 @@ class start(Command):
             raise InvalidConfiguration('You must be root if finitd.child.setuid is set.')
         if config.child.setgid() and os.getuid():
             raise InvalidConfiguration('You must be root if finitd.child.setgid is set.')
-        
+        if config.limits.cgroup():
+            if not cgroup.available():
+                raise InvalidConfiguration('finitd.limits.cgroup requires cgroup v2, '
+                                           'mounted at %s.' % cgroup.ROOT)
+            if os.getuid():
+                raise InvalidConfiguration('You must be root if finitd.limits.cgroup '
+                                           'is set.')
+            if config.limits.cgroup.cpu():
+                try:
+                    cgroup.cpuMax(config.limits.cgroup.cpu())
+                except ValueError, e:
+                    raise InvalidConfiguration('finitd.limits.cgroup.cpu: %s' % e)
+        self.checkLimits(config)
+        self.checkScheduling(config)
+        for group in config.sockets.children():
+            if not group.listen():
+                raise InvalidConfiguration('finitd.sockets.%s.listen must be set.' %
+                                           group._name)
+            try:
+                sockets.parseAddress(group.listen())
+            except ValueError, e:
+                raise InvalidConfiguration('finitd.sockets.%s.listen: %s' %
+                                           (group._name, e))
+        if config.log.pipe() and not config.watcher.wait():
+            raise InvalidConfiguration('finitd.watcher.wait must be set if '
+                                       'finitd.log.pipe is set.')
+        if config.log.buffer.full() not in logfile.FULL_POLICIES:
+            raise InvalidConfiguration('finitd.log.buffer.full must be one of %s.' %
+                                       ', '.join(logfile.FULL_POLICIES))
+        compressor = config.log.rotate.compress()
+        if compressor and compressor not in logfile.COMPRESSORS:
+            raise InvalidConfiguration('finitd.log.rotate.compress must be one of %s.' %
+                                       ', '.join(sorted(logfile.COMPRESSORS)))
+        self.checkReadiness(config)
+        self.checkHealth(config)
+
+    def checkHealth(self, config):
+        check = config.watcher.health
+        if not check():
+            return
+        import health
+        import sockets
+        if check() not in health.PROBES:
+            raise InvalidConfiguration('finitd.watcher.health must be one of %s.' %
+                                       ', '.join(sorted(health.PROBES)))
+        if not config.watcher.wait():
+            raise InvalidConfiguration('finitd.watcher.wait must be set if '
+                                       'finitd.watcher.health is set.')
+        if check() == 'command':
+            if not check.command():
+                raise InvalidConfiguration('finitd.watcher.health.command must be set '
+                                           'for the command check.')
+        else:
+            if not check.address():
+                raise InvalidConfiguration('finitd.watcher.health.address must be set '
+                                           'for the %s check.' % check())
+            try:
+                sockets.parseAddress(check.address())
+            except ValueError, e:
+                raise InvalidConfiguration('finitd.watcher.health.address: %s' % e)
+        if check.interval() <= 0 or check.timeout() <= 0:
+            raise InvalidConfiguration('finitd.watcher.health.interval and timeout '
+                                       'must be positive.')
+        if check.failures() < 1:
+            raise InvalidConfiguration('finitd.watcher.health.failures must be at '
+                                       'least 1.')
+
+    def checkReadiness(self, config):
+        ready = config.watcher.ready
+        if not ready():
+            return
+        import readiness
+        import sockets
+        if ready() not in readiness.STRATEGIES:
+            raise InvalidConfiguration('finitd.watcher.ready must be one of %s.' %
+                                       ', '.join(sorted(readiness.STRATEGIES)))
+        if not config.watcher.wait():
+            raise InvalidConfiguration('finitd.watcher.wait must be set if '
+                                       'finitd.watcher.ready is set.')
+        if ready() == 'port':
+            if not ready.port():
+                raise InvalidConfiguration('finitd.watcher.ready.port must be set for '
+                                           'the port strategy.')
+            try:
+                sockets.parseAddress(ready.port())
+            except ValueError, e:
+                raise InvalidConfiguration('finitd.watcher.ready.port: %s' % e)
+        elif ready() == 'output':
+            if not ready.output():
+                raise InvalidConfiguration('finitd.watcher.ready.output must be set '
+                                           'for the output strategy.')
+            if not config.log.pipe():
+                raise InvalidConfiguration('finitd.log.pipe must be set for the '
+                                           'output strategy.')
+            try:
+                re.compile(ready.output())
+            except re.error, e:
+                raise InvalidConfiguration('finitd.watcher.ready.output: %s' % e)
+
+    def checkLimits(self, config):
+        # Otherwise, setrlimit would only fail in the child, after the fork.
+        import resource
+        for name in RLIMITS:
+            value = config.limits.get(name)()
+            if value is None:
+                continue
+            (soft, hard) = value
+            if hard != resource.RLIM_INFINITY and \
+               (soft == resource.RLIM_INFINITY or soft > hard):
+                raise InvalidConfiguration('finitd.limits.%s: the soft limit cannot '
+                                           'be greater than the hard limit.' % name)
+
+    def checkScheduling(self, config):
+        child = config.child
+        if not (child.affinity() or child.nice() is not None or child.ionice() or
+                child.scheduler()):
+            return
+        import linux
+        if not linux.supported():
+            raise InvalidConfiguration('finitd.child.affinity, nice, ionice and '
+                                       'scheduler are only supported on Linux.')
+        if child.affinity():
+            cpus = os.sysconf('SC_NPROCESSORS_CONF')
+            if max(child.affinity()) >= cpus:
+                raise InvalidConfiguration('finitd.child.affinity: there are only %s '
+                                           'CPUs.' % cpus)
+        if child.nice() is not None:
+            if not -20 <= child.nice() <= 19:
+                raise InvalidConfiguration('finitd.child.nice must be between -20 '
+                                           'and 19.')
+            if child.nice() < 0 and os.getuid():
+                raise InvalidConfiguration('You must be root if finitd.child.nice '
+                                           'is negative.')
+        if child.ionice():
+            if child.ionice() not in linux.IOPRIO_CLASSES:
+                raise InvalidConfiguration('finitd.child.ionice must be one of %s.' %
+                                           ', '.join(sorted(linux.IOPRIO_CLASSES)))
+            if linux.SYS_ioprio_set is None:
+                raise InvalidConfiguration('finitd.child.ionice is not supported on '
+                                           'this architecture.')
+            if not 0 <= child.ionice.priority() <= 7:
+                raise InvalidConfiguration('finitd.child.ionice.priority must be '
+                                           'between 0 and 7.')
+            if child.ionice() == 'realtime' and os.getuid():
+                raise InvalidConfiguration('You must be root if finitd.child.ionice '
+                                           'is realtime.')
+        if child.scheduler():
+            if child.scheduler() not in linux.SCHEDULERS:
+                raise InvalidConfiguration('finitd.child.scheduler must be one of %s.' %
+                                           ', '.join(sorted(linux.SCHEDULERS)))
+            realtime = child.scheduler() in ('fifo', 'rr')
+            if realtime and not 1 <= child.scheduler.priority() <= 99:
+                raise InvalidConfiguration('finitd.child.scheduler.priority must be '
+                                           'between 1 and 99 for the %s scheduler.' %
+                                           child.scheduler())
+            if not realtime and child.scheduler.priority():
+                raise InvalidConfiguration('finitd.child.scheduler.priority must be 0 '
+                                           'for the %s scheduler.' % child.scheduler())
+            if realtime and os.getuid():
+                raise InvalidConfiguration('You must be root if finitd.child.scheduler '
+                                           'is %s.' % child.scheduler())
+
     def run(self, args, environ):
+        wait = parseWaitArgument(args, '--wait-ready',
+                                 self.config.options.startWaitTime())
         pid = self.checkProcessAlive()
         if pid:
             # (the exit code used here matches start-stop-daemon)
             error("""Process appears to be alive at pid %s.  If this is not the process
             you're attempting to start, remove the pidfile %r and start again.""" %
                   (pid, self.config.options.pidfile()), code=1)
+        if wait is not None and not self.config.watcher.wait():
+            error('--wait-ready requires finitd.watcher.wait.')
 
         # Before we fork, we replace sys.stdout/sys.stderr with sysloggers
         sys.stdout = util.SyslogFile()
         sys.stderr = util.SyslogFile(util.SyslogFile.LOG_ERR)
 
-        pid = os.fork()
-        if pid:
-            os._exit(0)
-
-        # Set a new session id.
-        sid = os.setsid()
-        if sid == -1:
-            error('setsid failed') # So apparently errno isn't available to Python...
-
+        readyWriter = None
+        if wait is None:
+            util.daemonize()
+        else:
+            # The watcher tells us over this pipe whether the process became ready.
+            (readyReader, readyWriter) = os.pipe()
+            readyWriter = util.moveAbove(readyWriter, 3) # Clear of stdio.
+            util.setCloexec(readyWriter)
+            util.daemonize(lambda: self.waitReady(readyReader, readyWriter, wait),
+                           keep=[readyWriter])
+        try:
+            self.createCgroup()
+        except EnvironmentError, e:
+            error('Could not create cgroup %r: %s' % (self.config.limits.cgroup(), e))
+        if self.config.watcher.slim():
+            self.execSlimWatcher(environ, readyWriter) # Only returns if exec failed.
+        self.watch(environ, readyWriter)
+
+    def execSlimWatcher(self, environ, readyWriter):
+        """Replaces this process with a slim watcher (finitd.slim) which is given
+        only the evaluated configuration and the state the watcher needs, so the
+        configuration machinery and the command line's modules don't stay resident
+        for the life of the service."""
+        import marshal
+        import tempfile
+        import flatconf
+        directory = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+        fds = [fd for fd in (self.cgroupProcs, readyWriter) if fd is not None]
+        try:
+            state = marshal.dumps({'config': flatconf.flatten(self.config),
+                                   'environ': environ,
+                                   'cgroupProcs': self.cgroupProcs,
+                                   'readyWriter': readyWriter,
+                                   'ident': util.syslogIdent})
+            if not sys.executable:
+                raise OSError(errno.ENOENT, 'sys.executable is unknown')
+            # The interpreter starts with valid stdio; its own files land above it.
+            null = os.open(os.devnull, os.O_RDWR)
+            for fd in range(3):
+                if fd != null:
+                    os.dup2(null, fd)
+            fp = tempfile.TemporaryFile()
+            fp.write(state)
+            fp.flush()
+            fp.seek(0)
+            fds.append(fp.fileno())
+            for fd in fds:
+                util.clearCloexec(fd)
+            os.execv(sys.executable,
+                     [sys.executable, '-S', '-c', 'import sys; sys.path.insert(0, %r); '
+                      'from finitd import slim; slim.main()' % directory,
+                      str(fp.fileno()), util.syslogIdent or 'finitd'])
+        except (ValueError, EnvironmentError), e:
+            print >>sys.stderr, 'Could not exec a slim watcher, ' \
+                  'watching from this process instead: %s' % e
+            for fd in fds:
+                util.setCloexec(fd)
+
+    def watch(self, environ, readyWriter=None):
+        """Runs the watcher in this (daemonized) process until it exits."""
+        # Imported before the chroot, which might hide them.
+        from watcher import Watcher
+        from eventloop import EventLoop
         self.chdir()
         self.chroot()
-
-        # Close open files before going into watcher loop.
-        try:
-            # "Borrowed" from the subprocess module ;)
-            MAXFD = os.sysconf('SC_OPEN_MAX')
-        except:
-            MAXFD = 256
-        os.closerange(0, MAXFD)
-        fd = os.open(self.config.child.stdin(), os.O_CREAT | os.O_RDONLY)
-        assert fd == 0, 'stdin fd = %r' % fd
-        fd = os.open(self.config.child.stdout(), os.O_CREAT | os.O_WRONLY | os.O_APPEND)
-        assert fd == 1, 'stdout fd = %r' % fd
-        if self.config.child.stderr() != self.config.child.stdout():
-            fd = os.open(self.config.child.stderr(),
-                         os.O_CREAT | os.O_WRONLY | os.O_APPEND)
-            assert fd == 2, 'stderr fd = %r' % fd
+        if self.config.log.pipe():
+            # The watcher's own stdout and stderr go nowhere; the child's go into the
+            # pipes the watcher creates.
+            null = os.open(os.devnull, os.O_WRONLY)
+            self.redirect((null, null))
         else:
-            os.dup2(1, 2)
+            self.redirect()
+
+        loop = EventLoop()
+        watcher = Watcher(self, environ, loop)
+        if readyWriter is not None:
+            watcher.whenReady(lambda error:
+                              self.reportReady(readyWriter, watcher, error))
+        watcher.start()
+        loop.run()
+        os._exit(0)
 
-        
-        lastRestart = 0
-        restartWait = self.config.watcher.restart.wait()
-        watcherPid = os.getpid()
-        def log(s):
-            print 'Watcher[%s]: %s' % (watcherPid, s)
-        while time.time() > lastRestart + restartWait:
-            lastRestart = time.time()
-            log('starting process')
-            pid = os.fork() # This spawns what will become the actual child process.
-            if pid:
-                def sigusr1(signum, frame):
-                    log('received SIGUSR1, removing watcher pidfile and exiting')
-                    # XXX All we really need to do is configure not to restart, right?
-                    # Originally I removed both pidfiles here, but it's needed in order
-                    # to kill the child process, which must necessarily happen after the
-                    # watcher exits, if the watcher is configured to restart the child.
-                    self.removePidfile(self.config.watcher.pidfile())
-                    os._exit(0)
-                signal.signal(signal.SIGUSR1, sigusr1)
-                log('child process started at pid %s' % pid)
-                self.writePidfile(pid)
-                if self.config.watcher.wait():
-                    self.writePidfile(watcherPid, self.config.watcher.pidfile())
-                    (_, status) = os.waitpid(pid, 0)
-                    log('process exited with status %s' % status)
-                    # Remove pidfile when child has exited.
-                    self.removePidfile()
-                    if self.config.watcher.restart() and status != 0:
-                        command = self.config.watcher.restart.command()
-                        if command:
-                            log('running %r before restart' % command)
-                            status = os.system(command)
-                            if status:
-                                log('%r exited with nonzero status %s, exiting' % status)
-                                break
-                        continue # Not strictly necessary, but we're way nested here.
-                    else:
-                        break
-                else:
+    def reportReady(self, fd, watcher, error):
+        if error:
+            message = 'failed %s\n' % error
+        else:
+            message = 'ready %s\n' % watcher.pid
+        try:
+            os.write(fd, message)
+        except OSError:
+            pass # start --wait-ready gave up waiting.
+        os.close(fd)
+
+    def waitReady(self, reader, writer, timeout):
+        """Waits (in the parent of the daemonized watcher) for the watcher to report
+        whether the process became ready, returning the status start exits with."""
+        import select
+        os.close(writer)
+        deadline = time.time() + timeout
+        report = ''
+        while True:
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                sys.__stderr__.write('Process was not ready after %s seconds.\n' %
+                                     timeout)
+                return 1
+            (readable, _, _) = select.select([reader], [], [], remaining)
+            if readable:
+                data = os.read(reader, 4096)
+                if not data:
                     break
-            else:
-                # This is the child process, pre-exec.
-                self.umask()
-                self.setgid()
-                self.setuid()
-                # Now we're ready to actually spawn the process.
-                self.execute(environ)
-        self.removePidfile(self.config.watcher.pidfile())
-        log('exiting')
-        os._exit(0)
+                report += data
+        if report.startswith('ready '):
+            return 0
+        elif report.startswith('failed '):
+            sys.__stderr__.write(report[len('failed '):])
+        else:
+            sys.__stderr__.write('The watcher exited before the process was ready.\n')
+        return 1
 
 
     
@@ -241,16 +633,22 @@ class debug(start): # subclassing start to inherit checkConfig
     """Starts the configured child process without daemonizing or redirecting
     stdin/stdout/stderr, for debugging problems with starting the process."""
     def run(self, args, environ):
+        self.createCgroup()
+        self.joinCgroup()
         self.chdir()
         self.chroot()
         self.umask()
+        self.setrlimits()
+        self.schedule()
         self.setgid()
         self.setuid()
         self.execute(environ)
     
 
 class stop(Command):
-    """Stops the running child process by sending it SIGTERM."""
+    """Stops the running child process by sending it SIGTERM.  Given --wait, waits
+    (at most finitd.options.stopWaitTime seconds, or as many seconds as given by
+    --wait=SECONDS) for the process to exit."""
     def checkConfig(self, config):
         if not config.options.pidfile():
             raise InvalidConfiguration('Cannot stop the process without a configured'
@@ -260,64 +658,251 @@ class stop(Command):
                                        'finitd.commands.stop.signal cannot be '
                                        'configured simultaneously.')
     def run(self, args, environ):
+        wait = parseWaitArgument(args, '--wait', self.config.options.stopWaitTime())
         self.chdir() # If the pidfile is a relative pathname, it's relative to here.
+        reply = self.controlRequest('stop')
+        if reply is not None and not reply.get('error'):
+            if not reply['pid']:
+                print 'Process is not running.'
+                sys.exit(1)
+            if wait is not None:
+                until = time.time() + wait
+                if not util.waitForExit(reply['pid'], wait):
+                    error('Process is still running at pid %s' % reply['pid'])
+                # The watcher removes its socket as it exits; wait for that too, so a
+                # subsequent start can listen on it.
+                util.waitForRemoval(self.config.watcher.socket(),
+                                    max(0, until - time.time()))
+            return
         pid = self.checkProcessAlive()
         if pid:
-            if self.config.watcher.pidfile() and self.config.watcher.restart():
-                watcherPid = self.getPidFromFile(self.config.watcher.pidfile())
-                if watcherPid:
-                    # Tell the watcher to remove the pidfile and exit.
-                    os.kill(watcherPid, signal.SIGUSR1)
-                    time.sleep(1) # Wait to make sure the watcher exits.
+            self.stopWatcher()
             if self.config.commands.stop.command():
-                self.execute(environ, self.config.commands.stop.command())
+                self.runStopCommand(environ)
             else:
                 os.kill(pid, self.config.commands.stop.signal())
+            if wait is not None and not util.waitForExit(pid, wait):
+                error('Process is still running at pid %s' % pid)
         else:
+            # The watcher might be waiting to restart the process; it shouldn't.
+            self.stopWatcher()
             print 'Process is not running.'
             sys.exit(1) # to match start-stop-daemon
+
+    def stopWatcher(self):
+        if self.config.watcher.pidfile() and self.config.watcher.restart():
+            watcherPid = self.getPidFromFile(self.config.watcher.pidfile())
+            if watcherPid and util.checkProcessAlive(watcherPid):
+                # Tell the watcher to stop babysitting and exit.  A watcher sees its
+                # pidfile's removal as a stop request even if it exits with us.
+                self.removePidfile(self.config.watcher.pidfile())
+                os.kill(watcherPid, signal.SIGUSR1)
+
+    def runStopCommand(self, environ):
+        pid = os.fork()
+        if not pid:
+            try:
+                self.execute(environ, self.config.commands.stop.command())
+            finally:
+                os._exit(127)
+        (_, status) = os.waitpid(pid, 0)
+        if status:
+            error('finitd.commands.stop.command exited with status %s' % status)
         
 class restart(Command):
-    """Restarts the process.  Equivalent to `stop` followed by `start`"""
+    """Restarts the process.  Equivalent to `stop` followed by `start`, but the process
+    is started again as soon as the old one has exited.  Accepts start's
+    --wait-ready."""
     def run(self, args, environ):
-        stop(self.config).run([], environ)
-        waitFor(self.config.options.restartWaitTime())
+        timeout = self.config.options.restartWaitTime()
+        stop(self.config).run(['--wait=%s' % timeout], environ)
         pid = self.checkProcessAlive()
         if pid:
             error('Process is still running at pid %s' % pid)
-        start(self.config).run([], environ)
+        start(self.config).run(args, environ)
+
+class reload(Command):
+    """Replaces the running process without a gap in service: the watcher starts a new
+    process alongside the old one and, once the new one is ready, stops the old one.
+    Waits until the new process has replaced the old one."""
+    environment = False
+    def checkConfig(self, config):
+        if not config.options.pidfile():
+            raise InvalidConfiguration('finitd.options.pidfile must be configured.')
+        if not (config.watcher.wait() and config.watcher.pidfile()):
+            raise InvalidConfiguration('finitd.watcher.wait and finitd.watcher.pidfile '
+                                       'must be set to reload the process.')
+
+    def run(self, args, environ):
+        self.chdir() # If the pidfile is a relative pathname, it's relative to here.
+        timeout = self.config.watcher.reload.wait() + self.config.options.startWaitTime()
+        path = self.config.watcher.socket()
+        if path and os.path.exists(path):
+            import socket
+            import control
+            try:
+                reply = control.request(path, 'reload', timeout)
+            except socket.error, e:
+                error('Could not reload the process: %s' % e)
+            if reply.get('error'):
+                error(reply['error'])
+            print 'Process is running at pid %s' % reply['pid']
+            return
+        # Without a control socket, a (lone) watcher reloads on SIGHUP; we know it's
+        # done when the pidfile names the new process.
+        pid = self.checkProcessAlive()
+        if not pid:
+            print 'Process is not running.'
+            sys.exit(1)
+        watcherPid = self.getPidFromFile(self.config.watcher.pidfile())
+        if not (watcherPid and util.checkProcessAlive(watcherPid)):
+            error('The watcher is not running.')
+        os.kill(watcherPid, signal.SIGHUP)
+        deadline = time.time() + timeout
+        while time.time() < deadline:
+            newPid = self.checkProcessAlive()
+            if newPid and newPid != pid:
+                print 'Process is running at pid %s' % newPid
+                return
+            time.sleep(0.1)
+        error('The process was not replaced within %s seconds.' % timeout)
 
 class kill(Command):
     """Attempts to stop the process ordinarily, but if that fails, sends the process
     SIGKILL."""
     def run(self, args, environ):
+        self.chdir() # If the pidfile is a relative pathname, it's relative to here.
+        pid = self.checkProcessAlive()
         stop(self.config).run([], environ)
-        waitingUntil = time.time() + self.config.options.killWaitTime()
-        while time.time() < waitingUntil and self.checkProcessAlive():
-            time.sleep(1)
-        if self.checkProcessAlive():
-            os.kill(self.getPidFromFile(), signal.SIGKILL)
-            time.sleep(self.config.options.restartWaitTime())
-            if self.checkProcessAlive():
-                error('Cannot kill process %s' % self.getPidFromFile())
+        if not util.waitForExit(pid, self.config.options.killWaitTime()):
+            os.kill(pid, signal.SIGKILL)
+            if not util.waitForExit(pid, self.config.options.restartWaitTime()):
+                error('Cannot kill process %s' % pid)
 
 class status(Command):
     """Returns whether the process is alive or not.  Prints a message and exits with
     error status 0 if the process exists, with error status 1 if the process does not
     exist."""
+    environment = False
     def run(self, args, environ):
-        pid = self.checkProcessAlive()
+        self.chdir() # If the pidfile is a relative pathname, it's relative to here.
+        reply = self.controlRequest('status')
+        if reply is not None and not reply.get('error'):
+            pid = reply['pid']
+        else:
+            pid = self.checkProcessAlive()
         if pid:
             print 'Process is running at pid %s' % pid
             sys.exit(0)
+        if reply is None and self.config.watcher.restart.breaker():
+            reply = self.historyStatus()
+        if reply is not None and reply.get('tripped') and reply.get('watching', True):
+            print 'Process is not running: restarts tripped after %s crashes; it ' \
+                  'will be tried again in %d seconds.' % \
+                  (reply['crashes'], max(0, reply['tripped'] - time.time()))
+            sys.exit(1)
+        elif reply is not None and reply.get('tripped'):
+            # No watcher is left to try it again.
+            print 'Process is not running: restarts tripped after %s crashes; the ' \
+                  'next start will try it once more.' % reply['crashes']
+            sys.exit(1)
         else:
             print 'Process is not running.'
             sys.exit(1)
 
+    def historyStatus(self):
+        """Returns what the watcher would report about its breaker, from
+        finitd.watcher.history, for when there's no watcher to ask, along with
+        whether there's a watcher at all (to try the process again) as 'watching'."""
+        import history
+        state = history.History(self.config, lambda s: None)
+        if state.tripped is None:
+            return None
+        cooldown = self.config.watcher.restart.breaker.cooldown()
+        watcherPidfile = self.config.watcher.pidfile()
+        watching = bool(watcherPidfile and self.getPidFromFile(watcherPidfile))
+        return {'crashes': state.recentCrashes(), 'tripped': state.tripped + cooldown,
+                'watching': watching}
+
+class metrics(Command):
+    """Prints the child process's resource usage in the Prometheus text format, as
+    sampled by the watcher when asked over finitd.watcher.socket."""
+    environment = False
+    def checkConfig(self, config):
+        if not config.watcher.socket():
+            raise InvalidConfiguration('finitd.watcher.socket must be configured.')
+
+    def run(self, args, environ):
+        self.chdir() # If the socket is a relative pathname, it's relative to here.
+        reply = self.controlRequest('metrics')
+        if reply is None:
+            error('The watcher is not running.')
+        elif reply.get('error'):
+            error(reply['error'])
+        sys.stdout.write(reply['metrics'])
+
+class logs(Command):
+    """Prints the child's output from finitd.child.stdout (or, given --stderr,
+    finitd.child.stderr) and its rotated files.  --since=TIME and --until=TIME
+    print only what was written after or before TIME (seconds since the epoch, a
+    local 'YYYY-MM-DD HH:MM:SS', or an age like 30s, 10m, 2h or 1d), as found by the
+    index the watcher keeps of each file with finitd.log.pipe and finitd.log.index.
+    Without an index, they only pick among the rotated files, and a warning says
+    so.  -f (or --follow) keeps printing output as it's written."""
+    environment = False
+    def run(self, args, environ):
+        path = self.config.child.stdout()
+        (since, until, follow) = (None, None, False)
+        while args:
+            arg = args.pop(0)
+            if arg in ('-f', '--follow'):
+                follow = True
+            elif arg == '--stderr':
+                path = self.config.child.stderr()
+            elif arg.split('=')[0] in ('--since', '--until'):
+                if '=' in arg:
+                    (option, value) = arg.split('=', 1)
+                elif args:
+                    (option, value) = (arg, args.pop(0))
+                else:
+                    error('%s requires a time.' % arg)
+                when = parseTime(value)
+                if when is None:
+                    error('%s expects a time, not %r.' % (option, value))
+                if option == '--since':
+                    since = when
+                else:
+                    until = when
+            else:
+                error('Invalid argument to logs: %r' % arg)
+        if follow and until is not None:
+            error('--follow and --until cannot be given together.')
+        self.chdir() # If the file is a relative pathname, it's relative to here.
+        if self.config.child.chroot():
+            path = os.path.join(self.config.child.chdir(), path.lstrip('/'))
+        import logfile
+        try:
+            def unindexed(filename):
+                sys.stdout.flush()
+                sys.stderr.write('%s has no index, so --since and --until were not '
+                                 'applied within it.\n' % filename)
+            fp = logfile.read(path, sys.stdout, since, until,
+                              self.config.log.index(), unindexed)
+            if follow:
+                logfile.follow(path, sys.stdout, fp)
+            elif fp is not None:
+                fp.close()
+        except KeyboardInterrupt:
+            pass
+        except IOError, e:
+            if e.errno != errno.EPIPE: # Whatever we're writing to has gone away.
+                raise
+
 class annotate(Command):
     """Annotates the given configuration file and outputs it to stdout.  Useful with
     /dev/null as a configuration file just to output an annotated configuration file
     ready for modification."""
+    environment = False
     def run(self, args, environ):
         self.config.writefp(sys.stdout)
 
@@ -345,7 +930,10 @@ commands = [
     'stop',
     'kill',
     'restart',
+    'reload',
     'status',
+    'metrics',
+    'logs',
     'debug',
     'annotate',
 ]
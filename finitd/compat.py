@@ -41,3 +41,8 @@ if sys.version_info < (2, 6, 0):
             except OSError:
                 pass
     os.closerange = closerange
+
+try:
+    import json
+except ImportError: # Python < 2.6
+    import simplejson as json
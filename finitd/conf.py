@@ -31,27 +31,35 @@
 ###
 
 import os
-import grp
-import pwd
+import stat
 import signal
+import marshal
+import binascii
 devnull = getattr(os, 'devnull', '/dev/null')
 
 import hieropt
 
+# pwd, grp and resource are imported where they're used, so reading a configuration
+# from the cache (see readConfig) doesn't import them.
+
 class Uid(hieropt.Value):
     def type(self):
         return 'user'
     def toString(self, v):
+        import pwd
         return pwd.getpwuid(v).pw_name
     def fromString(self, s):
+        import pwd
         return pwd.getpwnam(s).pw_uid
 
 class Gid(hieropt.Value):
     def type(self):
         return 'group'
     def toString(self, v):
+        import grp
         return grp.getgrgid(v).gr_name
     def fromString(self, s):
+        import grp
         return grp.getgrnam(s).gr_gid
 
 class Signal(hieropt.Value):
@@ -65,8 +73,89 @@ class Signal(hieropt.Value):
     def fromString(self, s):
         assert s.startswith('SIG') and not s.startswith('SIG_'), repr(s)
         return getattr(signal, s)
+
+class List(hieropt.Value):
+    """A list of strings, separated by whitespace and/or commas."""
+    def toString(self, v):
+        return ' '.join(v)
+
+    def fromString(self, s):
+        return s.replace(',', ' ').split()
+
+class Argv(hieropt.Value):
+    """An argument vector, split (and unquoted) as the shell would split it, but
+    without any expansion."""
+    def toString(self, v):
+        import pipes
+        return ' '.join([pipes.quote(arg) for arg in v])
+
+    def fromString(self, s):
+        import shlex
+        return shlex.split(s)
+
+class CpuList(hieropt.Value):
+    """A list of CPU numbers and ranges of them, e.g., 0-3,8."""
+    def fromString(self, s):
+        cpus = []
+        for part in s.replace(',', ' ').split():
+            if '-' in part:
+                (first, last) = part.split('-', 1)
+                cpus.extend(range(int(first), int(last) + 1))
+            else:
+                cpus.append(int(part))
+        if not cpus or min(cpus) < 0:
+            raise ValueError('%r is not a list of CPUs' % s)
+        return sorted(set(cpus))
+
+    def toString(self, v):
+        return ','.join(map(str, v))
+
+class StatusList(List):
+    """A list of exit statuses and signal names."""
+    def fromString(self, s):
+        statuses = List.fromString(self, s)
+        for status in statuses:
+            if not status.isdigit() and \
+               not (status.startswith('SIG') and hasattr(signal, status)):
+                raise ValueError('%r is neither an exit status nor a signal' % status)
+        return statuses
                     
     
+class Size(hieropt.Value):
+    """A number of bytes, optionally suffixed with K, M or G."""
+    multipliers = {'': 1, 'K': 1 << 10, 'M': 1 << 20, 'G': 1 << 30}
+    def fromString(self, s):
+        s = s.strip().upper()
+        if s.endswith('B'):
+            s = s[:-1]
+        suffix = s[-1:] in self.multipliers and s[-1:] or ''
+        return int(s[:len(s)-len(suffix)]) * self.multipliers[suffix]
+
+class Limit(Size):
+    """A resource limit: 'unlimited', a number (optionally suffixed like a Size) or
+    soft and hard numbers separated by a colon."""
+    def fromString(self, s):
+        import resource
+        limits = []
+        for part in s.split(':'):
+            if part.strip() == 'unlimited':
+                limits.append(resource.RLIM_INFINITY)
+            else:
+                limits.append(Size.fromString(self, part))
+        if len(limits) == 1:
+            limits.append(limits[0])
+        if len(limits) != 2:
+            raise ValueError('%r is not a resource limit' % s)
+        return tuple(limits)
+
+    def toString(self, v):
+        import resource
+        names = [limit == resource.RLIM_INFINITY and 'unlimited' or '%s' % limit
+                 for limit in v]
+        if names[0] == names[1]:
+            return names[0]
+        return ':'.join(names)
+
 class CommandGroup(hieropt.Group):
     def __init__(self, name):
         hieropt.Group.__init__(self, name)
@@ -77,74 +166,431 @@ class CommandGroup(hieropt.Group):
                                     comment="""A description of what the %s command
                                                does""" % self._name))
         
-config = hieropt.Group('finitd')
-child = config.register(hieropt.Group('child'))
-
-child.register(hieropt.Value('command',
-    comment="""Command to actually run. Will be parsed by /bin/sh -c."""))
-child.register(hieropt.Value('stdin', default=devnull,
-    comment="""File to read child program's stdin from."""))
-child.register(hieropt.Value('stdout', default=devnull,
-    comment="""File to write child program's stdout to."""))
-child.register(hieropt.Value('stderr', default=child.stdout,
-    comment="""File to write child program's stderr to."""))
-child.register(hieropt.Value('chdir', default='/',
-    comment="""Directory to change to before executing child."""))
-child.register(hieropt.Bool('chroot', default=False,
-    comment="""Whether or not to chroot in the 'chdir' directory."""))
-child.register(hieropt.Int('umask', default=0,
-    comment="""Umask to set before executing child."""))
-child.register(Uid('setuid',
-    comment="""Username to setuid to."""))
-child.register(Gid('setgid',
-    comment="""Group name to setgid to."""))
-
-commands = config.register(hieropt.Group('commands'))
-commands.register(hieropt.Group('stop'))
-commands.stop.register(hieropt.Value('command',
-    comment="""Contains an optional command to run instead of just sending a signal to
-    the child pid."""))
-commands.stop.register(Signal('signal', default=signal.SIGTERM,
-    comment="""Determines what signal is sent to kill the process."""))
-commands.register(hieropt.Group('arbitrary', Child=CommandGroup,
-    comment="""finitd.commands.arbitrary contains the configuration for individual
-    commands configured by the user.  Each command supports a 'command' variable which
-    specifies the actual command to run."""))
-env = config.register(hieropt.Group('env', Child=hieropt.Value,
-    comment="""finitd.env is a group which contains variables that are placed into the
-    environment before any command is run.  To set the variable FOO to 'bar' add a line
-    'finitd.env.FOO: bar'."""))
-
-
-options = config.register(hieropt.Group('options'))
-options.register(hieropt.Value('pidfile',
-    comment="""The file to write with the pid of the spawned child process."""))
-options.register(hieropt.Bool('clearenv', default=False,
-    comment="""Determines whether to clear the environment before executing the child
-    process."""))
-options.register(hieropt.Value('envdir',
-    comment="""A directory wherein each file names an envrionment variable, the contents
-    of that file being that variable's value."""))
-options.register(hieropt.Int('restartWaitTime', default=10,
-    comment="""Number of seconds to wait during a restart before attempting to start the
-    process again."""))
-options.register(hieropt.Int('killWaitTime', default=60,
-    comment="""Number of seconds to wait during a kill before killing the process
-    forcefully."""))
-
-watcher = config.register(hieropt.Group('watcher'))
-watcher.register(hieropt.Bool('wait', default=True,
-    comment="""Determines whether the watcher will wait for the child and remove the
-    configured pidfile.  Must be True for babysitting support."""))
-# The default here breaks during tests, because it defaults to the options.pidfile
-# above, rather than the one in the particular tree in which it's called.
-watcher.register(hieropt.Value('pidfile',
-                              default=lambda: options.pidfile() and \
-                                              options.pidfile() + '.watcher',
-    comment="""A file to write the pid of the watcher."""))
-watcher.register(hieropt.Bool('restart', default=False,
-    comment="""Determines whether the watcher will restart the child if the child
-    crashes."""))
-watcher.restart.register(hieropt.Int('wait', default=60,
-    comment="""Determines the minimum number of seconds to wait after the most recent
-    restart before restarting the child process again."""))
+class SocketGroup(hieropt.Group):
+    def __init__(self, name):
+        hieropt.Group.__init__(self, name)
+        self.register(hieropt.Value('listen',
+            comment="""The address the %s socket listens on: a TCP [host:]port (e.g.,
+            8080, 127.0.0.1:8080 or [::1]:8080) or a Unix domain socket's path (e.g.,
+            unix:/var/run/service.sock).""" % self._name))
+        self.register(hieropt.Int('backlog', default=128,
+            comment="""The %s socket's listen backlog.""" % self._name))
+
+def makeConfig():
+    """Returns a new, independent finitd configuration tree."""
+    config = hieropt.Group('finitd')
+    child = config.register(hieropt.Group('child'))
+
+    child.register(hieropt.Value('command',
+        comment="""Command to actually run. Will be parsed by /bin/sh -c, unless it's
+        simple enough (just words, with nothing for the shell to expand) to be
+        executed directly."""))
+    child.register(Argv('argv',
+        comment="""An alternative to finitd.child.command: the program to run and its
+        arguments, executed directly rather than by /bin/sh, e.g., /usr/bin/server
+        --name 'my server'.  Arguments are split and unquoted as the shell would,
+        but nothing is expanded."""))
+    child.register(hieropt.Value('stdin', default=devnull,
+        comment="""File to read child program's stdin from."""))
+    child.register(hieropt.Value('stdout', default=devnull,
+        comment="""File to write child program's stdout to."""))
+    child.register(hieropt.Value('stderr', default=child.stdout,
+        comment="""File to write child program's stderr to."""))
+    child.register(hieropt.Value('chdir', default='/',
+        comment="""Directory to change to before executing child."""))
+    child.register(hieropt.Bool('chroot', default=False,
+        comment="""Whether or not to chroot in the 'chdir' directory."""))
+    child.register(hieropt.Int('umask', default=0,
+        comment="""Umask to set before executing child."""))
+    child.register(Uid('setuid',
+        comment="""Username to setuid to."""))
+    child.register(Gid('setgid',
+        comment="""Group name to setgid to."""))
+    child.register(CpuList('affinity',
+        comment="""CPUs the child process may run on, e.g., 0-3,8."""))
+    child.register(hieropt.Int('nice',
+        comment="""Nice value (-20 to 19) to run the child process with."""))
+    child.register(hieropt.Value('ionice',
+        comment="""I/O scheduling class to run the child process with: realtime,
+        best-effort or idle."""))
+    child.ionice.register(hieropt.Int('priority', default=4,
+        comment="""I/O priority, from 0 (highest) to 7, within the realtime and
+        best-effort classes."""))
+    child.register(hieropt.Value('scheduler',
+        comment="""Scheduling policy to run the child process with: other, batch, idle,
+        fifo or rr."""))
+    child.scheduler.register(hieropt.Int('priority', default=0,
+        comment="""Scheduling priority, from 1 to 99, for the fifo and rr policies."""))
+    child.register(List('requires',
+        comment="""Names of services (the names of their configuration files, without
+        the .conf extension) which must be running before this one is started.  When
+        started together with 'finitd --all', this service waits for them, and isn't
+        started at all if they fail to start."""))
+    child.register(List('after',
+        comment="""Names of services which, when started together with 'finitd --all',
+        are started before this one.  Unlike finitd.child.requires, this service is
+        started even if they fail to start."""))
+
+    commands = config.register(hieropt.Group('commands'))
+    commands.register(hieropt.Group('stop'))
+    commands.stop.register(hieropt.Value('command',
+        comment="""Contains an optional command to run instead of just sending a signal to
+        the child pid."""))
+    commands.stop.register(Signal('signal', default=signal.SIGTERM,
+        comment="""Determines what signal is sent to kill the process."""))
+    commands.register(hieropt.Group('arbitrary', Child=CommandGroup,
+        comment="""finitd.commands.arbitrary contains the configuration for individual
+        commands configured by the user.  Each command supports a 'command' variable which
+        specifies the actual command to run."""))
+    env = config.register(hieropt.Group('env', Child=hieropt.Value,
+        comment="""finitd.env is a group which contains variables that are placed into the
+        environment before any command is run.  To set the variable FOO to 'bar' add a line
+        'finitd.env.FOO: bar'."""))
+
+    options = config.register(hieropt.Group('options'))
+    options.register(hieropt.Value('pidfile',
+        comment="""The file to write with the pid of the spawned child process."""))
+    options.register(hieropt.Bool('clearenv', default=False,
+        comment="""Determines whether to clear the environment before executing the child
+        process."""))
+    options.register(hieropt.Value('envdir',
+        comment="""A directory wherein each file names an envrionment variable, the contents
+        of that file being that variable's value."""))
+    options.register(hieropt.Int('restartWaitTime', default=10,
+        comment="""Maximum number of seconds to wait during a restart for the process to
+        exit before attempting to start the process again.  The process is started again as
+        soon as the old one has exited."""))
+    options.register(hieropt.Int('killWaitTime', default=60,
+        comment="""Number of seconds to wait during a kill, or a restart after failed
+        health checks, before killing the process forcefully."""))
+    options.register(hieropt.Int('startWaitTime', default=60,
+        comment="""Maximum number of seconds services which require this one wait for
+        it to be ready after it's started, and 'start --wait-ready' waits for it to be
+        ready.  'start --wait-ready=SECONDS' overrides this.  A reload's new process
+        which isn't ready in this time is stopped, and the old one kept."""))
+    options.register(hieropt.Int('stopWaitTime', default=60,
+        comment="""Maximum number of seconds 'stop --wait' waits for the process to exit.
+        'stop --wait=SECONDS' overrides this."""))
+
+    watcher = config.register(hieropt.Group('watcher'))
+    watcher.register(hieropt.Bool('wait', default=True,
+        comment="""Determines whether the watcher will wait for the child and remove the
+        configured pidfile.  Must be True for babysitting support."""))
+    watcher.register(hieropt.Value('pidfile',
+                                  default=lambda: options.pidfile() and \
+                                                  options.pidfile() + '.watcher',
+        comment="""A file to write the pid of the watcher."""))
+    watcher.register(hieropt.Value('table',
+        comment="""A file (e.g., /run/finitd/table) shared by the watchers on this host,
+        in which the watcher publishes its state for `finitd --status-all`."""))
+    watcher.register(hieropt.Value('history',
+                                  default=lambda: options.pidfile() and \
+                                                  options.pidfile() + '.history',
+        comment="""A file in which the watcher keeps the times of the child process's
+        recent starts and crashes, so that they outlive the watcher (through a reboot
+        or another start, say) for finitd.watcher.restart.breaker.  It's only written
+        if the breaker is enabled."""))
+    watcher.register(hieropt.Bool('slim', default=True,
+        comment="""Determines whether the start command re-executes the watcher as a
+        slim process which keeps only what the watcher needs in memory, rather than
+        the whole command line and its configuration machinery."""))
+    watcher.register(hieropt.Value('socket',
+        comment="""A Unix domain socket on which the watcher accepts status, stop,
+        restart and signal requests.  The status, stop and restart commands use it when
+        it's configured."""))
+    watcher.register(hieropt.Group('metrics'))
+    watcher.metrics.register(hieropt.Value('file',
+        comment="""A file to which the watcher writes the child's resource usage (CPU
+        time, memory, open files, threads and I/O, from /proc) in the Prometheus text
+        format, e.g. for node_exporter's textfile collector.  The same metrics are
+        available from the control socket, sampled when they're requested."""))
+    watcher.metrics.register(hieropt.Int('interval', default=15,
+        comment="""Number of seconds between writes of finitd.watcher.metrics.file."""))
+    watcher.register(hieropt.Bool('restart', default=False,
+        comment="""Determines whether the watcher will restart the child if the child
+        crashes."""))
+    watcher.register(hieropt.Value('ready',
+        comment="""How the watcher knows the child process is ready: notify (it sends
+        READY=1 to the socket named by NOTIFY_SOCKET, as sd_notify does), port (the
+        address in finitd.watcher.ready.port accepts connections) or output (it writes
+        a line matching finitd.watcher.ready.output; requires finitd.log.pipe).  If
+        it isn't set, the child process is ready once it's executed."""))
+    watcher.ready.register(hieropt.Value('port',
+        comment="""The address, a TCP [host:]port or a Unix domain socket's path, the
+        port strategy connects to.  It shouldn't be one of finitd.sockets, which the
+        watcher itself is listening on."""))
+    watcher.ready.register(hieropt.Value('output',
+        comment="""The regular expression the output strategy looks for in the child
+        process's output.  During a reload, the old process's output is read from the
+        same pipes, so it shouldn't match anything the old process writes then."""))
+    watcher.register(hieropt.Value('health',
+        comment="""How the watcher checks that the child process is healthy once it's
+        ready: connect (finitd.watcher.health.address accepts a connection), http (a
+        GET of finitd.watcher.health.path from that address gets a 2xx or 3xx
+        response) or command (finitd.watcher.health.command exits with status 0).
+        After finitd.watcher.health.failures consecutive failures, the child process
+        is restarted."""))
+    watcher.health.register(hieropt.Value('address',
+        comment="""The address, a TCP [host:]port or a Unix domain socket's path, the
+        connect and http checks connect to."""))
+    watcher.health.register(hieropt.Value('path', default='/',
+        comment="""The path the http check requests."""))
+    watcher.health.register(hieropt.Value('command',
+        comment="""The command the command check runs.  Will be parsed by
+        /bin/sh -c."""))
+    watcher.health.register(hieropt.Float('interval', default=10,
+        comment="""Number of seconds between health checks."""))
+    watcher.health.register(hieropt.Float('timeout', default=5,
+        comment="""Number of seconds after which a health check which hasn't finished
+        fails."""))
+    watcher.health.register(hieropt.Int('failures', default=3,
+        comment="""Number of consecutive failed health checks after which the child
+        process is restarted."""))
+    watcher.register(hieropt.Group('reload'))
+    watcher.reload.register(hieropt.Int('wait', default=5,
+        comment="""If finitd.watcher.ready isn't set, the number of seconds the new
+        child process started by the reload command must run before it's considered
+        ready to replace the old one."""))
+    watcher.reload.register(hieropt.Int('timeout', default=60,
+        comment="""Number of seconds the old child process replaced by the reload
+        command has to exit after being sent finitd.commands.stop.signal before it's
+        killed."""))
+    watcher.restart.register(hieropt.Int('wait', default=1,
+        comment="""Determines the minimum number of seconds to wait after the most recent
+        restart before restarting the child process again."""))
+    watcher.restart.register(hieropt.Float('backoff', default=1,
+        comment="""Number of seconds to wait before restarting the child process after
+        it fails.  The wait grows by finitd.watcher.restart.backoff.factor for each
+        consecutive failure."""))
+    watcher.restart.backoff.register(hieropt.Float('factor', default=2,
+        comment="""Factor by which the wait grows for each consecutive failure."""))
+    watcher.restart.backoff.register(hieropt.Float('max', default=300,
+        comment="""Maximum number of seconds to wait before restarting the child
+        process."""))
+    watcher.restart.backoff.register(hieropt.Float('jitter', default=0.5,
+        comment="""Fraction of each wait which is randomized, so services which fail at
+        the same time aren't all restarted at the same time."""))
+    watcher.restart.register(hieropt.Int('stable', default=60,
+        comment="""Number of seconds the child process must run before its next failure
+        no longer counts as consecutive with the ones before it."""))
+    watcher.restart.register(hieropt.Int('retries', default=0,
+        comment="""Maximum number of consecutive failures to restart the child process
+        after; the watcher exits after the next one.  0 means no maximum."""))
+    watcher.restart.register(hieropt.Int('breaker', default=0,
+        comment="""If nonzero, the number of crashes (failures which would be restarted)
+        within finitd.watcher.restart.breaker.window seconds after which the watcher
+        stops restarting the child process, reporting it as tripped, until
+        finitd.watcher.restart.breaker.cooldown seconds have passed.  It then tries
+        the process once more, and trips again if that crashes before it's stable.
+        Crashes are counted across watchers through finitd.watcher.history."""))
+    watcher.restart.breaker.register(hieropt.Float('window', default=300,
+        comment="""Number of seconds in which finitd.watcher.restart.breaker crashes
+        trip the breaker."""))
+    watcher.restart.breaker.register(hieropt.Float('cooldown', default=600,
+        comment="""Number of seconds after the breaker trips before the watcher tries
+        the process again."""))
+    watcher.restart.register(StatusList('on',
+        comment="""Exit statuses (e.g., 1) and signals (e.g., SIGSEGV) after which the
+        child process is restarted.  By default, it's restarted after any nonzero exit
+        status or signal."""))
+    watcher.restart.register(StatusList('ignore',
+        comment="""Exit statuses and signals after which the child process isn't
+        restarted, even if finitd.watcher.restart.on matches."""))
+    watcher.restart.register(hieropt.Value('command',
+        comment="""A command to run before restarting the child process.  If it exits with
+        a nonzero status, the child process is not restarted."""))
+
+    sockets = config.register(hieropt.Group('sockets', Child=SocketGroup,
+        comment="""finitd.sockets contains listening sockets the watcher binds once and
+        passes to every child process it starts as file descriptors 3 and up, with
+        LISTEN_FDS, LISTEN_PID and LISTEN_FDNAMES set as systemd does.  To pass a
+        socket listening on port 8080 named 'http', add a line
+        'finitd.sockets.http.listen: 8080'."""))
+
+    limits = config.register(hieropt.Group('limits',
+        comment="""finitd.limits contains the resource limits the child process is
+        started with.  Each rlimit is 'unlimited', a number (e.g., 1024 or 2G) which
+        is both the soft and the hard limit, or soft and hard limits separated by a
+        colon (e.g., 1024:4096)."""))
+    for (name, comment) in [
+        ('nofile', 'Maximum number of open file descriptors.'),
+        ('nproc', "Maximum number of processes for the child's user."),
+        ('as', 'Maximum size of the address space, in bytes.'),
+        ('core', 'Maximum size of core files, in bytes.'),
+        ('cpu', 'Maximum CPU time, in seconds.'),
+        ('memlock', 'Maximum number of bytes of locked memory.'),
+    ]:
+        limits.register(Limit(name, comment=comment))
+    limits.register(hieropt.Value('cgroup',
+        comment="""A cgroup (a path under /sys/fs/cgroup; cgroup v2 only) to start the
+        child process in.  It's created if necessary."""))
+    limits.cgroup.register(Size('memory',
+        comment="""The cgroup's memory.max, e.g., 512M."""))
+    limits.cgroup.register(hieropt.Value('cpu',
+        comment="""The cgroup's cpu.max, either as a percentage of one CPU (e.g., 50%
+        or 200%) or in cpu.max's own format ('quota period', in microseconds)."""))
+
+    log = config.register(hieropt.Group('log'))
+    log.register(hieropt.Bool('pipe', default=False,
+        comment="""Determines whether the child writes its stdout and stderr into pipes,
+        from which the watcher writes them to finitd.child.stdout and
+        finitd.child.stderr.  The watcher can then rotate those files as configured by
+        finitd.log.rotate without the child's involvement.  Requires
+        finitd.watcher.wait."""))
+    log.register(Size('buffer', default=0,
+        comment="""Number of bytes of the child's output the watcher buffers in memory
+        while a separate thread writes it, so a stalled disk doesn't stall the watcher
+        or the child.  0 means the watcher writes the child's output itself, and the
+        child waits whenever the watcher does."""))
+    log.buffer.register(hieropt.Value('full', default='block',
+        comment="""What the watcher does when the buffer is full: block (stop reading
+        the child's output, so the child waits for the disk), drop-oldest or
+        drop-newest.  How much output was dropped is written to the log once it's
+        writable again."""))
+    log.register(hieropt.Group('rotate'))
+    log.rotate.register(Size('size', default=0,
+        comment="""Size (e.g., 100M) at which the watcher rotates the child's output
+        files.  0 means they aren't rotated by size."""))
+    log.rotate.register(hieropt.Int('interval', default=0,
+        comment="""Number of seconds after which the watcher rotates the child's output
+        files.  Rotations happen at multiples of this interval, so 3600 rotates them on
+        the hour and 86400 at midnight UTC.  0 means they aren't rotated by time."""))
+    log.rotate.register(hieropt.Int('keep', default=10,
+        comment="""Number of rotated files to keep, each named after the file it was
+        rotated from and the time it was rotated.  0 means all of them are kept."""))
+    log.rotate.register(hieropt.Value('compress',
+        comment="""How rotated files are compressed: gzip or bz2.  They're compressed by
+        a separate process, so the watcher never waits for them."""))
+    log.register(hieropt.Float('index', default=1,
+        comment="""Number of seconds between the entries of the sparse index of times
+        and offsets the watcher keeps (as <file>.index) for each file it writes the
+        child's output to, which lets the logs command's --since and --until seek
+        straight to the output written around a given time.  0 means no index is
+        kept."""))
+    return config
+
+def cacheDirectory():
+    return os.path.join(os.environ.get('XDG_CACHE_HOME') or
+                        os.path.expanduser('~/.cache'), 'finitd')
+
+def trusted(fd):
+    """Returns whether the file or directory open as fd belongs to us and can't be
+    written by anyone else, so what's cached in it can be trusted.  (Under sudo,
+    for instance, root may be given the invoking user's cache directory.)"""
+    st = os.fstat(fd)
+    return st.st_uid == os.geteuid() and \
+           not st.st_mode & (stat.S_IWGRP | stat.S_IWOTH)
+
+def trustedDirectory(path):
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        return trusted(fd)
+    finally:
+        os.close(fd)
+
+def cacheKey(filename):
+    """Returns what must not have changed for the cached values of the given
+    configuration file to be used: the file itself, finitd (and this module in
+    particular), and the user and group databases Uid and Gid values come from."""
+    import finitd
+    st = os.stat(filename)
+    key = [filename, finitd.__version__, os.path.getmtime(__file__),
+           st.st_mtime, st.st_size, st.st_ino]
+    for database in ['/etc/passwd', '/etc/group']:
+        try:
+            key.append(os.path.getmtime(database))
+        except OSError:
+            key.append(None)
+    return tuple(key)
+
+def lookup(config, name):
+    """Returns the variable in config with the given full name (e.g.,
+    'finitd.child.command'), creating it if its group creates children."""
+    variable = config
+    for part in name.split('.')[1:]:
+        variable = variable.get(part)
+    return variable
+
+def readConfig(config, filename):
+    """Reads the given configuration file into config, as config.read does, but
+    from a cache of the values it sets (in cacheDirectory()) if nothing they depend
+    on has changed since they were cached."""
+    filename = os.path.abspath(filename)
+    try:
+        key = cacheKey(filename)
+    except OSError:
+        config.read(filename) # Which reports the problem.
+        return
+    # A checksum's enough to name it by (and cheaper to import than hashlib), since
+    # the filename is part of the key, too.
+    cacheFile = os.path.join(cacheDirectory(), '%08x' % (binascii.crc32(filename) &
+                                                         0xffffffff))
+    try:
+        fp = open(cacheFile, 'rb')
+        try:
+            if not trusted(fp.fileno()) or not trustedDirectory(cacheDirectory()):
+                raise ValueError('untrusted cache')
+            (cachedKey, values) = marshal.load(fp)
+        finally:
+            fp.close()
+        if cachedKey == key:
+            for (name, value) in values:
+                lookup(config, name).set(value)
+            return
+    except (EnvironmentError, EOFError, ValueError, TypeError, KeyError):
+        pass
+    config.read(filename)
+    values = [(name, variable._value) for (name, variable) in config
+              if variable.expectsValue() and not variable.isDefault()]
+    try:
+        if not os.path.isdir(cacheDirectory()):
+            os.makedirs(cacheDirectory(), 0700)
+        if not trustedDirectory(cacheDirectory()):
+            return
+        temporary = '%s.%s' % (cacheFile, os.getpid())
+        fp = os.fdopen(os.open(temporary, os.O_WRONLY | os.O_CREAT | os.O_EXCL,
+                               0600), 'wb')
+        try:
+            marshal.dump((key, values), fp)
+        finally:
+            fp.close()
+        os.rename(temporary, cacheFile)
+    except (EnvironmentError, ValueError):
+        pass # Caching is only an optimization.
+
+config = makeConfig()
+child = config.child
+commands = config.commands
+env = config.env
+options = config.options
+watcher = config.watcher
+log = config.log
+limits = config.limits
+sockets = config.sockets
+
+def resolvePath(config, path):
+    """Returns the given file path made absolute, as a watcher running in the
+    configured chdir (and possibly chroot) would have seen it."""
+    if config.child.chroot():
+        return os.path.join(config.child.chdir(), path.lstrip('/'))
+    return os.path.join(config.child.chdir(), path)
+
+def resolvePaths(config):
+    """Makes the file paths in the given configuration absolute (see resolvePath)."""
+    resolve = lambda path: resolvePath(config, path)
+    for value in [config.child.stdin, config.child.stdout, config.child.stderr,
+                  config.options.pidfile, config.watcher.pidfile,
+                  config.watcher.socket, config.watcher.metrics.file,
+                  config.watcher.history, config.watcher.table]:
+        if value.isDefault() and value in [config.child.stderr, config.watcher.pidfile,
+                                           config.watcher.history]:
+            continue # These defaults follow other values, which we resolve.
+        if value() is not None:
+            value.set(resolve(value()))
+    for value in [group.listen for group in config.sockets.children()] + \
+                 [config.watcher.ready.port, config.watcher.health.address]:
+        address = value()
+        if address and address.startswith('unix:'):
+            value.set('unix:' + resolve(address[len('unix:'):]))
+        elif address and address.startswith('/'):
+            value.set(resolve(address))
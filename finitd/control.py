@@ -0,0 +1,275 @@
+###
+# Copyright (c) 2009, Juju, Inc.
+# All rights reserved.
+# 
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are
+# met:
+# 
+#     * Redistributions of source code must retain the above copyright
+#       notice, this list of conditions and the following disclaimer. 
+#     * Redistributions in binary form must reproduce the above
+#       copyright notice, this list of conditions and the following
+#       disclaimer in the documentation and/or other materials provided
+#       with the distribution.
+#     * Neither the name of the author of this software nor the names of
+#       the contributors to the software may be used to endorse or
+#       promote products derived from this software without specific
+#       prior written permission. 
+# 
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS
+# "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT
+# LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR
+# A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT
+# HOLDER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL,
+# SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT
+# LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE,
+# DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY
+# THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+# OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE. 
+###
+
+"""The watcher's control socket.  A client connects to the Unix domain socket
+configured as finitd.watcher.socket and sends a one-line request:
+
+    status          -- Replies with the watcher's state.
+    stop            -- Stops the child process without restarting it.
+    restart         -- Restarts the child process, replying once it's restarted.
+    reload          -- Replaces the child process with a new one, started before the
+                       old one is stopped, replying once the new one is ready.
+    signal SIGNAL   -- Sends the child process the given signal (name or number).
+    metrics         -- Replies with the child's resource usage (see finitd.metrics).
+
+Every reply is a single line containing a JSON object.  Successful replies contain
+the watcher's state (see Watcher.state), except that the metrics request's reply
+contains the metrics, in the Prometheus text format, as 'metrics'.  Failed requests
+get an object with an 'error' key."""
+
+import os
+import errno
+import socket
+
+import util
+import metrics
+from compat import json
+
+MAXREQUEST = 1024
+REPLYTIMEOUT = 5 # Seconds a client has to read its reply.
+
+def request(path, line, timeout=5):
+    """Sends the given request to the control socket at path and returns the
+    reply.  Raises socket.error if the watcher can't be reached."""
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.settimeout(timeout)
+        sock.connect(path)
+        sock.sendall(line + '\n')
+        data = ''
+        while '\n' not in data:
+            s = sock.recv(4096)
+            if not s:
+                raise socket.error(errno.ECONNRESET, 'Connection closed by watcher')
+            data += s
+    finally:
+        sock.close()
+    try:
+        return json.loads(data)
+    except ValueError, e:
+        raise socket.error(errno.EPROTO, 'Invalid reply from watcher: %s' % e)
+
+class Request(object):
+    """A request sent to the control socket at path without blocking the given
+    EventLoop.  callback(reply) is called with the reply, or with None if the watcher
+    can't be reached or doesn't reply within timeout seconds."""
+    def __init__(self, loop, path, line, callback, timeout=5):
+        self.loop = loop
+        self.line = line
+        self.callback = callback
+        self.data = ''
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        util.setCloexec(self.sock.fileno())
+        self.sock.setblocking(0)
+        self.timer = loop.callLater(timeout, self.finish, None)
+        try:
+            self.sock.connect(path)
+        except socket.error, e:
+            if e.args[0] not in (errno.EINPROGRESS, errno.EAGAIN):
+                self.timer.cancel()
+                self.timer = loop.callLater(0, self.finish, None)
+                return
+        loop.addWriter(self.sock.fileno(), self.connected)
+
+    def connected(self, fd):
+        self.loop.removeWriter(fd)
+        try:
+            if self.sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR):
+                raise socket.error(errno.ECONNREFUSED, 'Connection refused')
+            self.sock.sendall(self.line + '\n') # Requests fit in the socket buffer.
+        except socket.error:
+            self.finish(None)
+            return
+        self.loop.addReader(fd, self.read)
+
+    def read(self, fd):
+        try:
+            s = self.sock.recv(4096)
+        except socket.error, e:
+            if e.args[0] in (errno.EAGAIN, errno.EINTR):
+                return
+            s = ''
+        if not s:
+            self.finish(None)
+            return
+        self.data += s
+        if '\n' in self.data:
+            try:
+                reply = json.loads(self.data)
+            except ValueError:
+                reply = None
+            self.finish(reply)
+
+    def finish(self, reply):
+        if self.sock is None:
+            return
+        self.timer.cancel()
+        self.loop.removeReader(self.sock.fileno())
+        self.loop.removeWriter(self.sock.fileno())
+        self.sock.close()
+        self.sock = None
+        self.callback(reply)
+
+
+class ControlServer(object):
+    def __init__(self, watcher, path, loop):
+        self.watcher = watcher
+        self.path = path
+        self.loop = loop
+        self.sock = None
+        self.connections = {} # {fd: (socket, data read so far)}
+        self.replies = {} # {fd: (socket, data left to send, timer)}
+
+    def listen(self):
+        if os.path.exists(self.path):
+            try:
+                request(self.path, 'status', timeout=1)
+            except socket.error:
+                os.remove(self.path) # Left over from a watcher that's gone.
+            else:
+                raise socket.error(errno.EADDRINUSE,
+                                   'Another watcher is listening on %r' % self.path)
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        util.setCloexec(self.sock.fileno())
+        self.sock.setblocking(0)
+        self.sock.bind(self.path)
+        self.sock.listen(16)
+        self.loop.addReader(self.sock.fileno(), self.accept)
+
+    def close(self):
+        for fd in self.connections.keys():
+            self.closeConnection(fd)
+        for fd in self.replies.keys():
+            self.closeReply(fd)
+        if self.sock is not None:
+            self.loop.removeReader(self.sock.fileno())
+            self.sock.close()
+            self.sock = None
+            try:
+                os.remove(self.path)
+            except OSError:
+                pass
+
+    def accept(self, fd):
+        try:
+            (conn, _) = self.sock.accept()
+        except socket.error, e:
+            if e.args[0] in (errno.EAGAIN, errno.EINTR):
+                return
+            raise
+        util.setCloexec(conn.fileno())
+        conn.setblocking(0)
+        self.connections[conn.fileno()] = (conn, '')
+        self.loop.addReader(conn.fileno(), self.read)
+
+    def closeConnection(self, fd):
+        (conn, _) = self.connections.pop(fd)
+        self.loop.removeReader(fd)
+        conn.close()
+
+    def read(self, fd):
+        (conn, data) = self.connections[fd]
+        try:
+            s = conn.recv(4096)
+        except socket.error, e:
+            if e.args[0] in (errno.EAGAIN, errno.EINTR):
+                return
+            s = ''
+        if not s or len(data) > MAXREQUEST:
+            self.closeConnection(fd)
+            return
+        data += s
+        if '\n' not in data:
+            self.connections[fd] = (conn, data)
+            return
+        # We only handle one request per connection.
+        self.loop.removeReader(fd)
+        del self.connections[fd]
+        def respond(reply):
+            # The reply is sent without blocking, so a client which doesn't read it
+            # can't hold up the watcher.
+            timer = self.loop.callLater(REPLYTIMEOUT, self.closeReply, fd)
+            self.replies[fd] = (conn, json.dumps(reply) + '\n', timer)
+            self.write(fd)
+        self.handle(data.split('\n', 1)[0].split(), respond)
+
+    def write(self, fd):
+        (conn, data, timer) = self.replies[fd]
+        try:
+            sent = conn.send(data)
+        except socket.error, e:
+            if e.args[0] in (errno.EAGAIN, errno.EINTR):
+                self.loop.addWriter(fd, self.write)
+                return
+            sent = len(data) # The client went away; nothing to do about it.
+        data = data[sent:]
+        if data:
+            self.replies[fd] = (conn, data, timer)
+            self.loop.addWriter(fd, self.write)
+        else:
+            self.closeReply(fd)
+
+    def closeReply(self, fd):
+        (conn, _, timer) = self.replies.pop(fd)
+        timer.cancel()
+        self.loop.removeWriter(fd)
+        conn.close()
+
+    def handle(self, words, respond):
+        if not words:
+            respond({'error': 'Empty request'})
+        elif words == ['status']:
+            respond(self.watcher.state())
+        elif words == ['stop']:
+            self.watcher.stop()
+            respond(self.watcher.state())
+        elif words == ['reload']:
+            def reloaded(error):
+                if error:
+                    respond({'error': error})
+                else:
+                    respond(self.watcher.state())
+            self.watcher.reload(reloaded)
+        elif words == ['metrics']:
+            respond({'metrics': metrics.render(self.watcher)})
+        elif words == ['restart']:
+            self.watcher.restart(lambda: respond(self.watcher.state()))
+        elif words[0] == 'signal' and len(words) == 2:
+            try:
+                signum = util.parseSignal(words[1])
+                self.watcher.signal(signum)
+            except (ValueError, OSError), e:
+                respond({'error': str(e)})
+            else:
+                respond(self.watcher.state())
+        else:
+            respond({'error': 'Invalid request: %r' % ' '.join(words)})
@@ -0,0 +1,258 @@
+###
+# Copyright (c) 2009, Juju, Inc.
+# All rights reserved.
+# 
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are
+# met:
+# 
+#     * Redistributions of source code must retain the above copyright
+#       notice, this list of conditions and the following disclaimer. 
+#     * Redistributions in binary form must reproduce the above
+#       copyright notice, this list of conditions and the following
+#       disclaimer in the documentation and/or other materials provided
+#       with the distribution.
+#     * Neither the name of the author of this software nor the names of
+#       the contributors to the software may be used to endorse or
+#       promote products derived from this software without specific
+#       prior written permission. 
+# 
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS
+# "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT
+# LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR
+# A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT
+# HOLDER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL,
+# SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT
+# LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE,
+# DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY
+# THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+# OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE. 
+###
+
+"""A small select/poll based event loop for the watcher.
+
+Everything the watcher reacts to -- child exits, signals, readable file descriptors
+and timers -- is dispatched from EventLoop.run, so the watcher sleeps in a single
+poll() call until something actually happens.  Signals are delivered through a
+self-pipe, so signal handlers never run watcher code in signal context."""
+
+import os
+import time
+import heapq
+import errno
+import select
+import signal
+import threading
+
+import util
+
+WAKEUP = 0 # Written to the wakeup pipe by callFromThread; no signal is 0.
+
+# select.poll doesn't exist everywhere, but we use its event masks regardless.
+POLLIN = getattr(select, 'POLLIN', 1)
+POLLPRI = getattr(select, 'POLLPRI', 2)
+POLLOUT = getattr(select, 'POLLOUT', 4)
+
+class Timer(object):
+    def __init__(self, when, callback, args):
+        self.when = when
+        self.callback = callback
+        self.args = args
+        self.cancelled = False
+
+    def cancel(self):
+        self.cancelled = True
+
+    def __cmp__(self, other):
+        return cmp(self.when, other.when)
+
+
+class EventLoop(object):
+    def __init__(self):
+        self.readers = {}  # {fd: callback(fd)}
+        self.writers = {}  # {fd: callback(fd)}
+        self.children = {} # {pid: callback(pid, status)}
+        self.signals = {}  # {signum: callback(signum)}
+        self.timers = []   # heap of Timer objects
+        self.calls = []    # [(callback, args)] from callFromThread
+        self.callsLock = threading.Lock()
+        self.running = False
+        self.stopped = False # Whether stop was called since run last returned.
+        if hasattr(select, 'poll'):
+            self.poller = select.poll()
+        else:
+            self.poller = None
+        (self.wakeupRead, self.wakeupWrite) = os.pipe()
+        for fd in (self.wakeupRead, self.wakeupWrite):
+            util.setCloexec(fd)
+            util.setNonblocking(fd)
+        self.addReader(self.wakeupRead, self._readWakeup)
+        self.handleSignal(signal.SIGCHLD, self._reapChildren)
+
+    def _updatePoller(self, fd):
+        if self.poller is None:
+            return
+        events = 0
+        if fd in self.readers:
+            events |= POLLIN | POLLPRI
+        if fd in self.writers:
+            events |= POLLOUT
+        if events:
+            self.poller.register(fd, events)
+        else:
+            try:
+                self.poller.unregister(fd)
+            except KeyError:
+                pass
+
+    def addReader(self, fd, callback):
+        self.readers[fd] = callback
+        self._updatePoller(fd)
+
+    def removeReader(self, fd):
+        self.readers.pop(fd, None)
+        self._updatePoller(fd)
+
+    def addWriter(self, fd, callback):
+        self.writers[fd] = callback
+        self._updatePoller(fd)
+
+    def removeWriter(self, fd):
+        self.writers.pop(fd, None)
+        self._updatePoller(fd)
+
+    def callLater(self, seconds, callback, *args):
+        """Schedules callback(*args) to be called in the given number of seconds.
+        Returns a Timer whose cancel method unschedules the call."""
+        timer = Timer(time.time() + seconds, callback, args)
+        heapq.heappush(self.timers, timer)
+        return timer
+
+    def callFromThread(self, callback, *args):
+        """Arranges for callback(*args) to be called from the loop.  This is the only
+        EventLoop method that's safe to call from another thread."""
+        self.callsLock.acquire()
+        try:
+            self.calls.append((callback, args))
+        finally:
+            self.callsLock.release()
+        self._signalHandler(WAKEUP, None)
+
+    def handleSignal(self, signum, callback):
+        """Arranges for callback(signum) to be called from the loop (not from the
+        signal handler itself) whenever the given signal is received."""
+        self.signals[signum] = callback
+        signal.signal(signum, self._signalHandler)
+
+    def watchChild(self, pid, callback):
+        """Arranges for callback(pid, status) to be called once the given child
+        process exits."""
+        self.children[pid] = callback
+        # The child might have exited before we started watching it.
+        self._reapChildren(signal.SIGCHLD)
+
+    def unwatchChild(self, pid):
+        self.children.pop(pid, None)
+
+    def _signalHandler(self, signum, frame):
+        try:
+            os.write(self.wakeupWrite, chr(signum))
+        except OSError, e:
+            if e.errno != errno.EAGAIN: # The pipe is full; we'll wake up anyway.
+                raise
+
+    def _readWakeup(self, fd):
+        try:
+            data = os.read(fd, 512)
+        except OSError, e:
+            if e.errno == errno.EAGAIN:
+                return
+            raise
+        seen = set()
+        for signum in map(ord, data):
+            if signum in seen:
+                continue
+            seen.add(signum)
+            callback = self.signals.get(signum)
+            if callback is not None:
+                callback(signum)
+        if self.calls:
+            self._runCalls()
+
+    def _runCalls(self):
+        self.callsLock.acquire()
+        try:
+            (calls, self.calls) = (self.calls, [])
+        finally:
+            self.callsLock.release()
+        for (callback, args) in calls:
+            callback(*args)
+
+    def _reapChildren(self, signum):
+        # We only reap the children we've been asked to watch, so anything else
+        # (os.system, for instance) can still wait for its own children.
+        for pid in self.children.keys():
+            try:
+                (reaped, status) = os.waitpid(pid, os.WNOHANG)
+            except OSError, e:
+                if e.errno == errno.EINTR:
+                    continue
+                elif e.errno != errno.ECHILD:
+                    raise
+                status = -1 # Someone else reaped it; we'll never know its status.
+            else:
+                if not reaped:
+                    continue # Still running.
+            callback = self.children.pop(pid)
+            callback(pid, status)
+
+    def _timeout(self):
+        while self.timers and self.timers[0].cancelled:
+            heapq.heappop(self.timers)
+        if not self.timers:
+            return None
+        return max(0, self.timers[0].when - time.time())
+
+    def _poll(self, timeout):
+        if self.poller is not None:
+            if timeout is not None:
+                timeout = int(timeout * 1000) + 1 # poll() takes milliseconds.
+            return self.poller.poll(timeout)
+        (r, w, x) = select.select(self.readers.keys(), self.writers.keys(), [],
+                                  timeout)
+        return [(fd, POLLIN) for fd in r] + \
+               [(fd, POLLOUT) for fd in w]
+
+    def _runTimers(self):
+        now = time.time()
+        while self.timers and self.timers[0].when <= now:
+            timer = heapq.heappop(self.timers)
+            if not timer.cancelled:
+                timer.callback(*timer.args)
+
+    def run(self):
+        """Dispatches events until stop is called.  If it was called before run (by
+        a callback run while setting things up, say), run returns at once."""
+        self.running = not self.stopped
+        self.stopped = False
+        while self.running:
+            try:
+                events = self._poll(self._timeout())
+            except (select.error, OSError, IOError), e:
+                if e.args[0] == errno.EINTR:
+                    continue
+                raise
+            for (fd, event) in events:
+                if event & POLLOUT and fd in self.writers:
+                    self.writers[fd](fd)
+                if event & ~POLLOUT and fd in self.readers:
+                    self.readers[fd](fd)
+                if not self.running:
+                    break
+            if self.running:
+                self._runTimers()
+
+    def stop(self):
+        self.stopped = not self.running
+        self.running = False
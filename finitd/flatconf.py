@@ -0,0 +1,73 @@
+###
+# Copyright (c) 2009, Juju, Inc.
+# All rights reserved.
+# 
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are
+# met:
+# 
+#     * Redistributions of source code must retain the above copyright
+#       notice, this list of conditions and the following disclaimer. 
+#     * Redistributions in binary form must reproduce the above
+#       copyright notice, this list of conditions and the following
+#       disclaimer in the documentation and/or other materials provided
+#       with the distribution.
+#     * Neither the name of the author of this software nor the names of
+#       the contributors to the software may be used to endorse or
+#       promote products derived from this software without specific
+#       prior written permission. 
+# 
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS
+# "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT
+# LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR
+# A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT
+# HOLDER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL,
+# SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT
+# LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE,
+# DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY
+# THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+# OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE. 
+###
+
+
+"""A configuration tree flattened into plain values, so it can be handed to another
+process (see slim) without the hieropt variables and parsing that produced it."""
+
+def flatten(variable):
+    """Returns the given configuration variable and its children, evaluated, as
+    nested (name, value, isDefault, children) tuples that marshal can serialize."""
+    if variable.expectsValue():
+        (value, isDefault) = (variable(), variable.isDefault())
+    else:
+        (value, isDefault) = (None, True)
+    return (variable._name, value, isDefault,
+            [flatten(child) for child in variable.children()])
+
+class Variable(object):
+    """A read-only stand-in for a configuration variable, made from flatten's
+    output."""
+    def __init__(self, flattened):
+        (self._name, self._value, self._isDefault, children) = flattened
+        self._children = [Variable(child) for child in children]
+        self._byName = dict((child._name, child) for child in self._children)
+
+    def __call__(self):
+        return self._value
+
+    def __getattr__(self, name):
+        if name.startswith('_'):
+            raise AttributeError(name)
+        try:
+            return self._byName[name]
+        except KeyError:
+            raise AttributeError(name)
+
+    def get(self, name):
+        return self._byName[name]
+
+    def children(self):
+        return list(self._children)
+
+    def isDefault(self):
+        return self._isDefault
@@ -0,0 +1,278 @@
+###
+# Copyright (c) 2009, Juju, Inc.
+# All rights reserved.
+# 
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are
+# met:
+# 
+#     * Redistributions of source code must retain the above copyright
+#       notice, this list of conditions and the following disclaimer. 
+#     * Redistributions in binary form must reproduce the above
+#       copyright notice, this list of conditions and the following
+#       disclaimer in the documentation and/or other materials provided
+#       with the distribution.
+#     * Neither the name of the author of this software nor the names of
+#       the contributors to the software may be used to endorse or
+#       promote products derived from this software without specific
+#       prior written permission. 
+# 
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS
+# "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT
+# LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR
+# A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT
+# HOLDER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL,
+# SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT
+# LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE,
+# DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY
+# THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+# OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE. 
+###
+
+
+"""Periodic health checks the watcher runs against its child process, restarting
+it after too many consecutive failures.  Connections (and HTTP requests) are made
+from the watcher's own event loop; only the command check forks."""
+
+import os
+import errno
+import signal
+import socket
+
+import util
+import sockets
+
+class Probe(object):
+    """A single health check, calling callback with None if it passed or with the
+    reason it failed.  A cancelled probe never calls its callback."""
+    def __init__(self, watcher, callback):
+        self.watcher = watcher
+        self.config = watcher.config.watcher.health
+        self.loop = watcher.loop
+        self.callback = callback
+
+    def start(self):
+        raise NotImplementedError
+
+    def cancel(self):
+        self.callback = None
+
+    def finish(self, error):
+        (callback, self.callback) = (self.callback, None)
+        if callback is not None:
+            callback(error)
+
+
+class SocketProbe(Probe):
+    """Passes if finitd.watcher.health.address accepts a connection."""
+    request = None # Sent once connected, if given.
+    def __init__(self, watcher, callback):
+        Probe.__init__(self, watcher, callback)
+        self.sock = None
+        self.response = ''
+
+    def start(self):
+        (family, address) = sockets.parseAddress(self.config.address())
+        self.sock = socket.socket(family, socket.SOCK_STREAM)
+        util.setCloexec(self.sock.fileno())
+        self.sock.setblocking(0)
+        err = self.sock.connect_ex(address)
+        if err == 0:
+            self.connected()
+        elif err == errno.EINPROGRESS:
+            self.loop.addWriter(self.sock.fileno(), self.writable)
+        else:
+            self.done('could not connect: %s' % os.strerror(err))
+
+    def writable(self, fd):
+        self.loop.removeWriter(fd)
+        err = self.sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+        if err:
+            self.done('could not connect: %s' % os.strerror(err))
+        else:
+            self.connected()
+
+    def connected(self):
+        if self.request is None:
+            self.done(None)
+        else:
+            self.pending = self.request
+            self.loop.addWriter(self.sock.fileno(), self.send)
+
+    def send(self, fd):
+        try:
+            sent = self.sock.send(self.pending)
+        except socket.error, e:
+            if e.args[0] in (errno.EAGAIN, errno.EINTR):
+                return
+            self.done('could not send request: %s' % e.args[-1])
+            return
+        self.pending = self.pending[sent:]
+        if not self.pending:
+            self.loop.removeWriter(fd)
+            self.loop.addReader(fd, self.read)
+
+    def read(self, fd):
+        try:
+            data = self.sock.recv(4096)
+        except socket.error, e:
+            if e.args[0] in (errno.EAGAIN, errno.EINTR):
+                return
+            self.done('could not read response: %s' % e.args[-1])
+            return
+        self.response += data
+        if not data or '\n' in self.response:
+            self.done(self.checkResponse())
+
+    def checkResponse(self):
+        return None
+
+    def done(self, error):
+        """Finishes the probe, passing if error is None."""
+        self.close()
+        self.finish(error)
+
+    def close(self):
+        if self.sock is not None:
+            self.loop.removeReader(self.sock.fileno())
+            self.loop.removeWriter(self.sock.fileno())
+            self.sock.close()
+            self.sock = None
+
+    def cancel(self):
+        Probe.cancel(self)
+        self.close()
+
+
+class HttpProbe(SocketProbe):
+    """Passes if a GET of finitd.watcher.health.path from finitd.watcher.health.address
+    gets a 2xx or 3xx response."""
+    def __init__(self, watcher, callback):
+        SocketProbe.__init__(self, watcher, callback)
+        (family, address) = sockets.parseAddress(self.config.address())
+        if family == socket.AF_UNIX:
+            host = 'localhost'
+        else:
+            host = address[0]
+        self.request = ('GET %s HTTP/1.0\r\nHost: %s\r\nConnection: close\r\n\r\n' %
+                        (self.config.path(), host))
+
+    def checkResponse(self):
+        line = self.response.split('\n', 1)[0].strip()
+        parts = line.split()
+        if len(parts) < 2 or not parts[0].startswith('HTTP/'):
+            return 'invalid response: %r' % line[:80]
+        elif parts[1][:1] not in '23':
+            return 'response: %s' % line[:80]
+        return None
+
+
+class CommandProbe(Probe):
+    """Passes if finitd.watcher.health.command exits with status 0."""
+    def __init__(self, watcher, callback):
+        Probe.__init__(self, watcher, callback)
+        self.pid = None
+
+    def start(self):
+        self.pid = os.fork()
+        if not self.pid:
+            try:
+                self.watcher.command.execute(self.watcher.environ, self.config.command())
+            finally:
+                os._exit(127)
+        self.loop.watchChild(self.pid, self.exited)
+
+    def exited(self, pid, status):
+        self.pid = None
+        if status:
+            self.finish('command exited with status %s' % status)
+        else:
+            self.finish(None)
+
+    def cancel(self):
+        Probe.cancel(self)
+        if self.pid is not None:
+            try:
+                os.kill(self.pid, signal.SIGKILL) # It's still reaped by exited.
+            except OSError:
+                pass
+
+
+PROBES = {
+    'connect': SocketProbe,
+    'http': HttpProbe,
+    'command': CommandProbe,
+}
+
+class HealthCheck(object):
+    """Probes the watcher's child process every finitd.watcher.health.interval
+    seconds once it's ready, restarting it after finitd.watcher.health.failures
+    consecutive failures."""
+    def __init__(self, watcher):
+        self.watcher = watcher
+        self.config = watcher.config.watcher.health
+        self.loop = watcher.loop
+        self.failures = 0
+        self.probe = None
+        self.timer = None
+        self.timeoutTimer = None
+        self.killTimer = None
+
+    def start(self):
+        self.stop()
+        self.failures = 0
+        self.timer = self.loop.callLater(self.config.interval(), self.check)
+
+    def stop(self):
+        for timer in (self.timer, self.timeoutTimer, self.killTimer):
+            if timer is not None:
+                timer.cancel()
+        self.timer = self.timeoutTimer = self.killTimer = None
+        if self.probe is not None:
+            self.probe.cancel()
+            self.probe = None
+
+    def check(self):
+        self.timer = None
+        self.probe = PROBES[self.config()](self.watcher, self.checked)
+        self.timeoutTimer = self.loop.callLater(self.config.timeout(), self.timedOut)
+        self.probe.start()
+
+    def timedOut(self):
+        self.timeoutTimer = None
+        self.probe.cancel()
+        self.checked('timed out after %s seconds' % self.config.timeout())
+
+    def checked(self, error):
+        if self.timeoutTimer is not None:
+            self.timeoutTimer.cancel()
+            self.timeoutTimer = None
+        self.probe = None
+        if error is None:
+            if self.failures:
+                self.failures = 0
+                self.watcher.publish()
+        else:
+            self.failures += 1
+            self.watcher.log('health check failed (%s of %s): %s' %
+                             (self.failures, self.config.failures(), error))
+            self.watcher.publish()
+            if self.failures >= self.config.failures():
+                self.watcher.log('process is unhealthy, restarting it')
+                pid = self.watcher.pid
+                self.watcher.restart()
+                # A wedged process might not exit when it's asked to.
+                self.killTimer = self.loop.callLater(
+                    self.watcher.config.options.killWaitTime(), self.kill, pid)
+                return # Checks start again once the new process is ready.
+        self.timer = self.loop.callLater(self.config.interval(), self.check)
+
+    def kill(self, pid):
+        self.killTimer = None
+        if self.watcher.pid == pid:
+            self.watcher.log('process at pid %s did not exit, killing it' % pid)
+            try:
+                os.kill(pid, signal.SIGKILL)
+            except OSError:
+                pass
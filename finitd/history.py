@@ -0,0 +1,127 @@
+###
+# Copyright (c) 2009, Juju, Inc.
+# All rights reserved.
+# 
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are
+# met:
+# 
+#     * Redistributions of source code must retain the above copyright
+#       notice, this list of conditions and the following disclaimer. 
+#     * Redistributions in binary form must reproduce the above
+#       copyright notice, this list of conditions and the following
+#       disclaimer in the documentation and/or other materials provided
+#       with the distribution.
+#     * Neither the name of the author of this software nor the names of
+#       the contributors to the software may be used to endorse or
+#       promote products derived from this software without specific
+#       prior written permission. 
+# 
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS
+# "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT
+# LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR
+# A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT
+# HOLDER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL,
+# SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT
+# LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE,
+# DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY
+# THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+# OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE. 
+###
+
+
+"""A service's recent starts and crashes, kept in finitd.watcher.history so they
+outlive the watcher, and the circuit breaker (finitd.watcher.restart.breaker) which
+stops restarting a service that keeps crashing."""
+
+import os
+import time
+
+from compat import json
+
+MAXENTRIES = 64 # Of each kind; more than any sensible breaker needs.
+
+class History(object):
+    def __init__(self, config, log):
+        self.filename = config.watcher.history()
+        self.config = config.watcher.restart
+        self.log = log
+        self.starts = []    # Times the child process was started.
+        self.crashes = []   # Times it crashed.
+        self.tripped = None # When the breaker last tripped, unless it's been reset.
+        self.load()
+
+    def load(self):
+        if not self.filename:
+            return
+        try:
+            fp = open(self.filename)
+            try:
+                state = json.load(fp)
+            finally:
+                fp.close()
+            self.starts = [float(t) for t in state['starts']][-MAXENTRIES:]
+            self.crashes = [float(t) for t in state['crashes']][-MAXENTRIES:]
+            self.tripped = state['tripped'] and float(state['tripped'])
+        except EnvironmentError:
+            pass # No history yet.
+        except (ValueError, TypeError, KeyError), e:
+            self.log('ignoring unreadable history in %r: %s' % (self.filename, e))
+
+    def save(self):
+        if not self.filename or not self.config.breaker():
+            return # Nothing needs it.
+        tmp = self.filename + '.tmp'
+        try:
+            fp = open(tmp, 'w')
+            try:
+                json.dump({'starts': self.starts, 'crashes': self.crashes,
+                           'tripped': self.tripped}, fp)
+            finally:
+                fp.close()
+            os.rename(tmp, self.filename)
+        except EnvironmentError, e:
+            self.log('could not write history to %r: %s' % (self.filename, e))
+
+    def started(self, now=None):
+        if now is None:
+            now = time.time()
+        self.starts = self.starts[-(MAXENTRIES - 1):] + [now]
+        self.save()
+
+    def exited(self, started, now=None):
+        """Resets the breaker if the process started at the given time was stable."""
+        if now is None:
+            now = time.time()
+        if self.tripped is not None and now - started >= self.config.stable():
+            self.tripped = None
+            self.save()
+
+    def crashed(self, now=None):
+        """Records a crash, returning whether it trips the breaker: whether it's
+        finitd.watcher.restart.breaker crashes in the window, or the breaker had
+        tripped and hasn't been reset since."""
+        if now is None:
+            now = time.time()
+        self.crashes = self.crashes[-(MAXENTRIES - 1):] + [now]
+        breaker = self.config.breaker()
+        trip = breaker and (self.tripped is not None or
+                            self.recentCrashes(now) >= breaker)
+        if trip:
+            self.tripped = now
+        self.save()
+        return bool(trip)
+
+    def recentCrashes(self, now=None):
+        if now is None:
+            now = time.time()
+        window = self.config.breaker.window()
+        return len([t for t in self.crashes if now - t <= window])
+
+    def cooldown(self, now=None):
+        """Returns the number of seconds until the tripped breaker lets the process be
+        tried again."""
+        if now is None:
+            now = time.time()
+        return max(0, self.tripped + self.config.breaker.cooldown() - now)
@@ -0,0 +1,149 @@
+###
+# Copyright (c) 2009, Juju, Inc.
+# All rights reserved.
+# 
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are
+# met:
+# 
+#     * Redistributions of source code must retain the above copyright
+#       notice, this list of conditions and the following disclaimer. 
+#     * Redistributions in binary form must reproduce the above
+#       copyright notice, this list of conditions and the following
+#       disclaimer in the documentation and/or other materials provided
+#       with the distribution.
+#     * Neither the name of the author of this software nor the names of
+#       the contributors to the software may be used to endorse or
+#       promote products derived from this software without specific
+#       prior written permission. 
+# 
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS
+# "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT
+# LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR
+# A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT
+# HOLDER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL,
+# SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT
+# LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE,
+# DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY
+# THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+# OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE. 
+###
+
+"""Thin ctypes wrappers around Linux system calls that Python's os module doesn't
+expose.  Each wrapper returns None (rather than raising) when the system call isn't
+available, so callers can fall back to something portable."""
+
+import os
+import sys
+import errno
+
+try:
+    import ctypes
+    libc = ctypes.CDLL(None, use_errno=True)
+except (ImportError, OSError):
+    libc = None
+
+# Unlike older system calls, these have the same number on every architecture.
+SYS_pidfd_open = 434
+
+def syscall(number, *args):
+    if libc is None or not sys.platform.startswith('linux'):
+        return None
+    ret = libc.syscall(number, *args)
+    if ret == -1:
+        e = ctypes.get_errno()
+        if e == errno.ENOSYS:
+            return None
+        raise OSError(e, os.strerror(e))
+    return ret
+
+def pidfdOpen(pid):
+    """Returns a file descriptor which becomes readable when the given process exits,
+    or None if pidfd_open isn't supported."""
+    return syscall(SYS_pidfd_open, pid, 0)
+
+def call(function, *args):
+    """Calls the given libc function, raising OSError if it fails.  Returns None if
+    it doesn't exist."""
+    if libc is None or not sys.platform.startswith('linux') or \
+       not hasattr(libc, function):
+        return None
+    ret = getattr(libc, function)(*args)
+    if ret == -1:
+        e = ctypes.get_errno()
+        raise OSError(e, os.strerror(e))
+    return ret
+
+def setAffinity(cpus):
+    """Restricts this process to the given CPUs."""
+    size = max(cpus) // 8 + 1
+    mask = (ctypes.c_ubyte * size)()
+    for cpu in cpus:
+        mask[cpu // 8] |= 1 << (cpu % 8)
+    return call('sched_setaffinity', 0, ctypes.c_size_t(size), mask)
+
+PRIO_PROCESS = 0
+
+def setNice(nice):
+    """Sets this process's nice value (rather than adding to it, as os.nice does)."""
+    return call('setpriority', PRIO_PROCESS, 0, nice)
+
+SCHEDULERS = {
+    'other': 0,
+    'fifo': 1,
+    'rr': 2,
+    'batch': 3,
+    'idle': 5,
+}
+
+def setScheduler(policy, priority=0):
+    """Sets this process's scheduling policy (one of SCHEDULERS) and priority."""
+    param = ctypes.c_int(priority) # struct sched_param is just the priority.
+    return call('sched_setscheduler', 0, SCHEDULERS[policy], ctypes.byref(param))
+
+# ioprio_set predates the unified system call table, so its number depends on the
+# architecture.
+SYS_ioprio_set = {
+    'x86_64': 251,
+    'i386': 289,
+    'i686': 289,
+    'aarch64': 30,
+    'armv7l': 314,
+    'ppc64le': 273,
+    's390x': 282,
+}.get(os.uname()[4])
+
+IOPRIO_CLASSES = {
+    'realtime': 1,
+    'best-effort': 2,
+    'idle': 3,
+}
+IOPRIO_WHO_PROCESS = 1
+IOPRIO_CLASS_SHIFT = 13
+
+def setIoPriority(cls, priority=0):
+    """Sets this process's I/O scheduling class (one of IOPRIO_CLASSES) and priority
+    (0, the highest, to 7), returning None if ioprio_set isn't supported."""
+    if SYS_ioprio_set is None:
+        return None
+    return syscall(SYS_ioprio_set, IOPRIO_WHO_PROCESS, 0,
+                   IOPRIO_CLASSES[cls] << IOPRIO_CLASS_SHIFT | priority)
+
+IN_MODIFY = 0x2
+IN_MOVED_FROM = 0x40
+IN_MOVED_TO = 0x80
+IN_CREATE = 0x100
+IN_NONBLOCK = os.O_NONBLOCK
+IN_CLOEXEC = 02000000
+
+def inotifyInit():
+    """Returns a nonblocking, close-on-exec inotify file descriptor, or None if
+    inotify isn't supported."""
+    return call('inotify_init1', IN_NONBLOCK | IN_CLOEXEC)
+
+def inotifyAddWatch(fd, path, mask):
+    return call('inotify_add_watch', fd, path, mask)
+
+def supported():
+    return libc is not None and sys.platform.startswith('linux')
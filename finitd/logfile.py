@@ -0,0 +1,691 @@
+###
+# Copyright (c) 2009, Juju, Inc.
+# All rights reserved.
+# 
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are
+# met:
+# 
+#     * Redistributions of source code must retain the above copyright
+#       notice, this list of conditions and the following disclaimer. 
+#     * Redistributions in binary form must reproduce the above
+#       copyright notice, this list of conditions and the following
+#       disclaimer in the documentation and/or other materials provided
+#       with the distribution.
+#     * Neither the name of the author of this software nor the names of
+#       the contributors to the software may be used to endorse or
+#       promote products derived from this software without specific
+#       prior written permission. 
+# 
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS
+# "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT
+# LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR
+# A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT
+# HOLDER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL,
+# SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT
+# LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE,
+# DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY
+# THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+# OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE. 
+###
+
+
+"""The watcher's side of finitd.log.pipe: the child writes its output into a pipe,
+and the watcher writes it to the configured file, rotating and compressing that
+file as configured without the child's involvement."""
+
+import os
+import re
+import sys
+import stat
+import time
+import errno
+import select
+import struct
+import threading
+from collections import deque
+
+import util
+import linux
+
+# The compression modules are only imported when something is compressed, so they
+# don't take up room in every watcher.
+def gzipFile(*args):
+    import gzip
+    return gzip.GzipFile(*args)
+
+def bz2File(*args):
+    import bz2
+    return bz2.BZ2File(*args)
+
+COMPRESSORS = {
+    'gzip': ('.gz', gzipFile),
+    'bz2': ('.bz2', bz2File),
+}
+
+TIMESTAMP = '%Y%m%dT%H%M%SZ'
+
+INDEX = struct.Struct('=dQ') # An index entry: a time and the file's size then.
+
+BLOCK = 'block'
+DROP_OLDEST = 'drop-oldest'
+DROP_NEWEST = 'drop-newest'
+FULL_POLICIES = [BLOCK, DROP_OLDEST, DROP_NEWEST]
+
+def segments(path):
+    """Returns the rotated segments of the log file at the given path, oldest first.
+    Each segment is named after the (UTC) time it was rotated."""
+    directory = os.path.dirname(path) or '.'
+    pattern = re.compile(r'^%s\.(\d{8}T\d{6}Z)(?:-(\d+))?(%s)?$' %
+                         (re.escape(os.path.basename(path)),
+                          '|'.join([re.escape(ext) for (ext, _) in
+                                    COMPRESSORS.values()])))
+    try:
+        names = os.listdir(directory)
+    except OSError:
+        return []
+    matches = [(m.group(1), int(m.group(2) or 0), name)
+               for (m, name) in [(pattern.match(name), name) for name in names] if m]
+    matches.sort()
+    return [os.path.join(directory, name) for (_, _, name) in matches]
+
+def indexPath(path):
+    """Returns the name of the index of the given log file or segment."""
+    for (ext, _) in COMPRESSORS.values():
+        if path.endswith(ext):
+            path = path[:-len(ext)]
+    return path + '.index'
+
+def segmentTime(segment):
+    """Returns the time (in seconds since the epoch) the given segment was rotated, to
+    the second."""
+    import calendar # Only the logs command needs it, not every watcher.
+    m = re.search(r'\.(\d{8}T\d{6}Z)(?:-\d+)?(?:\.\w+)?$', segment)
+    return calendar.timegm(time.strptime(m.group(1), TIMESTAMP))
+
+def openSegment(path, rotated=True):
+    """Opens the given log file or (if rotated) segment for reading, decompressing it
+    if it's compressed, or returns None if it doesn't exist.  Segments compressed
+    since they were listed are found all the same."""
+    names = [(path, open)]
+    for (ext, File) in COMPRESSORS.values():
+        if not rotated:
+            break
+        elif path.endswith(ext):
+            names = [(path, File)]
+            break
+        names.append((path + ext, File))
+    for (name, File) in names:
+        try:
+            return File(name, 'rb')
+        except IOError, e:
+            if e.errno != errno.ENOENT:
+                raise
+    return None
+
+def compress(filename, compressor):
+    """Compresses the given file, removing it once the compressed file is complete."""
+    (ext, File) = COMPRESSORS[compressor]
+    tmp = filename + ext + '.tmp'
+    src = open(filename, 'rb')
+    try:
+        dst = File(tmp, 'wb')
+        try:
+            while True:
+                data = src.read(1 << 20)
+                if not data:
+                    break
+                dst.write(data)
+        finally:
+            dst.close()
+    finally:
+        src.close()
+    os.rename(tmp, filename + ext)
+    os.remove(filename)
+
+
+class LogFile(object):
+    """A log file, appended to by the watcher, which rotates itself according to
+    finitd.log.rotate."""
+    def __init__(self, path, config, loop, log):
+        self.path = path
+        self.rotation = config.log.rotate
+        self.loop = loop
+        self.log = log
+        self.fd = None
+        self.size = 0
+        self.indexInterval = config.log.index()
+        self.indexFd = None
+        self.lastIndexed = 0
+        self.timer = None
+        self.compressing = {} # {pid: segment}
+        self.lastSegment = (None, 0)
+        self.open()
+        if self.rotation.interval() and self.rotatable():
+            self.scheduleRotation()
+
+    def open(self):
+        self.fd = os.open(self.path, os.O_CREAT | os.O_WRONLY | os.O_APPEND, 0644)
+        util.setCloexec(self.fd)
+        self.size = os.fstat(self.fd).st_size
+        if self.indexInterval and self.rotatable():
+            self.indexFd = os.open(indexPath(self.path),
+                                   os.O_CREAT | os.O_WRONLY | os.O_APPEND, 0644)
+            util.setCloexec(self.indexFd)
+
+    def rotatable(self):
+        # Only regular files are rotated; there's no rotating /dev/null.
+        return stat.S_ISREG(os.fstat(self.fd).st_mode)
+
+    def scheduleRotation(self):
+        interval = self.rotation.interval()
+        # Rotations happen at multiples of the interval, so a 3600 second interval
+        # rotates on the hour.
+        now = time.time()
+        self.timer = self.loop.callLater((now // interval + 1) * interval - now,
+                                         self.rotateOnSchedule)
+
+    def rotateOnSchedule(self):
+        if self.size:
+            self.rotate()
+        self.scheduleRotation()
+
+    def write(self, data):
+        maxSize = self.rotation.size()
+        if maxSize and self.size and self.size + len(data) > maxSize and \
+           self.rotatable():
+            self.rotate()
+        now = time.time()
+        if self.indexFd is not None and now - self.lastIndexed >= self.indexInterval:
+            os.write(self.indexFd, INDEX.pack(now, self.size))
+            self.lastIndexed = now
+        while data:
+            try:
+                written = os.write(self.fd, data)
+            except OSError, e:
+                if e.errno == errno.EINTR:
+                    continue
+                raise
+            self.size += written
+            data = data[written:]
+
+    def rotate(self):
+        segment = '%s.%s' % (self.path, time.strftime(TIMESTAMP, time.gmtime()))
+        # Segments rotated within the same second are numbered, and never reuse the
+        # name of one which has already been pruned, so they still sort in order.
+        if self.lastSegment[0] == segment:
+            i = self.lastSegment[1] + 1
+            unique = '%s-%s' % (segment, i)
+        else:
+            i = 0
+            unique = segment
+        while [name for name in [unique] + [unique + ext for (ext, _) in
+                                            COMPRESSORS.values()]
+               if os.path.exists(name)]:
+            i += 1
+            unique = '%s-%s' % (segment, i)
+        self.lastSegment = (segment, i)
+        os.rename(self.path, unique)
+        os.close(self.fd)
+        if self.indexFd is not None:
+            os.rename(indexPath(self.path), indexPath(unique))
+            os.close(self.indexFd)
+            self.lastIndexed = 0
+        self.open()
+        self.rotated(unique)
+
+    def rotated(self, segment):
+        compressor = self.rotation.compress()
+        if compressor:
+            self.compress(segment, compressor)
+        self.prune()
+
+    def compress(self, segment, compressor):
+        pid = os.fork()
+        if not pid:
+            try:
+                try:
+                    os.nice(10) # Don't compete with the services we're running.
+                    compress(segment, compressor)
+                except:
+                    sys.stderr.write('Could not compress %r: %s\n' %
+                                     (segment, sys.exc_info()[1]))
+                    os._exit(1)
+            finally:
+                os._exit(0)
+        self.compressing[pid] = segment
+        self.loop.watchChild(pid, self.compressed)
+
+    def compressed(self, pid, status):
+        segment = self.compressing.pop(pid)
+        if status:
+            self.log('could not compress %r (status %s)' % (segment, status))
+        self.prune()
+
+    def prune(self):
+        keep = self.rotation.keep()
+        if not keep:
+            return
+        for segment in segments(self.path)[:-keep]:
+            if segment in self.compressing.values():
+                continue # It'll be pruned once it's been compressed.
+            for filename in (segment, indexPath(segment)):
+                try:
+                    os.remove(filename)
+                except OSError, e:
+                    if e.errno != errno.ENOENT:
+                        self.log('could not remove %r: %s' % (filename, e))
+
+    def full(self):
+        return False
+
+    def close(self):
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+        if self.indexFd is not None:
+            os.close(self.indexFd)
+            self.indexFd = None
+
+class BufferedLogFile(LogFile):
+    """A LogFile written by its own thread from a bounded in-memory buffer, so a
+    stalled disk stalls neither the watcher nor (unless finitd.log.buffer.full is
+    block) the child.  Output dropped because the buffer was full is counted, and the
+    counts are written to the log once it's writable again."""
+    ROTATE = object() # Queued to rotate the file in order with the writes around it.
+    def __init__(self, path, config, loop, log):
+        self.limit = config.log.buffer()
+        self.policy = config.log.buffer.full()
+        self.queue = deque()
+        self.buffered = 0 # Bytes queued or being written.
+        self.cond = threading.Condition()
+        self.closing = False
+        self.onDrain = None
+        self.droppedBytes = 0 # Ever, that is.
+        self.droppedLines = 0
+        self.unreported = (0, 0) # Bytes and lines dropped since the last report.
+        LogFile.__init__(self, path, config, loop, log)
+        self.thread = threading.Thread(target=self.run, name='writer for %s' % path)
+        self.thread.setDaemon(True)
+        self.thread.start()
+
+    def write(self, data):
+        self.cond.acquire()
+        try:
+            if self.buffered + len(data) > self.limit:
+                if self.policy == DROP_NEWEST:
+                    self.drop(data)
+                    return
+                elif self.policy == DROP_OLDEST:
+                    kept = []
+                    while self.queue and self.buffered + len(data) > self.limit:
+                        item = self.queue.popleft()
+                        if item is self.ROTATE:
+                            kept.append(item)
+                        else:
+                            self.buffered -= len(item)
+                            self.drop(item)
+                    self.queue.extendleft(reversed(kept))
+                    if len(data) > self.limit:
+                        self.drop(data[:-self.limit])
+                        data = data[-self.limit:]
+                # Blocking is up to the LogPipe, which stops reading once we're full.
+            self.queue.append(data)
+            self.buffered += len(data)
+            self.cond.notify()
+        finally:
+            self.cond.release()
+
+    def drop(self, data):
+        lines = data.count('\n')
+        self.droppedBytes += len(data)
+        self.droppedLines += lines
+        self.unreported = (self.unreported[0] + len(data),
+                           self.unreported[1] + lines)
+
+    def full(self):
+        return self.buffered >= self.limit
+
+    def whenDrained(self, callback):
+        """Arranges for callback() to be called from the loop once the buffer is no
+        more than half full."""
+        self.cond.acquire()
+        try:
+            if self.full():
+                self.onDrain = callback
+                return
+        finally:
+            self.cond.release()
+        callback()
+
+    def rotateOnSchedule(self):
+        self.cond.acquire()
+        try:
+            self.queue.append(self.ROTATE)
+            self.cond.notify()
+        finally:
+            self.cond.release()
+        self.scheduleRotation()
+
+    def rotated(self, segment):
+        # Compressing and pruning are the loop's business, not the writer thread's.
+        self.loop.callFromThread(LogFile.rotated, self, segment)
+
+    def run(self):
+        while True:
+            self.cond.acquire()
+            try:
+                while not self.queue and not self.closing:
+                    self.cond.wait()
+                if not self.queue:
+                    return
+                items = list(self.queue)
+                self.queue.clear()
+            finally:
+                self.cond.release()
+            written = 0
+            for item in items:
+                try:
+                    if item is self.ROTATE:
+                        if self.size:
+                            self.rotate()
+                    else:
+                        written += len(item)
+                        LogFile.write(self, item)
+                except EnvironmentError, e:
+                    self.loop.callFromThread(self.log, 'could not write to %r: %s' %
+                                             (self.path, e))
+            self.cond.acquire()
+            try:
+                self.buffered -= written
+                (dropped, lines) = self.unreported
+                if dropped and not self.queue:
+                    self.unreported = (0, 0)
+                else:
+                    dropped = 0 # We'll report once we've caught up.
+                if self.onDrain is not None and self.buffered <= self.limit // 2:
+                    self.loop.callFromThread(self.onDrain)
+                    self.onDrain = None
+            finally:
+                self.cond.release()
+            if dropped:
+                try:
+                    LogFile.write(self, 'finitd: dropped %s bytes (%s lines) of output '
+                                        'while the log was unwritable\n' %
+                                        (dropped, lines))
+                except EnvironmentError:
+                    pass
+
+    def close(self):
+        self.cond.acquire()
+        try:
+            self.closing = True
+            self.cond.notify()
+        finally:
+            self.cond.release()
+        # Give the writer a little time to finish, but if the disk is still stalled,
+        # we can't wait for it.
+        self.thread.join(5)
+        if self.thread.isAlive():
+            self.log('gave up writing %s bytes to %r' % (self.buffered, self.path))
+            if self.timer is not None:
+                self.timer.cancel()
+            return
+        LogFile.close(self)
+
+
+class LogPipe(object):
+    """A pipe the child writes into and the watcher reads from, writing what it reads
+    to a LogFile.  The pipe outlives any one child process, so nothing written by a
+    child (or its children) is lost across restarts."""
+    def __init__(self, logfile, loop, log):
+        self.logfile = logfile
+        self.loop = loop
+        self.log = log
+        (self.reader, self.writer) = os.pipe()
+        for fd in (self.reader, self.writer):
+            util.setCloexec(fd)
+        util.setNonblocking(self.reader)
+        self.closed = False
+        self.outputCallbacks = [] # Each is called with this pipe and what it read.
+        self.loop.addReader(self.reader, self.read)
+
+    def read(self, fd=None):
+        """Reads from the pipe and writes what was read, returning whether there was
+        anything to read."""
+        try:
+            data = os.read(self.reader, 65536)
+        except OSError, e:
+            if e.errno in (errno.EINTR, errno.EAGAIN):
+                return False
+            raise
+        if not data:
+            return False
+        try:
+            self.logfile.write(data)
+        except EnvironmentError, e:
+            self.log('could not write to %r: %s' % (self.logfile.path, e))
+        for callback in self.outputCallbacks[:]:
+            callback(self, data)
+        if self.logfile.full():
+            # Stop reading until there's room, so the child waits for the disk.
+            self.loop.removeReader(self.reader)
+            self.logfile.whenDrained(self.resume)
+        return True
+
+    def resume(self):
+        if not self.closed:
+            self.loop.addReader(self.reader, self.read)
+
+    def close(self):
+        self.loop.removeReader(self.reader)
+        while self.read():
+            continue # Write whatever's left.
+        self.closed = True
+        os.close(self.reader)
+        os.close(self.writer)
+        self.logfile.close()
+
+
+def openPipes(config, loop, log):
+    """Returns the LogPipes for the child's stdout and stderr (which are the same
+    LogPipe if they're written to the same file)."""
+    if config.log.buffer():
+        File = BufferedLogFile
+    else:
+        File = LogFile
+    stdout = LogPipe(File(config.child.stdout(), config, loop, log), loop, log)
+    if config.child.stderr() == config.child.stdout():
+        return (stdout, stdout)
+    stderr = LogPipe(File(config.child.stderr(), config, loop, log), loop, log)
+    return (stdout, stderr)
+
+
+class Index(object):
+    """A read-only view of a log file's index: entries of a time and the offset in the
+    file of the output the watcher wrote at that time.  A new entry is written at
+    most every finitd.log.index seconds, so everything between two entries' offsets
+    was written within that many seconds of the first's time."""
+    def __init__(self, path):
+        import mmap
+        self.data = None
+        self.count = 0
+        try:
+            fd = os.open(path, os.O_RDONLY)
+        except OSError, e:
+            if e.errno != errno.ENOENT:
+                raise
+            return
+        try:
+            self.count = os.fstat(fd).st_size // INDEX.size
+            if self.count:
+                self.data = mmap.mmap(fd, self.count * INDEX.size,
+                                      access=mmap.ACCESS_READ)
+        finally:
+            os.close(fd)
+
+    def __len__(self):
+        return self.count
+
+    def entry(self, i):
+        return INDEX.unpack_from(self.data, i * INDEX.size)
+
+    def bisect(self, when):
+        """Returns the number of entries at or before the given time."""
+        (lo, hi) = (0, self.count)
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self.entry(mid)[0] <= when:
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo
+
+    def offsetAt(self, when, interval=0):
+        """Returns an offset before which everything was written before the given
+        time, or None if everything was.  If the index was written with the given
+        interval, output written more than interval seconds before the time is
+        skipped, too."""
+        i = self.bisect(when)
+        if not i:
+            return 0
+        (entryTime, offset) = self.entry(i - 1)
+        if interval and when >= entryTime + interval:
+            if i == self.count:
+                return None
+            return self.entry(i)[1]
+        return offset
+
+    def offsetAfter(self, when):
+        """Returns an offset after which everything was written after the given time,
+        or None if there's no such offset."""
+        i = self.bisect(when)
+        if i == self.count:
+            return None
+        return self.entry(i)[1]
+
+    def close(self):
+        if self.data is not None:
+            self.data.close()
+            self.data = None
+
+
+def copy(fp, out, start=0, end=None):
+    """Copies the lines of fp which begin at or after the start offset and before
+    the end offset (None meaning the end of the file) to out."""
+    if start:
+        fp.seek(start - 1)
+        if fp.read(1) != '\n':
+            fp.readline() # Skip the rest of a line which began before start.
+    pos = fp.tell()
+    data = ''
+    while end is None or pos < end:
+        if end is None:
+            size = 1 << 16
+        else:
+            size = min(1 << 16, end - pos)
+        data = fp.read(size)
+        if not data:
+            return
+        out.write(data)
+        pos += len(data)
+    if data and not data.endswith('\n'):
+        out.write(fp.readline())
+
+def read(path, out, since=None, until=None, interval=0, unindexed=None):
+    """Writes the output logged to the given file, oldest first, to out: from its
+    rotated segments, then the file itself.  If since or until are given, only
+    output written (as near as the files' indexes, written every interval seconds,
+    can tell) after or before those times is written.  Files without an index can
+    only be skipped whole (by the times rotated segments are named after); they're
+    written whole otherwise, and unindexed(filename) is called for each, if it's
+    given.  Returns the file object of the file itself, positioned after what was
+    written, or None if the file doesn't exist."""
+    previous = None # When the last segment we looked at was rotated.
+    fp = None
+    for segment in segments(path) + [path]:
+        if segment != path:
+            rotated = segmentTime(segment)
+        else:
+            rotated = None
+        if until is not None and previous is not None and previous > until:
+            break # Everything in this segment was written after until.
+        previous = rotated
+        if since is not None and rotated is not None and rotated + 1 <= since:
+            continue # Everything in this segment was written before since.
+        fp = openSegment(segment, segment != path)
+        if fp is None:
+            continue # It's been pruned.
+        index = Index(indexPath(segment))
+        if (since is not None or until is not None) and not len(index) and \
+           unindexed is not None:
+            unindexed(segment)
+        try:
+            start = 0
+            end = None
+            if since is not None:
+                start = index.offsetAt(since, interval)
+            if until is not None:
+                end = index.offsetAfter(until)
+            if start is None:
+                if segment == path:
+                    fp.seek(0, os.SEEK_END)
+            else:
+                copy(fp, out, start, end)
+        finally:
+            index.close()
+        if segment != path:
+            fp.close()
+            fp = None
+    return fp
+
+def follow(path, out, fp=None, interval=0.5):
+    """Writes the output logged to the given file to out as it's written, starting
+    from fp's position (or the file's beginning, if fp is None), following the file
+    across rotations.  It's woken by inotify if that's available, and otherwise checks
+    for more every interval seconds.  Never returns."""
+    directory = os.path.dirname(os.path.abspath(path))
+    inotify = linux.inotifyInit()
+    try:
+        if inotify is not None:
+            linux.inotifyAddWatch(inotify, directory, linux.IN_CREATE |
+                                  linux.IN_MOVED_FROM | linux.IN_MOVED_TO)
+        while True:
+            if fp is None:
+                fp = openSegment(path, rotated=False)
+                if fp is not None and inotify is not None:
+                    linux.inotifyAddWatch(inotify, path, linux.IN_MODIFY)
+            if fp is not None:
+                copy(fp, out)
+                out.flush()
+                try:
+                    rotated = os.stat(path).st_ino != os.fstat(fp.fileno()).st_ino
+                except OSError, e:
+                    if e.errno != errno.ENOENT:
+                        raise
+                    rotated = True
+                if rotated:
+                    copy(fp, out) # Whatever was written before it was rotated.
+                    out.flush()
+                    fp.close()
+                    fp = None
+                    continue
+            if inotify is not None:
+                select.select([inotify], [], [])
+                try:
+                    while os.read(inotify, 1 << 16):
+                        continue
+                except OSError, e:
+                    if e.errno != errno.EAGAIN:
+                        raise
+            else:
+                time.sleep(interval)
+    finally:
+        if fp is not None:
+            fp.close()
+        if inotify is not None:
+            os.close(inotify)
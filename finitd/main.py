@@ -35,9 +35,26 @@ import sys
 import syslog
 import optparse
 import textwrap
+import traceback
+
+import finitd
+# Commands import what they need lazily, often after changing directory, so the
+# package can't be left where a relative sys.path entry (like the '' python -m adds)
+# found it.
+finitd.__path__[:] = [os.path.abspath(path) for path in finitd.__path__]
 
 from finitd.conf import config
-from finitd import util, commands
+from finitd import conf, util, commands
+
+class OptionParser(optparse.OptionParser):
+    """An OptionParser whose usage is made (by calling makeUsage, if it's set) only
+    when it's needed, since describing every command isn't cheap."""
+    makeUsage = None
+    def get_usage(self):
+        if self.makeUsage is not None:
+            self.set_usage(self.makeUsage())
+            self.makeUsage = None
+        return optparse.OptionParser.get_usage(self)
 
 def makeEnvironment(config):
     # Do we start with a clear environment or our existing one?
@@ -69,7 +86,10 @@ def makeEnvironment(config):
 
 def makeHelp(commands,
              configFilename=None,
-             usage='%prog <configfile> [options] <command>'):
+             usage='%prog <configfile> [options] <command>\n'
+                   '       %prog --all [--jobs N] <configfile>... <command>\n'
+                   '       %prog --supervise <directory>\n'
+                   '       %prog --status-all [<table>]'):
     if commands:
         usage = usage.replace('<command>', '{%s}' %
                               '|'.join(command.name for command in commands))
@@ -90,25 +110,91 @@ def makeHelp(commands,
         ])
     return '%s\n\n%s' % (usage, '\n'.join(parts))
 
+def makeCommands(config):
+    cmds = [getattr(commands, name)(config) for name in commands.commands]
+    for child in config.commands.arbitrary.children():
+        cmds.append(commands.ArbitraryCommand(config, child._name))
+    return cmds
+
+def openlog(configFilename):
+    if configFilename.startswith('/'):
+        absoluteConfigFilename = configFilename
+    else:
+        absoluteConfigFilename = os.path.join(os.getcwd(), configFilename)
+    util.openlog('%s %s' % (os.path.basename(sys.argv[0]), absoluteConfigFilename))
+
+def runCommand(config, command, args):
+    try:
+        command.checkConfig(config)
+    except commands.InvalidConfiguration, e:
+        util.error('Invalid configuration: %s' % e)
+
+    if command.environment:
+        environ = makeEnvironment(config)
+    else:
+        environ = None
+    command.run(args, environ)
+
+def runNamedCommand(config, commandName, args):
+    cmds = [cmd for cmd in makeCommands(config) if cmd.name == commandName]
+    if not cmds:
+        util.error('Invalid command: %r' % commandName)
+    runCommand(config, cmds[0], list(args))
+
+def exitStatus(function, *args):
+    """Calls function(*args) (typically, something which runs a command), returning
+    the exit status the finitd process would have exited with rather than exiting."""
+    try:
+        try:
+            function(*args)
+        except SystemExit, e:
+            if e.code is None:
+                return 0
+            elif isinstance(e.code, int):
+                return e.code & 0xff
+            else:
+                sys.stderr.write('%s\n' % e.code)
+                return 1
+        except:
+            traceback.print_exc()
+            return 1
+        else:
+            return 0
+    finally:
+        sys.stdout.flush()
+        sys.stderr.flush()
+
 def main():
-    parser = optparse.OptionParser(usage=makeHelp([]))
+    parser = OptionParser(usage='%prog <configfile> [options] <command>')
+    parser.makeUsage = lambda: makeHelp([])
     config.toOptionParser(parser=parser)
     parser.disable_interspersed_args() # For future support of commands with args.
-    if len(sys.argv) >= 2 and not sys.argv[1].startswith('-'):
+    if len(sys.argv) >= 2 and sys.argv[1] == '--supervise':
+        if len(sys.argv) != 3:
+            parser.error('--supervise requires exactly one directory.')
+        directory = os.path.abspath(sys.argv[2])
+        syslog.openlog('%s --supervise %s' % (os.path.basename(sys.argv[0]), directory))
+        from finitd.supervisor import supervise
+        supervise(directory)
+    elif len(sys.argv) >= 2 and sys.argv[1] == '--all':
+        from finitd import bulk
+        sys.exit(bulk.main(sys.argv[2:]))
+    elif len(sys.argv) >= 2 and sys.argv[1] == '--status-all':
+        from finitd import table
+        sys.exit(table.main(sys.argv[2:]))
+    elif len(sys.argv) >= 2 and not sys.argv[1].startswith('-'):
         configFilename = sys.argv.pop(1)
         try:
             fp = open(configFilename)
         except EnvironmentError, e:
             util.error('Could not open configuration file %r: %s' % (configFilename, e))
         
-        config.read(configFilename)
+        conf.readConfig(config, configFilename)
         config.readenv()
         #config.writefp(sys.stdout)
 
-        cmds = [getattr(commands, name)(config) for name in commands.commands]
-        for child in config.commands.arbitrary.children():
-            cmds.append(commands.ArbitraryCommand(config, name))
-        parser.set_usage(makeHelp(cmds, configFilename))
+        cmds = makeCommands(config)
+        parser.makeUsage = lambda: makeHelp(cmds, configFilename)
     else:
         parser.error('A configuration file must be provided.')
 
@@ -118,25 +204,14 @@ def main():
     except (ValueError, IndexError): # Unpack list of wrong size
         parser.error('A command must be provided.')
 
-    if configFilename.startswith('/'):
-        absoluteConfigFilename = configFilename
-    else:
-        absoluteConfigFilename = os.path.join(os.getcwd(), configFilename)
-    syslog.openlog('%s %s' % (os.path.basename(sys.argv[0]), absoluteConfigFilename))
-
+    openlog(configFilename)
 
     try:
         (command,) = [cmd for cmd in cmds if cmd.name == commandName]
     except ValueError: # unpack list of wrong size
         parser.error('Invalid command: %r' % commandName)
 
-    try:
-        command.checkConfig(config)
-    except commands.InvalidConfiguration, e:
-        util.error('Invalid configuration: %s' % e)
-
-    environ = makeEnvironment(config)
-    command.run(args, environ)
+    runCommand(config, command, args)
 
 if __name__ == '__main__':
     main()
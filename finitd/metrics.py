@@ -0,0 +1,147 @@
+###
+# Copyright (c) 2009, Juju, Inc.
+# All rights reserved.
+# 
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are
+# met:
+# 
+#     * Redistributions of source code must retain the above copyright
+#       notice, this list of conditions and the following disclaimer. 
+#     * Redistributions in binary form must reproduce the above
+#       copyright notice, this list of conditions and the following
+#       disclaimer in the documentation and/or other materials provided
+#       with the distribution.
+#     * Neither the name of the author of this software nor the names of
+#       the contributors to the software may be used to endorse or
+#       promote products derived from this software without specific
+#       prior written permission. 
+# 
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS
+# "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT
+# LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR
+# A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT
+# HOLDER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL,
+# SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT
+# LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE,
+# DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY
+# THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+# OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE. 
+###
+
+
+"""Samples a child process's resource usage from /proc and formats it, along with
+the watcher's own view of the child, in the Prometheus text exposition format."""
+
+import os
+
+import util
+
+CLOCK_TICKS = os.sysconf('SC_CLK_TCK')
+PAGE_SIZE = os.sysconf('SC_PAGE_SIZE')
+
+# (name, type, help) for each metric, in the order they're written.
+METRICS = [
+    ('finitd_up', 'gauge', 'Whether the child process is running.'),
+    ('finitd_restarts_total', 'counter', 'Times the child process has been restarted.'),
+    ('finitd_uptime_seconds', 'gauge', 'Seconds since the child process was started.'),
+    ('finitd_cpu_seconds_total', 'counter', 'CPU time used by the child process.'),
+    ('finitd_resident_memory_bytes', 'gauge', 'Resident set size of the child process.'),
+    ('finitd_open_fds', 'gauge', 'File descriptors open in the child process.'),
+    ('finitd_threads', 'gauge', 'Threads in the child process.'),
+    ('finitd_io_read_bytes_total', 'counter',
+     'Bytes the child process read from storage.'),
+    ('finitd_io_write_bytes_total', 'counter',
+     'Bytes the child process wrote to storage.'),
+    ('finitd_log_dropped_bytes_total', 'counter',
+     'Bytes of output dropped because the log buffer was full.'),
+]
+
+def sample(pid):
+    """Returns a dictionary of the given process's resource usage, which is empty if
+    the process doesn't exist.  Only what can be read is included: /proc/<pid>/io,
+    for instance, is only readable by the process's owner."""
+    stat = util.readStat(pid)
+    if not stat:
+        return {}
+    # Fields 14, 15, 20 and 24 of /proc/<pid>/stat.
+    usage = {
+        'cpu_user': float(stat[11]) / CLOCK_TICKS,
+        'cpu_system': float(stat[12]) / CLOCK_TICKS,
+        'threads': int(stat[17]),
+        'rss': int(stat[21]) * PAGE_SIZE,
+    }
+    try:
+        usage['fds'] = len(os.listdir('/proc/%s/fd' % pid))
+    except OSError:
+        pass
+    try:
+        fp = open('/proc/%s/io' % pid)
+        try:
+            for line in fp:
+                (key, _, value) = line.partition(':')
+                if key in ('read_bytes', 'write_bytes'):
+                    usage[key] = int(value)
+        finally:
+            fp.close()
+    except EnvironmentError:
+        pass
+    return usage
+
+def serviceName(watcher):
+    if watcher.name:
+        return watcher.name
+    pidfile = watcher.config.options.pidfile()
+    if not pidfile:
+        return 'watcher-%s' % watcher.watcherPid
+    return os.path.splitext(os.path.basename(pidfile))[0]
+
+def collect(watcher):
+    """Returns {metric name: [(labels, value)]} for the given watcher's child."""
+    state = watcher.state()
+    metrics = {
+        'finitd_up': [('', state['pid'] and 1 or 0)],
+        'finitd_restarts_total': [('', state['restarts'])],
+    }
+    if state['pid']:
+        metrics['finitd_uptime_seconds'] = [('', state['uptime'])]
+        usage = sample(state['pid'])
+        if usage:
+            metrics['finitd_cpu_seconds_total'] = [
+                (',mode="user"', usage['cpu_user']),
+                (',mode="system"', usage['cpu_system']),
+            ]
+            metrics['finitd_resident_memory_bytes'] = [('', usage['rss'])]
+            metrics['finitd_threads'] = [('', usage['threads'])]
+        for (key, name) in [('fds', 'finitd_open_fds'),
+                            ('read_bytes', 'finitd_io_read_bytes_total'),
+                            ('write_bytes', 'finitd_io_write_bytes_total')]:
+            if key in usage:
+                metrics[name] = [('', usage[key])]
+    for pipe in set(watcher.logPipes or []):
+        dropped = getattr(pipe.logfile, 'droppedBytes', None)
+        if dropped is not None:
+            metrics.setdefault('finitd_log_dropped_bytes_total', []).append(
+                (',file="%s"' % escape(pipe.logfile.path), dropped))
+    return metrics
+
+def escape(s):
+    return s.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+def render(watcher):
+    """Returns the given watcher's metrics in the Prometheus text format."""
+    service = 'service="%s"' % escape(serviceName(watcher))
+    metrics = collect(watcher)
+    lines = []
+    for (name, kind, description) in METRICS:
+        if name not in metrics:
+            continue
+        lines.append('# HELP %s %s' % (name, description))
+        lines.append('# TYPE %s %s' % (name, kind))
+        for (labels, value) in metrics[name]:
+            lines.append('%s{%s%s} %s' % (name, service, labels, value))
+    return '\n'.join(lines) + '\n'
+
+def write(watcher, filename):
+    util.writeFile(filename, render(watcher))
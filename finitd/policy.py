@@ -0,0 +1,107 @@
+###
+# Copyright (c) 2009, Juju, Inc.
+# All rights reserved.
+# 
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are
+# met:
+# 
+#     * Redistributions of source code must retain the above copyright
+#       notice, this list of conditions and the following disclaimer. 
+#     * Redistributions in binary form must reproduce the above
+#       copyright notice, this list of conditions and the following
+#       disclaimer in the documentation and/or other materials provided
+#       with the distribution.
+#     * Neither the name of the author of this software nor the names of
+#       the contributors to the software may be used to endorse or
+#       promote products derived from this software without specific
+#       prior written permission. 
+# 
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS
+# "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT
+# LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR
+# A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT
+# HOLDER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL,
+# SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT
+# LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE,
+# DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY
+# THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+# OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE. 
+###
+
+
+"""Decides whether, and how soon, a watcher restarts its child after it exits."""
+
+import os
+import time
+import random
+
+from util import parseSignal
+
+def describeStatus(status):
+    if os.WIFSIGNALED(status):
+        return 'killed by signal %s' % os.WTERMSIG(status)
+    return 'exited with status %s' % os.WEXITSTATUS(status)
+
+def matchesStatus(rules, status):
+    """Returns whether the given wait status matches any of the given rules, each of
+    which is either an exit status or a signal name."""
+    for rule in rules:
+        if rule.isdigit():
+            if os.WIFEXITED(status) and os.WEXITSTATUS(status) == int(rule):
+                return True
+        elif os.WIFSIGNALED(status) and os.WTERMSIG(status) == parseSignal(rule):
+            return True
+    return False
+
+
+class RestartPolicy(object):
+    """Implements finitd.watcher.restart: consecutive failures are restarted after
+    exponentially increasing, jittered delays, until the child stays up long enough
+    to be considered stable again or the configured number of retries runs out."""
+    def __init__(self, config, random=random.random):
+        self.config = config.watcher.restart
+        self.random = random
+        self.failures = 0 # Consecutive failures since the child was last stable.
+        self.reason = None
+
+    def shouldRestart(self, status):
+        ignore = self.config.ignore()
+        if ignore and matchesStatus(ignore, status):
+            self.reason = 'process %s, which finitd.watcher.restart.ignore matches' % \
+                          describeStatus(status)
+            return False
+        on = self.config.on()
+        if on:
+            restart = matchesStatus(on, status)
+        else:
+            restart = status != 0
+        if not restart:
+            self.reason = 'process %s' % describeStatus(status)
+        return restart
+
+    def restartDelay(self, status, started, now=None):
+        """Returns the number of seconds to wait before restarting a child which was
+        started at the given time and has exited with the given status, or None if it
+        shouldn't be restarted, in which case self.reason says why."""
+        if now is None:
+            now = time.time()
+        if not self.shouldRestart(status):
+            return None
+        if now - started >= self.config.stable():
+            self.failures = 0
+        self.failures += 1
+        retries = self.config.retries()
+        if retries and self.failures > retries:
+            self.reason = 'process %s and has been restarted %s times in a row' % \
+                          (describeStatus(status), retries)
+            return None
+        backoff = self.config.backoff
+        # (The exponent is bounded only so the float can't overflow.)
+        delay = backoff() * backoff.factor() ** min(self.failures - 1, 64)
+        delay = min(delay, backoff.max())
+        # Randomize the delay, so services which fail together (say, because something
+        # they all depend on went away) don't all come back at the same moment.
+        delay *= 1 - backoff.jitter() * self.random()
+        return max(delay, started + self.config.wait() - now)
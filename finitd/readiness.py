@@ -0,0 +1,201 @@
+###
+# Copyright (c) 2009, Juju, Inc.
+# All rights reserved.
+# 
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are
+# met:
+# 
+#     * Redistributions of source code must retain the above copyright
+#       notice, this list of conditions and the following disclaimer. 
+#     * Redistributions in binary form must reproduce the above
+#       copyright notice, this list of conditions and the following
+#       disclaimer in the documentation and/or other materials provided
+#       with the distribution.
+#     * Neither the name of the author of this software nor the names of
+#       the contributors to the software may be used to endorse or
+#       promote products derived from this software without specific
+#       prior written permission. 
+# 
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS
+# "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT
+# LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR
+# A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT
+# HOLDER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL,
+# SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT
+# LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE,
+# DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY
+# THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+# OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE. 
+###
+
+
+"""Ways the watcher can tell that a child process is ready, rather than merely
+running: the child says so over an sd_notify-compatible NOTIFY_SOCKET, a port starts
+accepting connections, or the child writes a matching line of output."""
+
+import os
+import re
+import errno
+import socket
+import itertools
+
+import util
+import sockets
+
+class Check(object):
+    """Watches one child process for readiness, calling the callback given to start
+    once it's ready.  A Check is created before the child is forked, so it can
+    prepare the child's environment."""
+    def __init__(self, config, loop, pipes):
+        self.config = config
+        self.loop = loop
+        self.callback = None
+
+    def prepare(self, environ):
+        """Called in the child process, before the command is executed."""
+        pass
+
+    def start(self, callback):
+        self.callback = callback
+
+    def close(self):
+        pass
+
+
+class NotifyCheck(Check):
+    """Waits for the child to send READY=1 to the datagram socket named by
+    NOTIFY_SOCKET, as sd_notify(3) does.  Each child gets its own socket (in the
+    abstract namespace, so it's reachable from a chroot), so a reload's new process
+    can't be mistaken for the old one."""
+    counter = itertools.count()
+    def __init__(self, config, loop, pipes):
+        Check.__init__(self, config, loop, pipes)
+        self.address = '\0finitd/%s/%s' % (os.getpid(), self.counter.next())
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        util.setCloexec(self.sock.fileno())
+        self.sock.setblocking(0)
+        self.sock.bind(self.address)
+
+    def prepare(self, environ):
+        environ['NOTIFY_SOCKET'] = '@' + self.address[1:]
+
+    def start(self, callback):
+        Check.start(self, callback)
+        self.loop.addReader(self.sock.fileno(), self.read)
+
+    def read(self, fd):
+        try:
+            data = self.sock.recv(4096)
+        except socket.error, e:
+            if e.args[0] in (errno.EAGAIN, errno.EINTR):
+                return
+            raise
+        if 'READY=1' in data.split('\n'):
+            self.callback()
+
+    def close(self):
+        if self.sock is not None:
+            self.loop.removeReader(self.sock.fileno())
+            self.sock.close()
+            self.sock = None
+
+
+class PortCheck(Check):
+    """Waits for finitd.watcher.ready.port to accept a connection, trying again
+    (at most a second later) whenever it doesn't."""
+    def __init__(self, config, loop, pipes):
+        Check.__init__(self, config, loop, pipes)
+        (self.family, self.address) = sockets.parseAddress(config.watcher.ready.port())
+        self.sock = None
+        self.timer = None
+        self.delay = 0.05
+
+    def start(self, callback):
+        Check.start(self, callback)
+        self.attempt()
+
+    def attempt(self):
+        self.timer = None
+        sock = socket.socket(self.family, socket.SOCK_STREAM)
+        util.setCloexec(sock.fileno())
+        sock.setblocking(0)
+        err = sock.connect_ex(self.address)
+        if err == 0:
+            sock.close()
+            self.callback()
+        elif err == errno.EINPROGRESS:
+            self.sock = sock
+            self.loop.addWriter(sock.fileno(), self.connected)
+        else:
+            sock.close()
+            self.retry()
+
+    def connected(self, fd):
+        self.loop.removeWriter(fd)
+        err = self.sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+        self.sock.close()
+        self.sock = None
+        if err:
+            self.retry()
+        else:
+            self.callback()
+
+    def retry(self):
+        self.timer = self.loop.callLater(self.delay, self.attempt)
+        self.delay = min(self.delay * 2, 1)
+
+    def close(self):
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
+        if self.sock is not None:
+            self.loop.removeWriter(self.sock.fileno())
+            self.sock.close()
+            self.sock = None
+
+
+class OutputCheck(Check):
+    """Waits for a line of the child's output (read from the watcher's log pipes)
+    to match finitd.watcher.ready.output."""
+    MAX_LINE = 65536 # Longer lines are only matched by their ends.
+    def __init__(self, config, loop, pipes):
+        Check.__init__(self, config, loop, pipes)
+        self.regex = re.compile(config.watcher.ready.output())
+        self.pipes = set(pipes)
+        self.partial = {} # {pipe: the unterminated end of what it's read}
+
+    def start(self, callback):
+        Check.start(self, callback)
+        for pipe in self.pipes:
+            pipe.outputCallbacks.append(self.output)
+
+    def output(self, pipe, data):
+        lines = (self.partial.get(pipe, '') + data).split('\n')
+        self.partial[pipe] = lines.pop()[-self.MAX_LINE:]
+        for line in lines:
+            if self.regex.search(line):
+                self.callback()
+                return
+
+    def close(self):
+        for pipe in self.pipes:
+            if self.output in pipe.outputCallbacks:
+                pipe.outputCallbacks.remove(self.output)
+        self.pipes = set()
+
+
+STRATEGIES = {
+    'notify': NotifyCheck,
+    'port': PortCheck,
+    'output': OutputCheck,
+}
+
+def check(config, loop, pipes):
+    """Returns a new Check for the given configuration's finitd.watcher.ready, or None
+    if it isn't set, in which case a child is ready once it's executed."""
+    strategy = config.watcher.ready()
+    if not strategy:
+        return None
+    return STRATEGIES[strategy](config, loop, pipes)
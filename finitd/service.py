@@ -0,0 +1,334 @@
+###
+# Copyright (c) 2009, Juju, Inc.
+# All rights reserved.
+# 
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are
+# met:
+# 
+#     * Redistributions of source code must retain the above copyright
+#       notice, this list of conditions and the following disclaimer. 
+#     * Redistributions in binary form must reproduce the above
+#       copyright notice, this list of conditions and the following
+#       disclaimer in the documentation and/or other materials provided
+#       with the distribution.
+#     * Neither the name of the author of this software nor the names of
+#       the contributors to the software may be used to endorse or
+#       promote products derived from this software without specific
+#       prior written permission. 
+# 
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS
+# "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT
+# LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR
+# A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT
+# HOLDER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL,
+# SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT
+# LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE,
+# DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY
+# THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+# OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE. 
+###
+
+
+"""A Python interface to finitd, for programs (deployment tools, orchestrators) which
+manage services without running the finitd command and parsing what it prints:
+
+    from finitd.service import Service
+    service = Service.fromFile('/etc/finitd/web.conf')
+    result = service.start()
+    if not result.ok:
+        print result.output
+    print service.status().pid
+
+Every operation returns a Result.  Each also has an asynchronous variant
+(startAsync, statusAsync, ...) which runs on a finitd EventLoop and calls its
+callback with the Result, so one process can drive many services at once:
+
+    loop = EventLoop()
+    for filename in filenames:
+        Service.fromFile(filename, loop).startAsync(started)
+    loop.run()
+
+Operations which change a service (start, stop, restart and reload) run the finitd
+command of the same name in a forked process, just as the finitd command would, but
+without starting another interpreter.  status and waitReady ask the watcher
+directly."""
+
+import os
+import sys
+import time
+import errno
+import signal
+import socket
+
+import conf
+import util
+import control
+from main import runNamedCommand, exitStatus
+
+def waitArgument(option, timeout):
+    if timeout is None:
+        return option
+    return '%s=%s' % (option, timeout)
+
+def exitCode(status):
+    if os.WIFEXITED(status):
+        return os.WEXITSTATUS(status)
+    else:
+        return 128 + os.WTERMSIG(status)
+
+class Result(object):
+    """The outcome of an operation on a service.  status is the exit status the finitd
+    command would have had (for status, 0 if the process is running and 1 if not),
+    output is what it printed, and state is the watcher's state afterwards (see
+    Watcher.state) or, if there's no watcher to ask, just the pid from the pidfile."""
+    def __init__(self, status, output, state):
+        self.status = status
+        self.output = output
+        self.state = state
+
+    @property
+    def ok(self):
+        return self.status == 0
+
+    @property
+    def pid(self):
+        return self.state.get('pid')
+
+    @property
+    def running(self):
+        return bool(self.pid)
+
+    @property
+    def ready(self):
+        """Whether the process is ready or, if there's no watcher to ask, running."""
+        return self.state.get('ready', self.running)
+
+    def __repr__(self):
+        return '<Result status=%s pid=%s>' % (self.status, self.pid)
+
+
+class Service(object):
+    """A service configured by the given configuration (e.g., finitd.conf.config).
+    The asynchronous operations run on the given EventLoop."""
+    def __init__(self, config, loop=None, filename=None):
+        self.config = config
+        self.loop = loop
+        self.filename = filename
+
+    @classmethod
+    def fromFile(cls, filename, loop=None):
+        """Returns the Service configured by the given file, and the environment's
+        FINITD_* variables, as `finitd <filename>` would be."""
+        config = conf.makeConfig()
+        conf.readConfig(config, filename)
+        config.readenv()
+        return cls(config, loop, filename)
+
+    def start(self, timeout=None, ready=True):
+        """Starts the process.  If finitd.watcher.wait is set, waits (at most timeout
+        seconds, by default finitd.options.startWaitTime) until it's ready unless
+        ready is False."""
+        return self.perform('start', self.startArgs(timeout, ready))
+
+    def startAsync(self, callback, timeout=None, ready=True):
+        self.performAsync('start', self.startArgs(timeout, ready), callback)
+
+    def stop(self, timeout=None):
+        """Stops the process, waiting (at most timeout seconds, by default
+        finitd.options.stopWaitTime) for it to exit."""
+        return self.perform('stop', [waitArgument('--wait', timeout)])
+
+    def stopAsync(self, callback, timeout=None):
+        self.performAsync('stop', [waitArgument('--wait', timeout)], callback)
+
+    def restart(self, timeout=None, ready=True):
+        """Stops the process and starts it again, as start does."""
+        return self.perform('restart', self.startArgs(timeout, ready))
+
+    def restartAsync(self, callback, timeout=None, ready=True):
+        self.performAsync('restart', self.startArgs(timeout, ready), callback)
+
+    def reload(self):
+        """Replaces the process with a new one, without a gap in service."""
+        return self.perform('reload', [])
+
+    def reloadAsync(self, callback):
+        self.performAsync('reload', [], callback)
+
+    def status(self):
+        return self.statusResult(self.state())
+
+    def statusAsync(self, callback):
+        self.stateAsync(lambda state: callback(self.statusResult(state)))
+
+    def waitReady(self, timeout=None):
+        """Waits at most timeout seconds (by default, finitd.options.startWaitTime)
+        for the process to be ready."""
+        (deadline, delay) = (self.deadline(timeout), 0.01)
+        while True:
+            result = self.status()
+            if result.ready or time.time() >= deadline:
+                return self.readyResult(result, timeout)
+            time.sleep(delay)
+            delay = min(delay * 2, 0.25)
+
+    def waitReadyAsync(self, callback, timeout=None):
+        deadline = self.deadline(timeout)
+        def check(delay):
+            def answered(result):
+                if result.ready or time.time() >= deadline:
+                    callback(self.readyResult(result, timeout))
+                else:
+                    self.loop.callLater(delay, check, min(delay * 2, 0.25))
+            self.statusAsync(answered)
+        check(0.01)
+
+    def deadline(self, timeout):
+        if timeout is None:
+            timeout = self.config.options.startWaitTime()
+        return time.time() + timeout
+
+    def readyResult(self, result, timeout):
+        if result.ready:
+            return Result(0, '', result.state)
+        if timeout is None:
+            timeout = self.config.options.startWaitTime()
+        return Result(1, 'Process was not ready after %s seconds.\n' % timeout,
+                      result.state)
+
+    def statusResult(self, state):
+        if state['pid']:
+            return Result(0, '', state)
+        else:
+            return Result(1, '', state)
+
+    def startArgs(self, timeout, ready):
+        if ready and self.config.watcher.wait():
+            return [waitArgument('--wait-ready', timeout)]
+        return []
+
+    def path(self, filename):
+        if filename:
+            return conf.resolvePath(self.config, filename)
+        return None
+
+    def state(self):
+        """Returns the watcher's state or, if there's no watcher to ask, the pid from
+        the pidfile."""
+        path = self.path(self.config.watcher.socket())
+        reply = None
+        if path and os.path.exists(path):
+            try:
+                reply = control.request(path, 'status')
+            except socket.error:
+                pass
+        return self.stateFromReply(reply)
+
+    def stateAsync(self, callback):
+        path = self.path(self.config.watcher.socket())
+        if path and os.path.exists(path):
+            control.Request(self.loop, path, 'status',
+                            lambda reply: callback(self.stateFromReply(reply)))
+        else:
+            self.loop.callLater(0, lambda: callback(self.stateFromReply(None)))
+
+    def stateFromReply(self, reply):
+        if reply is not None and not reply.get('error'):
+            return reply
+        pid = None
+        pidfile = self.path(self.config.options.pidfile())
+        if pidfile:
+            (pid, identity) = util.readPidfile(pidfile)
+            if pid and not util.checkProcessAlive(pid, identity):
+                pid = None
+        return {'pid': pid}
+
+    def perform(self, commandName, args):
+        (status, output) = self.run(commandName, args)
+        return Result(status, output, self.state())
+
+    def performAsync(self, commandName, args, callback):
+        def ran(status, output):
+            self.stateAsync(lambda state: callback(Result(status, output, state)))
+        self.runAsync(commandName, args, ran)
+
+    def fork(self, commandName, args):
+        """Forks a process which runs the given command, returning its pid and a file
+        descriptor from which its output can be read."""
+        (r, w) = os.pipe()
+        sys.stdout.flush()
+        sys.stderr.flush()
+        pid = os.fork()
+        if not pid:
+            status = 1
+            try:
+                signal.signal(signal.SIGCHLD, signal.SIG_DFL)
+                os.close(r)
+                os.dup2(w, 1)
+                os.dup2(w, 2)
+                if w > 2:
+                    os.close(w)
+                sys.stdout = os.fdopen(1, 'w')
+                sys.stderr = os.fdopen(2, 'w')
+                if self.filename:
+                    util.openlog('finitd %s' % os.path.abspath(self.filename))
+                status = exitStatus(runNamedCommand, self.config, commandName, args)
+            finally:
+                os._exit(status)
+        os.close(w)
+        util.setCloexec(r)
+        return (pid, r)
+
+    def run(self, commandName, args):
+        (pid, fd) = self.fork(commandName, args)
+        output = []
+        while True:
+            try:
+                s = os.read(fd, 4096)
+            except OSError, e:
+                if e.errno == errno.EINTR:
+                    continue
+                raise
+            if not s:
+                break # The command (and anything it forked, like a watcher) is done.
+            output.append(s)
+        os.close(fd)
+        while True:
+            try:
+                (_, status) = os.waitpid(pid, 0)
+                break
+            except OSError, e:
+                if e.errno != errno.EINTR:
+                    raise
+        return (exitCode(status), ''.join(output))
+
+    def runAsync(self, commandName, args, callback):
+        """Like run, but calls callback(status, output) from the loop instead."""
+        (pid, fd) = self.fork(commandName, args)
+        util.setNonblocking(fd)
+        output = []
+        done = {}
+        def finish():
+            if 'eof' in done and 'status' in done:
+                callback(done['status'], ''.join(output))
+        def read(fd):
+            try:
+                s = os.read(fd, 4096)
+            except OSError, e:
+                if e.errno in (errno.EAGAIN, errno.EINTR):
+                    return
+                s = ''
+            if s:
+                output.append(s)
+            else:
+                self.loop.removeReader(fd)
+                os.close(fd)
+                done['eof'] = True
+                finish()
+        def exited(pid, status):
+            done['status'] = exitCode(status)
+            finish()
+        self.loop.addReader(fd, read)
+        self.loop.watchChild(pid, exited)
@@ -0,0 +1,70 @@
+###
+# Copyright (c) 2009, Juju, Inc.
+# All rights reserved.
+# 
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are
+# met:
+# 
+#     * Redistributions of source code must retain the above copyright
+#       notice, this list of conditions and the following disclaimer. 
+#     * Redistributions in binary form must reproduce the above
+#       copyright notice, this list of conditions and the following
+#       disclaimer in the documentation and/or other materials provided
+#       with the distribution.
+#     * Neither the name of the author of this software nor the names of
+#       the contributors to the software may be used to endorse or
+#       promote products derived from this software without specific
+#       prior written permission. 
+# 
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS
+# "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT
+# LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR
+# A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT
+# HOLDER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL,
+# SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT
+# LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE,
+# DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY
+# THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+# OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE. 
+###
+
+
+"""The slim watcher, which start re-executes its daemonized process as (see
+start.execSlimWatcher).  It's given the evaluated configuration rather than reading
+it, so neither hieropt nor the command line's own modules are ever imported."""
+
+import sys
+
+# The watcher uses neither TLS nor hashing, but socket and random import their
+# modules (and with them, OpenSSL) if they can.
+sys.modules['_ssl'] = None
+sys.modules['_hashlib'] = None
+
+import os
+import marshal
+
+import util
+import flatconf
+import commands
+# Imported here, before start.watch's chroot might hide them.
+import watcher
+import eventloop
+
+def main():
+    (fd, ident) = sys.argv[1:]
+    fp = os.fdopen(int(fd), 'rb')
+    try:
+        state = marshal.load(fp)
+    finally:
+        fp.close()
+    util.openlog(ident)
+    sys.stdout = util.SyslogFile()
+    sys.stderr = util.SyslogFile(util.SyslogFile.LOG_ERR)
+    command = commands.start(flatconf.Variable(state['config']))
+    command.cgroupProcs = state['cgroupProcs']
+    for fd in (state['cgroupProcs'], state['readyWriter']):
+        if fd is not None:
+            util.setCloexec(fd)
+    command.watch(state['environ'], state['readyWriter'])
@@ -0,0 +1,121 @@
+###
+# Copyright (c) 2009, Juju, Inc.
+# All rights reserved.
+# 
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are
+# met:
+# 
+#     * Redistributions of source code must retain the above copyright
+#       notice, this list of conditions and the following disclaimer. 
+#     * Redistributions in binary form must reproduce the above
+#       copyright notice, this list of conditions and the following
+#       disclaimer in the documentation and/or other materials provided
+#       with the distribution.
+#     * Neither the name of the author of this software nor the names of
+#       the contributors to the software may be used to endorse or
+#       promote products derived from this software without specific
+#       prior written permission. 
+# 
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS
+# "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT
+# LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR
+# A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT
+# HOLDER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL,
+# SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT
+# LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE,
+# DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY
+# THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+# OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE. 
+###
+
+
+"""Listening sockets the watcher binds once and passes to each child process it
+starts, following systemd's socket activation convention: the sockets are file
+descriptors 3 and up, LISTEN_FDS says how many there are, LISTEN_PID which process
+they're for and LISTEN_FDNAMES what they're called.  Connections made while the
+child is restarting wait in the socket's backlog rather than being refused."""
+
+import os
+import errno
+import fcntl
+import socket
+
+import util
+
+LISTEN_FDS_START = 3
+
+def parseAddress(s):
+    """Returns (family, address) for the given listening address: a Unix domain
+    socket's path (unix:/path, or just /path), or a TCP [host:]port, optionally
+    prefixed with tcp:.  IPv6 hosts are bracketed, e.g., [::1]:8080."""
+    s = s.strip()
+    if s.startswith('unix:'):
+        return (socket.AF_UNIX, s[len('unix:'):])
+    elif s.startswith('/'):
+        return (socket.AF_UNIX, s)
+    if s.startswith('tcp:'):
+        s = s[len('tcp:'):]
+    (host, _, port) = s.rpartition(':')
+    if not port.isdigit() or int(port) > 65535:
+        raise ValueError('Invalid listening address: %r' % s)
+    if host.startswith('[') and host.endswith(']'):
+        return (socket.AF_INET6, (host[1:-1], int(port)))
+    elif ':' in host:
+        raise ValueError('IPv6 addresses must be bracketed: %r' % s)
+    return (socket.AF_INET, (host or '0.0.0.0', int(port)))
+
+def bind(address, backlog):
+    (family, address) = parseAddress(address)
+    sock = socket.socket(family, socket.SOCK_STREAM)
+    util.setCloexec(sock.fileno())
+    if family == socket.AF_UNIX:
+        try:
+            os.remove(address) # Left over from a watcher that's gone.
+        except OSError, e:
+            if e.errno != errno.ENOENT:
+                raise
+    else:
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    try:
+        sock.bind(address)
+        sock.listen(backlog)
+    except:
+        sock.close()
+        raise
+    return sock
+
+def bindAll(config):
+    """Binds every socket in finitd.sockets, returning [(name, socket)]."""
+    bound = []
+    try:
+        for group in config.sockets.children():
+            if group.listen():
+                bound.append((group._name, bind(group.listen(), group.backlog())))
+    except:
+        close(bound)
+        raise
+    return bound
+
+def close(bound):
+    for (_, sock) in bound:
+        if sock.family == socket.AF_UNIX:
+            try:
+                os.remove(sock.getsockname())
+            except OSError:
+                pass
+        sock.close()
+
+def inherit(bound, environ):
+    """Makes the given sockets file descriptors 3 and up in this (child) process and
+    describes them in the given environment."""
+    # Move them all out of the way first, so none is overwritten by another's dup2.
+    fds = [fcntl.fcntl(sock.fileno(), fcntl.F_DUPFD, LISTEN_FDS_START + len(bound))
+           for (_, sock) in bound]
+    for (i, fd) in enumerate(fds):
+        os.dup2(fd, LISTEN_FDS_START + i)
+        os.close(fd)
+    environ['LISTEN_FDS'] = str(len(bound))
+    environ['LISTEN_PID'] = str(os.getpid())
+    environ['LISTEN_FDNAMES'] = ':'.join([name for (name, _) in bound])
@@ -0,0 +1,133 @@
+###
+# Copyright (c) 2009, Juju, Inc.
+# All rights reserved.
+# 
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are
+# met:
+# 
+#     * Redistributions of source code must retain the above copyright
+#       notice, this list of conditions and the following disclaimer. 
+#     * Redistributions in binary form must reproduce the above
+#       copyright notice, this list of conditions and the following
+#       disclaimer in the documentation and/or other materials provided
+#       with the distribution.
+#     * Neither the name of the author of this software nor the names of
+#       the contributors to the software may be used to endorse or
+#       promote products derived from this software without specific
+#       prior written permission. 
+# 
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS
+# "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT
+# LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR
+# A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT
+# HOLDER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL,
+# SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT
+# LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE,
+# DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY
+# THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+# OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE. 
+###
+
+import os
+import sys
+import glob
+import signal
+
+import conf
+import util
+import commands
+from watcher import Watcher
+from eventloop import EventLoop
+from main import makeEnvironment
+
+class Supervisor(object):
+    """Runs the start command's watcher for every configuration file (*.conf) in a
+    directory from one process.  The directory is rescanned every interval seconds
+    and on SIGHUP: services whose configuration files appear are started, and
+    services whose configuration files disappear are stopped.  A service stopped with
+    `finitd <configfile> stop` stays stopped until its configuration file is removed
+    and added again or the supervisor is restarted."""
+    def __init__(self, directory, loop, interval=5):
+        self.directory = os.path.abspath(directory)
+        self.loop = loop
+        self.interval = interval
+        self.watchers = {} # {filename: Watcher, or None if it's not ours to run}
+        self.timer = None
+        self.pid = os.getpid()
+
+    def log(self, s):
+        print 'Supervisor[%s]: %s' % (self.pid, s)
+
+    def start(self):
+        self.loop.handleSignal(signal.SIGHUP, self.sighup)
+        self.loop.handleSignal(signal.SIGUSR1, self.sigusr1)
+        self.scan()
+
+    def scan(self):
+        if self.timer is not None:
+            self.timer.cancel()
+        filenames = set(glob.glob(os.path.join(self.directory, '*.conf')))
+        for filename in sorted(filenames - set(self.watchers)):
+            self.watchers[filename] = self.load(filename)
+        for filename in sorted(set(self.watchers) - filenames):
+            self.remove(filename)
+        self.timer = self.loop.callLater(self.interval, self.scan)
+
+    def load(self, filename):
+        name = os.path.splitext(os.path.basename(filename))[0]
+        config = conf.makeConfig()
+        command = commands.start(config)
+        try:
+            config.read(filename)
+            config.readenv()
+            conf.resolvePaths(config)
+            command.checkConfig(config)
+            pid = command.checkProcessAlive()
+        except commands.InvalidConfiguration, e:
+            self.log('invalid configuration %r: %s' % (filename, e))
+            return None
+        except (Exception, SystemExit), e:
+            self.log('could not load %r: %s' % (filename, e))
+            return None
+        if pid:
+            self.log('%s appears to be alive at pid %s, not starting it' % (name, pid))
+            return None
+        watcher = Watcher(command, makeEnvironment(config), self.loop,
+                          name=name, shared=True)
+        watcher.start()
+        return watcher
+
+    def remove(self, filename):
+        watcher = self.watchers.pop(filename)
+        if watcher is not None and not watcher.exited:
+            self.log('%r was removed' % filename)
+            watcher.stop()
+
+    def sighup(self, signum):
+        self.log('received SIGHUP, rescanning %r' % self.directory)
+        self.scan()
+
+    def sigusr1(self, signum):
+        # `finitd stop` removes a service's watcher pidfile before sending us SIGUSR1.
+        for watcher in self.watchers.values():
+            if watcher is not None and not watcher.exited and watcher.stopRequested():
+                watcher.log('received SIGUSR1 and watcher pidfile was removed')
+                watcher.stopping = True
+
+def supervise(directory, interval=5):
+    """Daemonizes and supervises every configuration file in the given directory."""
+    if not os.path.isdir(directory):
+        util.error('%r is not a directory.' % directory)
+    directory = os.path.abspath(directory)
+    sys.stdout = util.SyslogFile()
+    sys.stderr = util.SyslogFile(util.SyslogFile.LOG_ERR)
+    util.daemonize()
+    os.chdir('/')
+    for fd in range(3):
+        os.open(conf.devnull, os.O_RDWR)
+    loop = EventLoop()
+    Supervisor(directory, loop, interval).start()
+    loop.run()
+    os._exit(0)
@@ -0,0 +1,270 @@
+###
+# Copyright (c) 2009, Juju, Inc.
+# All rights reserved.
+# 
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are
+# met:
+# 
+#     * Redistributions of source code must retain the above copyright
+#       notice, this list of conditions and the following disclaimer. 
+#     * Redistributions in binary form must reproduce the above
+#       copyright notice, this list of conditions and the following
+#       disclaimer in the documentation and/or other materials provided
+#       with the distribution.
+#     * Neither the name of the author of this software nor the names of
+#       the contributors to the software may be used to endorse or
+#       promote products derived from this software without specific
+#       prior written permission. 
+# 
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS
+# "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT
+# LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR
+# A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT
+# HOLDER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL,
+# SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT
+# LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE,
+# DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY
+# THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+# OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE. 
+###
+
+
+"""A host-wide table of the state of every watcher configured to publish to it
+(finitd.watcher.table): one memory-mapped file of fixed-size slots, so `finitd
+--status-all` can report every service from a single mapping rather than reading
+each one's configuration and pidfile.
+
+The file is a header (MAGIC, the slot size and the number of slots) followed by the
+slots.  A watcher claims a free slot -- one whose watcher is 0 or no longer running --
+while holding an flock on the file, and is then its only writer.  A slot's sequence
+number is odd while it's being written, so readers retry slots that change while
+they're reading them."""
+
+import os
+import sys
+import mmap
+import time
+import errno
+import fcntl
+import struct
+
+import util
+import metrics
+
+DEFAULT = '/run/finitd/table'
+DEFAULT_SLOTS = 4096
+
+MAGIC = 'finitdT1'
+HEADER = struct.Struct('=8sII') # MAGIC, slot size, number of slots.
+# sequence, watcher pid, pid, restarts, last wait status (-1 for none), flags, start
+# time, tripped (when the child will be tried again; 0 if it isn't tripped), name.
+SLOT = struct.Struct('=IiiIiIdd128s')
+
+READY = 1
+STOPPING = 2
+UNHEALTHY = 4
+RELOADING = 8
+
+def isAlive(pid):
+    try:
+        os.kill(pid, 0)
+    except OSError, e:
+        return e.errno == errno.EPERM
+    return True
+
+class Table(object):
+    def __init__(self, path, slots=DEFAULT_SLOTS, create=True):
+        self.path = path
+        if create:
+            self.fd = os.open(path, os.O_RDWR | os.O_CREAT, 0644)
+        else:
+            self.fd = os.open(path, os.O_RDONLY)
+        try:
+            fcntl.flock(self.fd, fcntl.LOCK_EX)
+            try:
+                if create and os.fstat(self.fd).st_size == 0:
+                    os.write(self.fd, HEADER.pack(MAGIC, SLOT.size, slots))
+                    os.ftruncate(self.fd, HEADER.size + SLOT.size * slots)
+                os.lseek(self.fd, 0, os.SEEK_SET)
+                header = os.read(self.fd, HEADER.size)
+                if len(header) != HEADER.size:
+                    raise ValueError('%r is not a finitd table' % path)
+                (magic, size, self.slots) = HEADER.unpack(header)
+                if magic != MAGIC or size != SLOT.size:
+                    raise ValueError('%r is not a finitd table' % path)
+                util.setCloexec(self.fd)
+                if create:
+                    access = mmap.ACCESS_WRITE
+                else:
+                    access = mmap.ACCESS_READ
+                self.map = mmap.mmap(self.fd, HEADER.size + SLOT.size * self.slots,
+                                     access=access)
+            finally:
+                fcntl.flock(self.fd, fcntl.LOCK_UN)
+        except:
+            os.close(self.fd)
+            raise
+
+    def offset(self, index):
+        return HEADER.size + SLOT.size * index
+
+    def claim(self):
+        """Returns a free Slot, claimed for this process, or None if the table is
+        full."""
+        fcntl.flock(self.fd, fcntl.LOCK_EX)
+        try:
+            for index in xrange(self.slots):
+                offset = self.offset(index)
+                (sequence, watcher) = struct.unpack_from('=Ii', self.map, offset)
+                if watcher == 0 or not isAlive(watcher):
+                    slot = Slot(self, offset, sequence + (sequence & 1))
+                    slot.write(os.getpid(), 0, 0, -1, 0, 0, 0, '')
+                    return slot
+            return None
+        finally:
+            fcntl.flock(self.fd, fcntl.LOCK_UN)
+
+    def read(self, index):
+        """Returns the (watcher, pid, restarts, status, flags, started, tripped, name)
+        in the given slot, or None if it's being written."""
+        offset = self.offset(index)
+        for _ in range(100):
+            data = self.map[offset:offset + SLOT.size]
+            fields = SLOT.unpack(data)
+            if fields[0] & 1 or \
+               struct.unpack_from('=I', self.map, offset)[0] != fields[0]:
+                continue
+            return fields[1:8] + (fields[8].rstrip('\0'),)
+        return None
+
+    def snapshot(self):
+        """Returns the state of every running watcher in the table, as a list of
+        dictionaries like Watcher.state's."""
+        states = []
+        for index in xrange(self.slots):
+            fields = self.read(index)
+            if fields is None or not fields[0] or not isAlive(fields[0]):
+                continue
+            (watcher, pid, restarts, status, flags, started, tripped, name) = fields
+            if status < 0:
+                status = None
+            states.append({
+                'name': name,
+                'watcher': watcher,
+                'pid': pid or None,
+                'uptime': pid and time.time() - started or None,
+                'restarts': restarts,
+                'status': status,
+                'ready': bool(flags & READY),
+                'stopping': bool(flags & STOPPING),
+                'unhealthy': bool(flags & UNHEALTHY),
+                'reloading': bool(flags & RELOADING),
+                'tripped': tripped or None,
+            })
+        return states
+
+    def close(self):
+        self.map.close()
+        os.close(self.fd)
+
+
+class Slot(object):
+    """A watcher's slot in a Table."""
+    def __init__(self, table, offset, sequence):
+        self.table = table
+        self.offset = offset
+        self.sequence = sequence
+
+    def write(self, watcher, pid, restarts, status, flags, started, tripped, name):
+        mapping = self.table.map
+        mapping[self.offset:self.offset + 4] = struct.pack('=I', self.sequence + 1)
+        data = SLOT.pack(self.sequence + 1, watcher, pid, restarts, status, flags,
+                         started, tripped, name[:128])
+        mapping[self.offset + 4:self.offset + SLOT.size] = data[4:]
+        self.sequence = (self.sequence + 2) & 0xffffffff
+        mapping[self.offset:self.offset + 4] = struct.pack('=I', self.sequence)
+
+    def publish(self, watcher):
+        state = watcher.state()
+        flags = 0
+        for (key, flag) in [('ready', READY), ('stopping', STOPPING),
+                            ('unhealthy', UNHEALTHY), ('reloading', RELOADING)]:
+            if state[key]:
+                flags |= flag
+        if state['status'] is None:
+            status = -1
+        else:
+            status = state['status']
+        self.write(os.getpid(), state['pid'] or 0, state['restarts'], status, flags,
+                   watcher.lastRestart, state['tripped'] or 0,
+                   metrics.serviceName(watcher))
+
+    def release(self):
+        self.write(0, 0, 0, -1, 0, 0, 0, '')
+
+
+_tables = {} # {path: Table}, so watchers sharing a process share their tables.
+
+def claim(path):
+    """Returns a Slot claimed in the table at the given path (creating it if need
+    be), or None if it's full."""
+    if path not in _tables:
+        _tables[path] = Table(path)
+    return _tables[path].claim()
+
+def describe(state):
+    if state['tripped']:
+        return 'tripped'
+    elif state['stopping']:
+        return 'stopping'
+    elif not state['pid']:
+        return 'stopped'
+    elif state['unhealthy']:
+        return 'unhealthy'
+    elif state['reloading']:
+        return 'reloading'
+    elif state['ready']:
+        return 'ready'
+    else:
+        return 'starting'
+
+def describeStatus(status):
+    if status is None:
+        return '-'
+    elif os.WIFSIGNALED(status):
+        return 'signal %s' % os.WTERMSIG(status)
+    return 'exit %s' % os.WEXITSTATUS(status)
+
+def formatUptime(seconds):
+    if seconds is None:
+        return '-'
+    seconds = int(seconds)
+    return '%d:%02d:%02d' % (seconds // 3600, seconds // 60 % 60, seconds % 60)
+
+def printStates(states, fp=sys.stdout):
+    width = max([len(state['name']) for state in states] + [len('SERVICE')])
+    fp.write('%-*s  %-9s  %7s  %7s  %9s  %8s  %s\n' %
+             (width, 'SERVICE', 'STATE', 'PID', 'WATCHER', 'UPTIME', 'RESTARTS',
+              'LAST EXIT'))
+    for state in sorted(states, key=lambda state: state['name']):
+        fp.write('%-*s  %-9s  %7s  %7s  %9s  %8s  %s\n' %
+                 (width, state['name'], describe(state), state['pid'] or '-',
+                  state['watcher'], formatUptime(state['uptime']), state['restarts'],
+                  describeStatus(state['status'])))
+
+def main(argv):
+    """Implements `finitd --status-all [<table>]`, returning the exit status."""
+    if len(argv) > 1:
+        util.error('--status-all accepts at most one table file.')
+    path = argv and argv[0] or DEFAULT
+    try:
+        table = Table(path, create=False)
+    except (EnvironmentError, ValueError), e:
+        util.error('Could not read %r: %s' % (path, e))
+    try:
+        printStates(table.snapshot())
+    finally:
+        table.close()
+    return 0
@@ -0,0 +1,237 @@
+###
+# Copyright (c) 2009, Juju, Inc.
+# All rights reserved.
+# 
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are
+# met:
+# 
+#     * Redistributions of source code must retain the above copyright
+#       notice, this list of conditions and the following disclaimer. 
+#     * Redistributions in binary form must reproduce the above
+#       copyright notice, this list of conditions and the following
+#       disclaimer in the documentation and/or other materials provided
+#       with the distribution.
+#     * Neither the name of the author of this software nor the names of
+#       the contributors to the software may be used to endorse or
+#       promote products derived from this software without specific
+#       prior written permission. 
+# 
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS
+# "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT
+# LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR
+# A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT
+# HOLDER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL,
+# SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT
+# LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE,
+# DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY
+# THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+# OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE. 
+###
+
+
+"""Benchmarks of finitd's own overhead, using cheap stand-in children (sleep and
+false), so changes which make finitd slower or bigger show up as numbers rather than
+as flaky tests.  Not collected by nose; run it directly:
+
+    python -m finitd.test.benchmark [-n RUNS] [--services N] [--output FILE]
+                                    [--compare FILE]
+
+Each benchmark's results are summarized as percentiles.  --output writes them (with
+finitd's version) as JSON, and --compare prints them alongside those in an earlier
+--output file."""
+
+import os
+import sys
+import math
+import time
+import shutil
+import optparse
+import tempfile
+import subprocess
+
+import finitd
+from finitd import conf, util, control
+from finitd.compat import json
+
+class Benchmark(object):
+    def __init__(self, directory, finitd, runs, services):
+        self.directory = directory
+        self.finitd = finitd
+        self.runs = runs
+        self.services = services
+        self.results = {}
+        self.devnull = open(os.devnull, 'w')
+
+    def configure(self, name, command, **settings):
+        """Writes a configuration file for a service with the given name and command,
+        returning its filename.  Settings are full names (with underscores for dots,
+        e.g., watcher_restart) and values."""
+        config = conf.makeConfig()
+        directory = os.path.join(self.directory, name)
+        if not os.path.isdir(directory):
+            os.mkdir(directory)
+        config.child.chdir.set(directory)
+        config.child.command.set(command)
+        config.options.pidfile.set('pid')
+        config.watcher.pidfile.set('pid.watcher')
+        config.watcher.socket.set('socket')
+        for (name, value) in settings.items():
+            conf.lookup(config, 'finitd.' + name.replace('_', '.')).set(value)
+        filename = os.path.join(directory, 'finitd.conf')
+        fp = open(filename, 'w')
+        config.writefp(fp, annotate=False)
+        fp.close()
+        return filename
+
+    def run(self, *args):
+        """Runs finitd with the given arguments, returning how long it took."""
+        started = time.time()
+        status = subprocess.call(self.finitd + list(args), stdout=self.devnull)
+        elapsed = time.time() - started
+        if status:
+            raise RuntimeError('%s exited with status %s' %
+                               (' '.join(self.finitd + list(args)), status))
+        return elapsed
+
+    def record(self, name, unit, samples):
+        self.results[name] = summarize(unit, samples)
+
+    def benchmarkStartStop(self):
+        filename = self.configure('startstop', 'sleep 30')
+        (starts, stops) = ([], [])
+        for _ in range(self.runs):
+            # Without finitd.watcher.ready, a child is ready once it's executed.
+            starts.append(self.run(filename, 'start', '--wait-ready'))
+            stops.append(self.run(filename, 'stop', '--wait'))
+        self.record('start_to_exec', 'seconds', starts)
+        self.record('stop_to_exit', 'seconds', stops)
+
+    def benchmarkRestart(self):
+        filename = self.configure('restart', 'sleep 30')
+        self.run(filename, 'start', '--wait-ready')
+        try:
+            self.record('restart_turnaround', 'seconds',
+                        [self.run(filename, 'restart', '--wait-ready')
+                         for _ in range(self.runs)])
+        finally:
+            self.run(filename, 'stop', '--wait')
+
+    def benchmarkCrashLoop(self, duration=5):
+        filename = self.configure('crashloop', 'false', watcher_restart=True,
+                                  watcher_restart_wait=0, watcher_restart_backoff=0,
+                                  watcher_restart_backoff_jitter=0)
+        self.run(filename, 'start')
+        socket = os.path.join(self.directory, 'crashloop', 'socket')
+        time.sleep(0.5) # Let it get going.
+        samples = []
+        periods = max(1, self.runs // 5)
+        try:
+            for _ in range(periods):
+                before = control.request(socket, 'status')['restarts']
+                started = time.time()
+                time.sleep(float(duration) / periods)
+                after = control.request(socket, 'status')['restarts']
+                samples.append((after - before) / (time.time() - started))
+        finally:
+            control.request(socket, 'stop')
+            util.waitForRemoval(socket, 5)
+        self.record('crash_loop_restarts', 'per second', samples)
+
+    def benchmarkServices(self):
+        filenames = [self.configure('service%s' % i, 'sleep 60')
+                     for i in range(self.services)]
+        self.run(*(['--all'] + filenames + ['start', '--wait-ready']))
+        try:
+            self.record('status_all', 'seconds',
+                        [self.run(*(['--all'] + filenames + ['status']))
+                         for _ in range(self.runs)])
+            self.record('status_one', 'seconds',
+                        [self.run(filenames[i % len(filenames)], 'status')
+                         for i in range(self.runs)])
+            rss = []
+            for filename in filenames:
+                pidfile = os.path.join(os.path.dirname(filename), 'pid.watcher')
+                rss.append(residentBytes(util.getPidFromFile(pidfile)))
+            self.record('watcher_rss', 'bytes', rss)
+        finally:
+            self.run(*(['--all'] + filenames + ['stop', '--wait']))
+
+    def runAll(self):
+        for benchmark in [self.benchmarkStartStop, self.benchmarkRestart,
+                          self.benchmarkCrashLoop, self.benchmarkServices]:
+            benchmark()
+        return self.results
+
+
+def residentBytes(pid):
+    for line in open('/proc/%s/status' % pid):
+        if line.startswith('VmRSS:'):
+            return int(line.split()[1]) * 1024
+    return None
+
+def percentile(samples, fraction):
+    """Returns the given percentile (as a fraction) of the sorted samples, by the
+    nearest-rank method."""
+    rank = max(0, int(math.ceil(fraction * len(samples))) - 1)
+    return samples[rank]
+
+def summarize(unit, samples):
+    samples = sorted(samples)
+    return {
+        'unit': unit,
+        'n': len(samples),
+        'mean': sum(samples) / float(len(samples)),
+        'min': samples[0],
+        'p50': percentile(samples, 0.5),
+        'p90': percentile(samples, 0.9),
+        'p99': percentile(samples, 0.99),
+        'max': samples[-1],
+    }
+
+def report(results, previous=None):
+    for name in sorted(results):
+        result = results[name]
+        line = '%-22s p50 %-10.4g p90 %-10.4g p99 %-10.4g max %-10.4g %s' % \
+               (name, result['p50'], result['p90'], result['p99'], result['max'],
+                result['unit'])
+        if previous and name in previous and previous[name]['p50']:
+            line += '  (p50 %+.1f%%)' % \
+                    (100.0 * (float(result['p50']) / previous[name]['p50'] - 1))
+        print line
+
+def main(argv=None):
+    parser = optparse.OptionParser(usage='%prog [options]')
+    parser.add_option('-n', '--runs', type='int', default=20,
+                      help='Number of times each operation is measured.')
+    parser.add_option('--services', type='int', default=20,
+                      help='Number of services status and watcher RSS are measured '
+                           'over.')
+    parser.add_option('--finitd', default='%s -m finitd.main' % sys.executable,
+                      help='The finitd command to benchmark.')
+    parser.add_option('--output', help='A file to write the results to, as JSON.')
+    parser.add_option('--compare', help='An earlier --output file to compare with.')
+    (options, args) = parser.parse_args(argv)
+    previous = None
+    if options.compare:
+        previous = json.load(open(options.compare))['results']
+    directory = tempfile.mkdtemp(prefix='finitd-benchmark-')
+    try:
+        benchmark = Benchmark(directory, options.finitd.split(), options.runs,
+                              options.services)
+        results = benchmark.runAll()
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+    report(results, previous)
+    if options.output:
+        fp = open(options.output, 'w')
+        json.dump({'version': finitd.__version__,
+                   'python': sys.version.split()[0],
+                   'time': time.time(),
+                   'results': results}, fp, indent=2, sort_keys=True)
+        fp.write('\n')
+        fp.close()
+
+if __name__ == '__main__':
+    main()
@@ -30,9 +30,14 @@
 # OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE. 
 ###
 
+import os
 import grp
+import shutil
+import marshal
+import resource
+import tempfile
 
-from finitd import conf
+from finitd import conf, flatconf
 from finitd.test import *
 from hieropt.test.test_hieropt import assert_write_then_read_equivalence
 
@@ -58,6 +63,32 @@ def test_Signal():
     assert_equals(sig(), 15)
     assert_equals(str(sig), 'SIGTERM')
 
+def test_Size():
+    size = conf.Size('size')
+    size.setFromString('100M')
+    assert_equals(size(), 100 << 20)
+    size.setFromString('512')
+    assert_equals(size(), 512)
+
+def test_Limit():
+    limit = conf.Limit('limit')
+    limit.setFromString('1024:4096')
+    assert_equals(limit(), (1024, 4096))
+    assert_equals(str(limit), '1024:4096')
+    limit.setFromString('2G')
+    assert_equals(limit(), (2 << 30, 2 << 30))
+    assert_equals(str(limit), str(2 << 30))
+    limit.setFromString('unlimited')
+    assert_equals(limit(), (resource.RLIM_INFINITY, resource.RLIM_INFINITY))
+    assert_equals(str(limit), 'unlimited')
+    assert_raises(ValueError, limit.setFromString, '1:2:3')
+
+def test_Argv():
+    argv = conf.Argv('argv')
+    argv.setFromString('''/bin/echo 'a  b' "$c" d\\ e''')
+    assert_equals(argv(), ['/bin/echo', 'a  b', '$c', 'd e'])
+    assert_equals(str(argv), "/bin/echo 'a  b' '$c' 'd e'")
+
 def test_conf_config():
     assert_write_then_read_equivalence(conf.config)
 
@@ -66,3 +97,68 @@ def test_watcher_pidfile():
     assert_equals(conf.config.watcher.pidfile(), None)
     conf.config.options.pidfile.set('pid')
     assert_equals(conf.config.watcher.pidfile(), 'pid.watcher')
+
+def test_readConfig():
+    directory = tempfile.mkdtemp()
+    try:
+        os.environ['XDG_CACHE_HOME'] = directory
+        filename = os.path.join(directory, 'test.conf')
+        fp = open(filename, 'w')
+        fp.write('finitd.child.command: sleep 1\nfinitd.env.FOO: bar\n'
+                 'finitd.limits.nofile: 1024:4096\n')
+        fp.close()
+        for _ in range(2): # The second time, from the cache.
+            config = conf.makeConfig()
+            conf.readConfig(config, filename)
+            assert_equals(config.child.command(), 'sleep 1')
+            assert_equals(config.env.FOO(), 'bar')
+            assert_equals(config.limits.nofile(), (1024, 4096))
+            assert config.child.stdout.isDefault()
+            assert_equals(len(os.listdir(os.path.join(directory, 'finitd'))), 1)
+        fp = open(filename, 'w')
+        fp.write('finitd.child.command: sleep 10\n')
+        fp.close()
+        config = conf.makeConfig()
+        conf.readConfig(config, filename)
+        assert_equals(config.child.command(), 'sleep 10')
+        assert_equals(config.env.children(), [])
+    finally:
+        del os.environ['XDG_CACHE_HOME']
+        shutil.rmtree(directory)
+
+def test_readConfig_untrusted():
+    directory = tempfile.mkdtemp()
+    try:
+        os.environ['XDG_CACHE_HOME'] = directory
+        filename = os.path.join(directory, 'test.conf')
+        fp = open(filename, 'w')
+        fp.write('finitd.child.command: sleep 1\n')
+        fp.close()
+        conf.readConfig(conf.makeConfig(), filename)
+        (cacheFile,) = os.listdir(os.path.join(directory, 'finitd'))
+        cacheFile = os.path.join(directory, 'finitd', cacheFile)
+        fp = open(cacheFile, 'wb')
+        marshal.dump((conf.cacheKey(filename),
+                      [('finitd.child.command', 'planted')]), fp)
+        fp.close()
+        os.chmod(cacheFile, 0666) # Anyone could have planted that.
+        config = conf.makeConfig()
+        conf.readConfig(config, filename)
+        assert_equals(config.child.command(), 'sleep 1')
+    finally:
+        del os.environ['XDG_CACHE_HOME']
+        shutil.rmtree(directory)
+
+def test_flatten():
+    config = conf.makeConfig()
+    config.child.command.set('sleep 1')
+    config.env.get('FOO').set('bar')
+    config.limits.nofile.set((1024, 4096))
+    flat = flatconf.Variable(marshal.loads(marshal.dumps(flatconf.flatten(config))))
+    assert_equals(flat.child.command(), 'sleep 1')
+    assert_equals(flat.env.get('FOO')(), 'bar')
+    assert_equals(flat.limits.nofile(), (1024, 4096))
+    assert_equals([child._name for child in flat.env.children()], ['FOO'])
+    assert flat.child.stdout.isDefault()
+    assert not flat.child.command.isDefault()
+    assert_equals(flat.watcher.pidfile(), config.watcher.pidfile())
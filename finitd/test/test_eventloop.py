@@ -0,0 +1,118 @@
+###
+# Copyright (c) 2009, Juju, Inc.
+# All rights reserved.
+# 
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are
+# met:
+# 
+#     * Redistributions of source code must retain the above copyright
+#       notice, this list of conditions and the following disclaimer. 
+#     * Redistributions in binary form must reproduce the above
+#       copyright notice, this list of conditions and the following
+#       disclaimer in the documentation and/or other materials provided
+#       with the distribution.
+#     * Neither the name of the author of this software nor the names of
+#       the contributors to the software may be used to endorse or
+#       promote products derived from this software without specific
+#       prior written permission. 
+# 
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS
+# "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT
+# LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR
+# A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT
+# HOLDER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL,
+# SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT
+# LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE,
+# DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY
+# THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+# OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE. 
+###
+
+import os
+import time
+import signal
+import threading
+
+from finitd import eventloop
+from finitd.test import *
+
+def test_callLater():
+    loop = eventloop.EventLoop()
+    calls = []
+    loop.callLater(0.02, calls.append, 2)
+    loop.callLater(0.01, calls.append, 1)
+    loop.callLater(0.01, calls.append, 'cancelled').cancel()
+    loop.callLater(0.03, loop.stop)
+    loop.run()
+    assert_equals(calls, [1, 2])
+
+def test_stopBeforeRun():
+    loop = eventloop.EventLoop()
+    loop.stop()
+    loop.callLater(1, loop.stop) # In case the first stop is lost.
+    start = time.time()
+    loop.run()
+    assert time.time() - start < 0.5, 'a stop before run was lost'
+    # The loop still runs the next time, until it's stopped again.
+    calls = []
+    loop.callLater(0.01, calls.append, 1)
+    loop.callLater(0.02, loop.stop)
+    loop.run()
+    assert_equals(calls, [1])
+
+def test_watchChild():
+    loop = eventloop.EventLoop()
+    pid = os.fork()
+    if not pid:
+        os._exit(3)
+    exited = []
+    def childExited(pid, status):
+        exited.append((pid, os.WEXITSTATUS(status)))
+        loop.stop()
+    loop.watchChild(pid, childExited)
+    loop.callLater(5, loop.stop) # So a broken loop can't hang the tests.
+    loop.run()
+    assert_equals(exited, [(pid, 3)])
+
+def test_handleSignal():
+    loop = eventloop.EventLoop()
+    received = []
+    def sigusr2(signum):
+        received.append(signum)
+        loop.stop()
+    loop.handleSignal(signal.SIGUSR2, sigusr2)
+    loop.callLater(0, os.kill, os.getpid(), signal.SIGUSR2)
+    loop.callLater(5, loop.stop)
+    loop.run()
+    signal.signal(signal.SIGUSR2, signal.SIG_DFL)
+    assert_equals(received, [signal.SIGUSR2])
+
+def test_addReader():
+    loop = eventloop.EventLoop()
+    (r, w) = os.pipe()
+    read = []
+    def readable(fd):
+        read.append(os.read(fd, 100))
+        loop.stop()
+    loop.addReader(r, readable)
+    loop.callLater(0, os.write, w, 'foo')
+    loop.callLater(5, loop.stop)
+    loop.run()
+    os.close(r)
+    os.close(w)
+    assert_equals(read, ['foo'])
+
+def test_callFromThread():
+    loop = eventloop.EventLoop()
+    calls = []
+    def call(arg):
+        calls.append(arg)
+        loop.stop()
+    thread = threading.Thread(target=loop.callFromThread, args=(call, 'foo'))
+    loop.callLater(0, thread.start)
+    loop.callLater(5, loop.stop)
+    loop.run()
+    thread.join()
+    assert_equals(calls, ['foo'])
@@ -35,9 +35,18 @@ import sys
 import copy
 import time
 import shutil
+import signal
+import socket
 import datetime
+import gzip
 
 import finitd.conf
+import finitd.commands
+import finitd.control
+import finitd.logfile
+import finitd.util
+import finitd.service
+import finitd.eventloop
 from finitd.test import *
 
 base_dir = os.path.join(os.getcwd(), 'test.%s' % datetime.datetime.now().isoformat())
@@ -125,6 +134,33 @@ def test_basic():
     assert_stdout_equals(config, 'foo\n')
     assert_stderr_equals(config, '')
 
+def watcherPids(config, caller):
+    """Returns the pids of the processes whose command lines name the configuration
+    runConfig wrote for the given caller: its watcher, if it's still around."""
+    fn = filename(config, caller + '.conf')
+    pids = []
+    for pid in os.listdir('/proc'):
+        try:
+            cmdline = open('/proc/%s/cmdline' % pid).read()
+        except (EnvironmentError, ValueError):
+            continue
+        if fn in cmdline:
+            pids.append(int(pid))
+    return pids
+
+def test_watcher_exits():
+    # Whether the child exits before the watcher's loop runs or the watcher doesn't
+    # wait for it at all, the watcher exits.
+    config = runCommand('true')
+    time.sleep(0.5)
+    assert_equals(watcherPids(config, 'test_watcher_exits'), [])
+    config = getBasicConfig(caller='test_watcher_exits_nowait')
+    config.child.command.set('sleep 5')
+    config.watcher.wait.set(False)
+    runConfig(config, caller='test_watcher_exits_nowait')
+    time.sleep(0.5)
+    assert_equals(watcherPids(config, 'test_watcher_exits_nowait'), [])
+
 def test_redirection():
     config = runCommand('echo foo > bar')
     assert_file_equals(config, 'bar', 'foo\n')
@@ -165,6 +201,14 @@ def test_pidfile_write():
     assert not os.path.exists(pidfilename), 'pidfile was not removed'
     assert not os.path.exists(watcherpidfilename), 'watcherpidfile was not removed'
 
+def test_slim_watcher():
+    config = runCommand('sleep 2')
+    time.sleep(1) # Give the watcher time to write the pidfile.
+    pid = assert_pidfile(filename(config, config.watcher.pidfile()))
+    argv = content('/proc/%s/cmdline' % pid).split('\0')
+    assert 'slim.main()' in argv[3], 'watcher is not slim: %r' % argv
+    time.sleep(1.1)
+
 def test_clearenv():
     config = getBasicConfig()
     config.options.clearenv.set(True)
@@ -176,6 +220,25 @@ def test_clearenv():
             or line.startswith('SHLVL='), \
                'Unexpected env variable remaining: %r' % line
 
+def test_script_without_interpreter():
+    config = getBasicConfig()
+    script = filename(config, 's')
+    open(script, 'w').write('echo hi\n') # No #! line: the shell runs it.
+    os.chmod(script, 0755)
+    config.child.command.set('./s')
+    runConfig(config)
+    assert_stdout_equals(config, 'hi\n')
+
+def test_clearenv_path():
+    config = getBasicConfig()
+    decoy = filename(config, 'true')
+    open(decoy, 'w').write('#!/bin/sh\necho decoy\n')
+    os.chmod(decoy, 0755)
+    config.options.clearenv.set(True)
+    config.child.command.set('true') # Without a PATH, not the one here.
+    runConfig(config)
+    assert_stdout_equals(config, '')
+
 def test_env_vars():
     config = getBasicConfig()
     config.options.clearenv.set(True) # Makes things easier.
@@ -197,6 +260,151 @@ def test_basic_stop():
     assert not os.path.exists(pidfile(config)), 'pidfile %r exists' % pidfile(config)
     assert not os.path.exists('/proc/%s' % pid), '/proc/%s still exists' % pid
 
+def test_stop_wait():
+    config = getBasicConfig()
+    config.child.command.set('sleep 10')
+    runConfig(config)
+    time.sleep(1) # Time to start
+    pid = assert_pidfile(pidfile(config))
+    runConfig(config, finitd_command='stop --wait=5')
+    assert not os.path.exists('/proc/%s' % pid), '/proc/%s still exists' % pid
+
+def test_restart_backoff():
+    config = getBasicConfig()
+    config.child.command.set('sh -c "echo run; exit 1"')
+    config.watcher.restart.set(True)
+    config.watcher.restart.wait.set(0)
+    config.watcher.restart.backoff.set(0.1)
+    config.watcher.restart.retries.set(2)
+    runConfig(config)
+    time.sleep(1.5)
+    assert_stdout_equals(config, 'run\nrun\nrun\n')
+    assert not os.path.exists(filename(config, config.watcher.pidfile())), \
+           'watcher did not give up'
+
+def test_restart_breaker():
+    config = getBasicConfig()
+    config.child.command.set('sh -c "echo run; exit 1"')
+    config.watcher.socket.set('socket')
+    config.watcher.restart.set(True)
+    config.watcher.restart.wait.set(0)
+    config.watcher.restart.backoff.set(0.1)
+    config.watcher.restart.breaker.set(2)
+    config.watcher.restart.breaker.cooldown.set(60)
+    runConfig(config)
+    time.sleep(1)
+    try:
+        assert_stdout_equals(config, 'run\nrun\n')
+        reply = finitd.control.request(filename(config, 'socket'), 'status')
+        assert reply['tripped'] and not reply['pid'], reply
+        # Starting again tries once, and the breaker, which remembers, trips again.
+        runConfig(config, 'stop')
+        runConfig(config, 'start')
+        time.sleep(0.5)
+        assert_stdout_equals(config, 'run\nrun\nrun\n')
+        reply = finitd.control.request(filename(config, 'socket'), 'status')
+        assert_equals(reply['crashes'], 3)
+    finally:
+        runConfig(config, 'stop')
+
+def test_restart_breaker_status():
+    config = getBasicConfig()
+    config.child.command.set('sh -c "exit 1"')
+    config.watcher.restart.set(True)
+    config.watcher.restart.wait.set(0)
+    config.watcher.restart.backoff.set(0.1)
+    config.watcher.restart.breaker.set(2)
+    config.watcher.restart.breaker.cooldown.set(60)
+    runConfig(config)
+    time.sleep(1)
+    fn = filename(config, 'test_restart_breaker_status.conf')
+    try:
+        # Without a control socket, status reads the history.
+        output = os.popen('finitd %s status' % fn).read()
+        assert 'restarts tripped after 2 crashes; it will be tried again' in output, \
+               output
+    finally:
+        runConfig(config, 'stop')
+    time.sleep(0.5)
+    # Once the watcher's gone, nothing will try it again but another start.
+    output = os.popen('finitd %s status' % fn).read()
+    assert 'restarts tripped after 2 crashes; the next start will try it' in output, \
+           output
+
+def test_no_history_without_breaker():
+    config = runCommand('true')
+    time.sleep(0.5)
+    assert not os.path.exists(filename(config, 'pid.history'))
+
+def test_log_pipe():
+    config = getBasicConfig()
+    config.child.command.set(
+        'sh -c \'for i in 1 2 3 4 5; do echo line$i; sleep 0.1; done\'')
+    config.log.pipe.set(True)
+    config.log.rotate.size.set(10)
+    config.log.rotate.keep.set(2)
+    config.log.rotate.compress.set('gzip')
+    runConfig(config)
+    time.sleep(1.5)
+    assert_stdout_equals(config, 'line5\n')
+    segments = finitd.logfile.segments(stdout(config))
+    assert_equals([os.path.splitext(segment)[1] for segment in segments],
+                  ['.gz', '.gz'])
+    assert_equals([gzip.open(segment).read() for segment in segments],
+                  ['line3\n', 'line4\n'])
+
+def test_logs():
+    config = getBasicConfig()
+    config.child.command.set("sh -c 'echo before; sleep 1.5; echo after'")
+    config.log.pipe.set(True)
+    config.log.index.set(0.5)
+    runConfig(config)
+    middle = time.time() + 0.5
+    time.sleep(2)
+    fn = filename(config, 'test_logs.conf')
+    assert_equals(os.popen('finitd %s logs' % fn).read(), 'before\nafter\n')
+    assert_equals(os.popen('finitd %s logs --since=%s' % (fn, middle)).read(),
+                  'after\n')
+    assert_equals(os.popen('finitd %s logs --until=%s' % (fn, middle)).read(),
+                  'before\n')
+
+def test_logs_unindexed():
+    config = runCommand('echo output')
+    fn = filename(config, 'test_logs_unindexed.conf')
+    (_, stdout, stderr) = os.popen3('finitd %s logs --until=0' % fn)
+    assert_equals(stdout.read(), 'output\n')
+    assert 'has no index' in stderr.read()
+
+def test_limits():
+    config = getBasicConfig()
+    config.child.command.set("sh -c 'ulimit -n; ulimit -c'")
+    config.limits.nofile.set((123, 123))
+    config.limits.get('core').set((0, 0))
+    runConfig(config)
+    assert_stdout_equals(config, '123\n0\n')
+
+def test_limits_soft_above_hard():
+    config = getBasicConfig()
+    config.child.command.set('true')
+    config.limits.nofile.set((2048, 1024))
+    assert runConfig(config), 'start should refuse the configuration'
+    assert not os.path.exists(pidfile(config))
+
+def test_scheduling():
+    config = getBasicConfig()
+    config.child.command.set(
+        "sh -c 'grep Cpus_allowed_list /proc/self/status; cat /proc/self/stat'")
+    config.child.affinity.set([0])
+    config.child.nice.set(5)
+    config.child.ionice.set('idle')
+    config.child.scheduler.set('batch')
+    runConfig(config)
+    (affinity, stat) = content(stdout(config)).splitlines()
+    assert_equals(affinity.split(), ['Cpus_allowed_list:', '0'])
+    stat = stat[stat.rindex(')')+2:].split()
+    assert_equals(stat[16], '5') # Field 19: nice.
+    assert_equals(stat[38], '3') # Field 41: policy (SCHED_BATCH).
+
 def test_basic_restart():
     config = getBasicConfig()
     config.child.command.set('sleep 10')
@@ -230,8 +438,378 @@ def test_basic_appends_stdout_stderr():
     config.child.command.set('echo 2')
     runConfig(config)
     assert_stdout_equals(config, '1\n2\n')
-    
 
+def test_control_socket():
+    config = getBasicConfig()
+    config.child.command.set('sleep 10')
+    config.watcher.socket.set('socket')
+    runConfig(config)
+    time.sleep(1) # Time to start
+    pid = assert_pidfile(pidfile(config))
+    path = filename(config, 'socket')
+    reply = finitd.control.request(path, 'status')
+    assert_equals(reply['pid'], pid)
+    assert_equals(reply['restarts'], 0)
+    reply = finitd.control.request(path, 'restart')
+    assert_not_equals(reply['pid'], pid)
+    assert_equals(reply['restarts'], 1)
+    assert 'error' in finitd.control.request(path, 'bogus')
+    runConfig(config, finitd_command='stop --wait=5')
+    assert not os.path.exists(path), 'socket was not removed'
+    assert not os.path.exists('/proc/%s' % reply['pid']), 'process is still running'
+
+def test_control_socket_slow_client():
+    class Watcher(object):
+        def state(self):
+            return {'padding': 'x' * (1 << 22)} # More than the socket can buffer.
+    path = os.path.join(base_dir, 'slow.socket')
+    loop = finitd.eventloop.EventLoop()
+    server = finitd.control.ControlServer(Watcher(), path, loop)
+    server.listen()
+    client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        client.connect(path)
+        client.sendall('status\n') # And never read the reply.
+        start = time.time()
+        loop.callLater(0.5, loop.stop)
+        loop.run()
+        assert time.time() - start < 0.9, 'the watcher waited for the client'
+        assert_equals(len(server.replies), 1)
+    finally:
+        server.close()
+        client.close()
+
+def test_metrics():
+    config = getBasicConfig()
+    config.child.command.set('sleep 10')
+    config.watcher.socket.set('socket')
+    config.watcher.metrics.file.set('metrics.prom')
+    runConfig(config)
+    time.sleep(1) # Time to start
+    metrics = content(filename(config, 'metrics.prom'))
+    assert 'finitd_up{service="pid"} 1\n' in metrics, metrics
+    assert 'finitd_resident_memory_bytes{service="pid"} ' in metrics, metrics
+    reply = finitd.control.request(filename(config, 'socket'), 'metrics')
+    assert 'finitd_cpu_seconds_total{service="pid",mode="user"} ' in reply['metrics']
+    runConfig(config, finitd_command='stop --wait=5')
+    assert not os.path.exists(filename(config, 'metrics.prom')), \
+           'metrics file was not removed'
+
+def test_sockets():
+    config = getBasicConfig()
+    config.child.command.set("sh -c 'echo $$ $LISTEN_PID $LISTEN_FDS $LISTEN_FDNAMES; "
+                             "readlink /proc/self/fd/3; exec sleep 10'")
+    config.sockets.get('control').listen.set('unix:listener')
+    runConfig(config)
+    time.sleep(0.5)
+    (pids, link) = content(stdout(config)).splitlines()
+    (pid, listenPid, fds, names) = pids.split()
+    assert_equals(pid, listenPid)
+    assert_equals((fds, names), ('1', 'control'))
+    assert link.startswith('socket:'), link
+    sock = socket.socket(socket.AF_UNIX)
+    sock.connect(filename(config, 'listener'))
+    sock.close()
+    runConfig(config, finitd_command='stop --wait=5')
+    time.sleep(0.5)
+    assert not os.path.exists(filename(config, 'listener')), 'socket was not removed'
+
+def assert_reloads(config):
+    config.child.command.set('sleep 30')
+    config.watcher.reload.wait.set(1)
+    runConfig(config)
+    oldPid = assert_pidfile(pidfile(config))
+    runConfig(config, finitd_command='reload')
+    newPid = assert_pidfile(pidfile(config))
+    assert_not_equals(oldPid, newPid)
+    time.sleep(0.5) # Time for the old process to be stopped.
+    assert not finitd.util.checkProcessAlive(oldPid), 'old process is still running'
+    runConfig(config, finitd_command='stop --wait=5')
+    assert not finitd.util.checkProcessAlive(newPid), 'new process is still running'
+
+def test_reload():
+    config = getBasicConfig()
+    config.watcher.socket.set('socket')
+    assert_reloads(config)
+
+def test_reload_sighup():
+    assert_reloads(getBasicConfig())
+
+def readyOnOutput(config):
+    config.child.command.set("sh -c 'sleep 1; echo ready; exec sleep 30'")
+    config.log.pipe.set(True)
+    config.watcher.ready.set('output')
+    config.watcher.ready.output.set('^ready$')
+
+def test_wait_ready():
+    config = getBasicConfig()
+    readyOnOutput(config)
+    started = time.time()
+    assert_equals(runConfig(config, finitd_command='start --wait-ready=10'), 0)
+    assert time.time() - started >= 1, 'start returned before the process was ready'
+    assert_pidfile(pidfile(config))
+    runConfig(config, finitd_command='stop --wait=5')
+
+def test_wait_ready_failure():
+    config = getBasicConfig()
+    config.child.command.set("sh -c 'exit 3'")
+    config.watcher.ready.set('notify')
+    assert_not_equals(runConfig(config, finitd_command='start --wait-ready=10'), 0)
+
+def test_wait_ready_timeout():
+    config = getBasicConfig()
+    config.child.command.set('sleep 10')
+    config.watcher.ready.set('notify')
+    started = time.time()
+    assert_not_equals(runConfig(config, finitd_command='start --wait-ready=1'), 0)
+    assert time.time() - started < 5, 'start waited too long'
+    runConfig(config, finitd_command='stop --wait=5')
+
+def test_reload_ready():
+    config = getBasicConfig()
+    config.watcher.socket.set('socket')
+    readyOnOutput(config)
+    runConfig(config, finitd_command='start --wait-ready=10')
+    oldPid = assert_pidfile(pidfile(config))
+    started = time.time()
+    runConfig(config, finitd_command='reload')
+    assert time.time() - started >= 1, 'reload returned before the process was ready'
+    newPid = assert_pidfile(pidfile(config))
+    assert_not_equals(oldPid, newPid)
+    time.sleep(0.5) # Time for the old process to be stopped.
+    assert not finitd.util.checkProcessAlive(oldPid), 'old process is still running'
+    runConfig(config, finitd_command='stop --wait=5')
+
+def test_argv():
+    config = getBasicConfig()
+    config.child.argv.setFromString('''sh -c 'echo "$0|$1"' 'a  b' $HOME''')
+    runConfig(config)
+    assert_stdout_equals(config, 'a  b|$HOME\n')
+
+def test_simpleArgv():
+    assert_equals(finitd.commands.simpleArgv(' sleep  10 --x=y '),
+                  ['sleep', '10', '--x=y'])
+    for command in ['FOO=bar sleep 10', 'echo $HOME', "echo 'a b'", 'ls *',
+                    'echo a > b', 'sleep 1; sleep 2', 'echo ~']:
+        assert_equals(finitd.commands.simpleArgv(command), None)
+
+def test_health():
+    config = getBasicConfig()
+    config.child.command.set('sleep 30')
+    config.watcher.restart.set(True)
+    config.watcher.health.set('connect')
+    config.watcher.health.address.set('unix:nothing')
+    config.watcher.health.interval.set(0.5)
+    config.watcher.health.failures.set(2)
+    runConfig(config)
+    oldPid = assert_pidfile(pidfile(config))
+    time.sleep(2)
+    newPid = assert_pidfile(pidfile(config))
+    assert_not_equals(oldPid, newPid)
+    assert not finitd.util.checkProcessAlive(oldPid), 'old process is still running'
+    runConfig(config, finitd_command='stop --wait=5')
+
+def test_health_http():
+    config = getBasicConfig()
+    config.child.command.set('%s -m SimpleHTTPServer 18766' % sys.executable)
+    config.watcher.restart.set(True)
+    config.watcher.health.set('http')
+    config.watcher.health.address.set('127.0.0.1:18766')
+    config.watcher.health.interval.set(0.5)
+    config.watcher.health.failures.set(2)
+    runConfig(config)
+    pid = assert_pidfile(pidfile(config))
+    time.sleep(2)
+    assert_equals(assert_pidfile(pidfile(config)), pid)
+    assert 'GET / HTTP/1.0' in content(stderr(config))
+    runConfig(config, finitd_command='stop --wait=5')
+
+def test_all():
+    filenames = []
+    for name in ['all1', 'all2']:
+        config = getBasicConfig(caller=name)
+        config.child.command.set('echo %s' % name)
+        fn = filename(config, 'finitd.conf')
+        fp = open(fn, 'w')
+        config.writefp(fp, annotate=False)
+        fp.close()
+        filenames.append(fn)
+    fp = os.popen('finitd --all %s start' % ' '.join(filenames))
+    output = fp.read()
+    assert_equals(fp.close(), None) # i.e., exit status 0
+    for fn in filenames:
+        assert fn in output, 'Missing result for %r in %r' % (fn, output)
+    time.sleep(0.2) # Let the watchers run their children.
+    assert_equals(content(os.path.join(base_dir, 'all1', 'stdout')), 'all1\n')
+    assert_equals(content(os.path.join(base_dir, 'all2', 'stdout')), 'all2\n')
+    fp = os.popen('finitd --all %s status' % ' '.join(filenames))
+    assert 'Process is not running.' in fp.read()
+    assert_not_equals(fp.close(), None)
+
+def writeServices(services):
+    """Writes a configuration file for each (name, command, requires) in services into
+    a directory of their own, returning the filenames."""
+    directory = os.path.join(base_dir, callerName())
+    os.mkdir(directory)
+    filenames = []
+    for (name, command, requires) in services:
+        config = resetConfig(finitd.conf.config)
+        config.child.chdir.set(directory)
+        config.child.command.set(command)
+        config.child.requires.set(requires)
+        config.options.pidfile.set(name + '.pid')
+        config.watcher.pidfile.set(name + '.pid.watcher')
+        fn = os.path.join(directory, name + '.conf')
+        fp = open(fn, 'w')
+        config.writefp(fp, annotate=False)
+        fp.close()
+        filenames.append(fn)
+    return filenames
+
+def test_all_requires():
+    filenames = writeServices([('a', 'sleep 10', ['b']),
+                              ('b', 'sleep 10', [])])
+    fp = os.popen('finitd --all %s start' % ' '.join(filenames))
+    fp.read()
+    assert_equals(fp.close(), None)
+    fp = os.popen('finitd --all %s stop --wait=5' % ' '.join(filenames))
+    fp.read()
+    assert_equals(fp.close(), None)
+
+def test_all_requires_cycle():
+    filenames = writeServices([('a', 'sleep 10', ['b']),
+                              ('b', 'sleep 10', ['a'])])
+    fp = os.popen('finitd --all %s start 2>&1' % ' '.join(filenames))
+    output = fp.read()
+    assert_not_equals(fp.close(), None)
+    assert 'Dependency cycle' in output, output
+    assert not os.path.exists(filenames[0][:-len('.conf')] + '.pid')
+
+def test_supervise():
+    config = getBasicConfig()
+    config.child.command.set('sleep 10')
+    directory = filename(config, 'finitd.d')
+    os.mkdir(directory)
+    fp = open(os.path.join(directory, 'sleep.conf'), 'w')
+    config.writefp(fp, annotate=False)
+    fp.close()
+    os.system('finitd --supervise %s' % directory)
+    time.sleep(1) # Time to start
+    pid = assert_pidfile(pidfile(config))
+    supervisorPid = assert_pidfile(filename(config, config.watcher.pidfile()))
+    try:
+        runConfig(config, finitd_command='stop --wait=5', caller='sleep')
+        time.sleep(0.5) # Give the supervisor time to notice.
+        assert not os.path.exists('/proc/%s' % pid), '/proc/%s still exists' % pid
+        assert not os.path.exists(pidfile(config)), 'pidfile was not removed'
+        assert os.path.exists('/proc/%s' % supervisorPid), 'supervisor exited'
+    finally:
+        os.kill(supervisorPid, signal.SIGTERM)
+
+def test_status_imports():
+    config = getBasicConfig()
+    config.child.command.set('sleep 10')
+    fn = filename(config, 'test_status_imports.conf')
+    config.writefp(open(fn, 'w'), annotate=False)
+    script = filename(config, 'modules.py')
+    fp = open(script, 'w')
+    fp.write('import sys\n'
+             'sys.argv = ["finitd", %r, "status"]\n'
+             'from finitd import main\n'
+             'try:\n    main.main()\nexcept SystemExit:\n    pass\n'
+             'print " ".join(sorted(sys.modules))\n' % fn)
+    fp.close()
+    modules = os.popen('%s %s' % (sys.executable, script)).read().split()
+    assert 'finitd.commands' in modules, modules
+    for module in ['ctypes', 'json', 'hashlib', 'resource', 'pwd', 'grp']:
+        assert module not in modules, '%s was imported' % module
+
+def test_status_all():
+    config = getBasicConfig()
+    config.child.command.set('sleep 10')
+    config.watcher.table.set(os.path.join(base_dir, 'table'))
+    runConfig(config)
+    time.sleep(0.5)
+    try:
+        pid = assert_pidfile(pidfile(config))
+        lines = os.popen('finitd --status-all %s' % config.watcher.table()).readlines()
+        assert_equals(lines[0].split()[:3], ['SERVICE', 'STATE', 'PID'])
+        assert_equals(lines[1].split()[:3], ['pid', 'ready', str(pid)])
+    finally:
+        runConfig(config, 'stop')
+    lines = os.popen('finitd --status-all %s' % config.watcher.table()).readlines()
+    assert_equals(len(lines), 1)
+
+def writeService(config, name, loop=None):
+    # A fresh configuration, free of the groups earlier tests registered.
+    fn = filename(config, name + '.conf')
+    fp = open(fn, 'w')
+    config.writefp(fp, annotate=False)
+    fp.close()
+    return finitd.service.Service.fromFile(fn, loop)
+
+def test_service_environment():
+    config = getBasicConfig()
+    config.child.command.set('sleep 1')
+    os.environ['FINITD_CHILD_COMMAND'] = 'sleep 2'
+    try:
+        service = writeService(config, 'service')
+    finally:
+        del os.environ['FINITD_CHILD_COMMAND']
+    assert_equals(service.config.child.command(), 'sleep 2')
+
+def test_service():
+    config = getBasicConfig()
+    config.child.command.set('sleep 10')
+    config.watcher.socket.set('socket')
+    service = writeService(config, 'service')
+    result = service.start()
+    try:
+        assert result.ok, result.output
+        assert result.running and result.ready, result.state
+        assert_equals(service.status().pid, result.pid)
+        assert service.waitReady(timeout=1).ok
+    finally:
+        result = service.stop(timeout=5)
+    assert result.ok, result.output
+    assert not result.running
+    assert_equals(service.status().status, 1)
+    result = service.stop()
+    assert_equals(result.status, 1)
+    assert_equals(result.output, 'Process is not running.\n')
+
+def test_service_async():
+    loop = finitd.eventloop.EventLoop()
+    services = []
+    for name in ['a', 'b']:
+        config = getBasicConfig('test_service_async_' + name)
+        config.child.command.set('sleep 10')
+        config.watcher.socket.set('socket')
+        services.append(writeService(config, name, loop))
+    def runAll(operation):
+        results = []
+        def done(result):
+            results.append(result)
+            if len(results) == len(services):
+                loop.stop()
+        for service in services:
+            getattr(service, operation)(done)
+        timer = loop.callLater(10, loop.stop)
+        loop.run()
+        timer.cancel()
+        return results
+    try:
+        results = runAll('startAsync')
+        assert_equals([result.ok for result in results], [True, True])
+        assert_equals(len(set([result.pid for result in results])), 2)
+        results = runAll('statusAsync')
+        assert_equals([result.running for result in results], [True, True])
+        results = runAll('stopAsync')
+        assert_equals([result.running for result in results], [False, False])
+    finally:
+        signal.signal(signal.SIGCHLD, signal.SIG_DFL)
+        for service in services:
+            service.stop()
 
 # Pretty sure there's no design change we can do to make this work.
 #def test_basic_with_conjunction():
@@ -0,0 +1,112 @@
+###
+# Copyright (c) 2009, Juju, Inc.
+# All rights reserved.
+# 
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are
+# met:
+# 
+#     * Redistributions of source code must retain the above copyright
+#       notice, this list of conditions and the following disclaimer. 
+#     * Redistributions in binary form must reproduce the above
+#       copyright notice, this list of conditions and the following
+#       disclaimer in the documentation and/or other materials provided
+#       with the distribution.
+#     * Neither the name of the author of this software nor the names of
+#       the contributors to the software may be used to endorse or
+#       promote products derived from this software without specific
+#       prior written permission. 
+# 
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS
+# "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT
+# LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR
+# A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT
+# HOLDER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL,
+# SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT
+# LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE,
+# DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY
+# THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+# OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE. 
+###
+
+
+import os
+import time
+import tempfile
+from StringIO import StringIO
+
+import finitd.conf
+from finitd import logfile
+from finitd.eventloop import EventLoop
+from finitd.test import *
+
+def writeBuffered(policy, chunks):
+    """Writes the given chunks to a BufferedLogFile whose writer is held up until
+    they've all been buffered, returning what ends up in the file."""
+    config = finitd.conf.makeConfig()
+    config.log.buffer.set(10)
+    config.log.buffer.full.set(policy)
+    (fd, path) = tempfile.mkstemp()
+    os.close(fd)
+    logs = []
+    output = logfile.BufferedLogFile(path, config, EventLoop(), logs.append)
+    output.cond.acquire() # The writer waits for this, too.
+    try:
+        for chunk in chunks:
+            output.write(chunk)
+    finally:
+        output.cond.release()
+    output.close()
+    assert_equals(logs, [])
+    s = open(path).read()
+    os.remove(path)
+    return s
+
+def test_drop_newest():
+    assert_equals(writeBuffered('drop-newest', ['aaaa\n', 'bbbb\n', 'cccc\n']),
+                  'aaaa\nbbbb\nfinitd: dropped 5 bytes (1 lines) of output '
+                  'while the log was unwritable\n')
+
+def test_drop_oldest():
+    assert_equals(writeBuffered('drop-oldest', ['aaaa\n', 'bbbb\n', 'cccc\n']),
+                  'bbbb\ncccc\nfinitd: dropped 5 bytes (1 lines) of output '
+                  'while the log was unwritable\n')
+
+def test_block():
+    assert_equals(writeBuffered('block', ['aaaa\n', 'bbbb\n', 'cccc\n']),
+                  'aaaa\nbbbb\ncccc\n')
+
+def test_index():
+    config = finitd.conf.makeConfig()
+    config.log.index.set(10)
+    (fd, path) = tempfile.mkstemp()
+    os.close(fd)
+    output = logfile.LogFile(path, config, EventLoop(), None)
+    realTime = time.time
+    now = realTime()
+    try:
+        for (when, line) in [(now, 'one\n'), (now + 5, 'two\n'),
+                             (now + 10, 'three\n'), (now + 20, 'four\n')]:
+            time.time = lambda: when
+            output.write(line)
+    finally:
+        time.time = realTime
+    output.close()
+    index = logfile.Index(logfile.indexPath(path))
+    assert_equals([index.entry(i) for i in range(len(index))],
+                  [(now, 0), (now + 10, 8), (now + 20, 14)])
+    out = StringIO()
+    logfile.read(path, out, since=now + 12).close()
+    assert_equals(out.getvalue(), 'three\nfour\n')
+    out = StringIO()
+    logfile.read(path, out, since=now + 31).close()
+    assert_equals(out.getvalue(), 'four\n')
+    out = StringIO()
+    logfile.read(path, out, since=now + 31, interval=10).close()
+    assert_equals(out.getvalue(), '')
+    out = StringIO()
+    logfile.read(path, out, until=now + 5).close()
+    assert_equals(out.getvalue(), 'one\ntwo\n')
+    os.remove(path)
+    os.remove(logfile.indexPath(path))
@@ -0,0 +1,119 @@
+###
+# Copyright (c) 2009, Juju, Inc.
+# All rights reserved.
+# 
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are
+# met:
+# 
+#     * Redistributions of source code must retain the above copyright
+#       notice, this list of conditions and the following disclaimer. 
+#     * Redistributions in binary form must reproduce the above
+#       copyright notice, this list of conditions and the following
+#       disclaimer in the documentation and/or other materials provided
+#       with the distribution.
+#     * Neither the name of the author of this software nor the names of
+#       the contributors to the software may be used to endorse or
+#       promote products derived from this software without specific
+#       prior written permission. 
+# 
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS
+# "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT
+# LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR
+# A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT
+# HOLDER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL,
+# SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT
+# LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE,
+# DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY
+# THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+# OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE. 
+###
+
+
+import os
+import signal
+import tempfile
+
+import finitd.conf
+from finitd.policy import RestartPolicy
+from finitd.history import History
+from finitd.test import *
+
+def exited(status):
+    return status << 8
+
+def makePolicy(**values):
+    config = finitd.conf.makeConfig()
+    config.watcher.restart.set(True)
+    config.watcher.restart.wait.set(0)
+    config.watcher.restart.backoff.jitter.set(0)
+    for (name, value) in values.items():
+        group = config.watcher.restart
+        for part in name.split('_'):
+            group = group.get(part)
+        group.set(value)
+    return RestartPolicy(config, random=lambda: 1.0)
+
+def test_backoff():
+    policy = makePolicy(backoff=1.0, backoff_max=5.0)
+    delays = [policy.restartDelay(exited(1), 100, now=101) for _ in range(5)]
+    assert_equals(delays, [1, 2, 4, 5, 5])
+
+def test_stable_resets_backoff():
+    policy = makePolicy(stable=10)
+    policy.restartDelay(exited(1), 100, now=101)
+    assert_equals(policy.restartDelay(exited(1), 100, now=101), 2)
+    assert_equals(policy.restartDelay(exited(1), 100, now=200), 1)
+
+def test_wait_is_minimum_spacing():
+    policy = makePolicy(wait=30)
+    assert_equals(policy.restartDelay(exited(1), 100, now=110), 20)
+
+def test_jitter():
+    policy = makePolicy(backoff=10.0, backoff_jitter=0.5)
+    policy.random = lambda: 1.0
+    assert_equals(policy.restartDelay(exited(1), 100, now=101), 5)
+    policy.random = lambda: 0.0
+    assert_equals(policy.restartDelay(exited(1), 100, now=101), 20)
+
+def test_retries():
+    policy = makePolicy(retries=2)
+    assert policy.restartDelay(exited(1), 100, now=101) is not None
+    assert policy.restartDelay(exited(1), 100, now=101) is not None
+    assert policy.restartDelay(exited(1), 100, now=101) is None
+
+def test_status_rules():
+    policy = makePolicy()
+    assert policy.restartDelay(exited(0), 100, now=101) is None
+    assert policy.restartDelay(signal.SIGSEGV, 100, now=101) is not None
+    policy = makePolicy(on=['0', 'SIGSEGV'], ignore=['SIGTERM'])
+    assert policy.restartDelay(exited(0), 100, now=101) is not None
+    assert policy.restartDelay(exited(1), 100, now=101) is None
+    assert policy.restartDelay(signal.SIGSEGV, 100, now=101) is not None
+    assert policy.restartDelay(signal.SIGTERM, 100, now=101) is None
+
+def test_breaker():
+    config = finitd.conf.makeConfig()
+    config.watcher.restart.breaker.set(3)
+    config.watcher.restart.breaker.window.set(60)
+    config.watcher.restart.breaker.cooldown.set(30)
+    (fd, filename) = tempfile.mkstemp()
+    os.close(fd)
+    os.remove(filename)
+    config.watcher.history.set(filename)
+    try:
+        history = History(config, log=lambda s: None)
+        assert_equals([history.crashed(now=t) for t in (100, 150, 170)],
+                      [False, False, False]) # The first has left the window.
+        assert history.crashed(now=175)
+        assert_equals(history.cooldown(now=180), 25)
+        # Another watcher carries on where this one left off.
+        history = History(config, log=lambda s: None)
+        assert_equals(history.recentCrashes(now=175), 3)
+        assert history.crashed(now=210) # Crashing again before it's stable.
+        history.exited(210, now=300)
+        assert_equals(history.tripped, None)
+        assert not history.crashed(now=400)
+    finally:
+        os.remove(filename)
@@ -0,0 +1,68 @@
+###
+# Copyright (c) 2009, Juju, Inc.
+# All rights reserved.
+# 
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are
+# met:
+# 
+#     * Redistributions of source code must retain the above copyright
+#       notice, this list of conditions and the following disclaimer. 
+#     * Redistributions in binary form must reproduce the above
+#       copyright notice, this list of conditions and the following
+#       disclaimer in the documentation and/or other materials provided
+#       with the distribution.
+#     * Neither the name of the author of this software nor the names of
+#       the contributors to the software may be used to endorse or
+#       promote products derived from this software without specific
+#       prior written permission. 
+# 
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS
+# "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT
+# LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR
+# A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT
+# HOLDER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL,
+# SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT
+# LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE,
+# DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY
+# THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+# OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE. 
+###
+
+
+import os
+import shutil
+import tempfile
+
+from finitd import table
+from finitd.test import *
+
+def test_table():
+    directory = tempfile.mkdtemp()
+    try:
+        path = os.path.join(directory, 'table')
+        writer = table.Table(path, slots=2)
+        (first, second) = (writer.claim(), writer.claim())
+        assert writer.claim() is None, 'a full table had a free slot'
+        first.write(os.getpid(), 1234, 2, 256, table.READY, 100.0, 0, 'web')
+        reader = table.Table(path, create=False)
+        assert_equals(reader.read(0), (os.getpid(), 1234, 2, 256, table.READY, 100.0,
+                                       0, 'web'))
+        states = reader.snapshot()
+        assert_equals([(state['name'], state['pid'], state['status'], state['ready'])
+                       for state in states], [('web', 1234, 256, True), ('', None,
+                                                                         None, False)])
+        first.release()
+        assert_equals(len(reader.snapshot()), 1)
+        third = writer.claim()
+        assert third is not None, 'a released slot was not reused'
+        third.release()
+        # A slot whose watcher has exited is free, too.
+        second.write(2 ** 22 + 1, 0, 0, -1, 0, 0, 0, 'gone')
+        assert_equals(reader.snapshot(), [])
+        assert writer.claim() is not None, "a dead watcher's slot was not reused"
+        reader.close()
+        writer.close()
+    finally:
+        shutil.rmtree(directory)
@@ -31,6 +31,7 @@
 ###
 
 import os
+import time
 import tempfile
 
 from finitd import util
@@ -44,9 +45,39 @@ def test_checkProcessAlive():
     os.waitpid(pid, 0) # Wait for the child to exit.
     assert not util.checkProcessAlive(pid)
 
+def test_waitForExit():
+    pid = os.fork()
+    if not pid:
+        time.sleep(0.2)
+        os._exit(0)
+    start = time.time()
+    assert not util.waitForExit(pid, 0.01), 'Child should still be alive.'
+    assert util.waitForExit(pid, 5), 'Child should have exited.'
+    assert time.time() - start < 2, 'waitForExit waited too long.'
+    os.waitpid(pid, 0)
+
 def test_getPidFromFile():
     fp = tempfile.NamedTemporaryFile(delete=False)
     fp.write('123\n')
     fp.close()
     assert_equals(util.getPidFromFile(fp.name), 123)
     os.remove(fp.name)
+
+def test_pidfileIdentity():
+    (fd, pidfile) = tempfile.mkstemp()
+    os.close(fd)
+    util.writePidfile(pidfile, os.getpid())
+    (pid, identity) = util.readPidfile(pidfile)
+    assert_equals(pid, os.getpid())
+    assert util.checkProcessAlive(pid, identity)
+    assert_equals(util.checkPidfiles([pidfile]), {pidfile: os.getpid()})
+    # A process started at a different time is some other process, reusing the pid.
+    identity['start'] -= 1
+    util.writePidfile(pidfile, os.getpid(), identity)
+    assert not util.checkProcessAlive(pid, identity)
+    assert_equals(util.getPidFromFile(pidfile), None)
+    assert_equals(util.checkPidfiles([pidfile]), {pidfile: 0})
+    # The pidfile itself is just the pid, for `kill $(cat pidfile)`.
+    assert_equals(open(pidfile).read(), '%s\n' % os.getpid())
+    util.removePidfile(pidfile)
+    assert not os.path.exists(util.identityPath(pidfile))
@@ -32,14 +32,37 @@
 
 import os
 import sys
+import time
+import fcntl
 import errno
+import select
+import signal
 import syslog
 
+def parseSignal(s):
+    """Returns the number of the signal given by name (e.g., TERM or SIGTERM) or
+    number."""
+    if s.isdigit():
+        return int(s)
+    name = s.upper()
+    if not name.startswith('SIG'):
+        name = 'SIG' + name
+    if name.startswith('SIG_') or not hasattr(signal, name):
+        raise ValueError('Invalid signal: %r' % s)
+    return getattr(signal, name)
+
 def error(msg, code=-1):
     sys.stderr.write(msg.strip())
     sys.stderr.write('\n')
     sys.exit(code)
 
+syslogIdent = None # The ident given to openlog.
+
+def openlog(ident):
+    global syslogIdent
+    syslogIdent = ident
+    syslog.openlog(ident)
+
 class SyslogFile(object):
     def __init__(self, level=syslog.LOG_INFO):
         self.level = level
@@ -57,23 +80,292 @@ for s in dir(syslog):
     if s.startswith('LOG_'):
         setattr(SyslogFile, s, getattr(syslog, s))
 
-def getPidFromFile(pidfile):
-    if not os.path.exists(pidfile):
-        return None
+def identityPath(pidfile):
+    """Returns the name of the file next to the given pidfile which identifies its
+    process.  The pidfile itself holds nothing but the pid, so that the likes of
+    `kill $(cat pidfile)` keep working."""
+    return pidfile + '.identity'
+
+def readLines(filename):
+    """Returns the lines of the given file, or None if it doesn't exist."""
     try:
-        fp = open(pidfile)
+        fp = open(filename)
     except EnvironmentError, e:
-        error('Cannot open pidfile %r: %s' % (pidfile, e))
-    pid = int(fp.read())
-    fp.close()
+        if e.errno == errno.ENOENT:
+            return None
+        error('Cannot open %r: %s' % (filename, e))
+    try:
+        return fp.read().splitlines()
+    finally:
+        fp.close()
+
+def readPidfile(pidfile):
+    """Returns (pid, identity) from the given pidfile, or (None, None) if it doesn't
+    exist.  The identity is read from the pidfile's identity file, whose first line
+    is the pid too and each following line a 'key value' pair written by
+    writePidfile; it's empty if that file is missing or is for some other pid."""
+    lines = readLines(pidfile)
+    if not lines or not lines[0].strip():
+        return (None, None)
+    pid = int(lines[0])
+    if len(lines) == 1: # (Older pidfiles included the identity themselves.)
+        lines = readLines(identityPath(pidfile))
+        if not lines or lines[0].strip() != str(pid):
+            return (pid, {})
+    identity = {}
+    for line in lines[1:]:
+        (key, _, value) = line.partition(' ')
+        if key == 'start':
+            identity[key] = int(value)
+        elif key:
+            identity[key] = value
+    return (pid, identity)
+
+def writeFile(filename, s):
+    # Write and rename, so no one ever reads a partially written file.
+    tmp = '%s.%s.tmp' % (filename, os.getpid())
+    fp = open(tmp, 'w')
+    try:
+        fp.write(s)
+    finally:
+        fp.close()
+    os.rename(tmp, filename)
+
+def writePidfile(pidfile, pid, identity=None):
+    """Writes the given pid to the given pidfile, and the identity of the process
+    (as returned by processIdentity) to its identity file."""
+    if identity is None:
+        identity = processIdentity(pid)
+    lines = ['%s' % pid]
+    for key in ['start', 'boot', 'exe']:
+        if key in identity:
+            lines.append('%s %s' % (key, identity[key]))
+    # The identity first, so whoever reads the new pid finds its identity.
+    writeFile(identityPath(pidfile), '\n'.join(lines) + '\n')
+    writeFile(pidfile, '%s\n' % pid)
+
+def removePidfile(pidfile):
+    """Removes the given pidfile and its identity file."""
+    os.remove(pidfile)
+    try:
+        os.remove(identityPath(pidfile))
+    except OSError, e:
+        if e.errno != errno.ENOENT:
+            raise
+
+def getPidFromFile(pidfile):
+    (pid, identity) = readPidfile(pidfile)
+    if pid and identity and not checkIdentity(pid, identity):
+        return None # The pidfile is stale and the pid has been reused.
     return pid
 
-def checkProcessAlive(pid):
+def checkProcessAlive(pid, identity=None):
     try:
         os.kill(pid, 0)
-        return pid
     except OSError, e:
         if e.errno == errno.ESRCH: # No such process.
             return 0
-        else:
-            return pid # XXX Should do more checking, based on config.
+        # (EPERM: it exists, but isn't ours to signal.)
+    stat = readStat(pid)
+    if stat and stat[0] == 'Z':
+        return 0 # It's exited; its parent just hasn't noticed yet.
+    if identity and not checkIdentity(pid, identity):
+        return 0 # It's some other process which happens to have the same pid.
+    return pid
+
+def readStat(pid):
+    """Returns the fields of /proc/<pid>/stat following the command name (so the
+    process state is first), or None if they can't be read."""
+    try:
+        fp = open('/proc/%s/stat' % pid)
+    except EnvironmentError:
+        return None # No /proc, or no such process.
+    try:
+        stat = fp.read()
+    finally:
+        fp.close()
+    # The command name is parenthesized and might contain spaces or parentheses.
+    return stat[stat.rindex(')')+2:].split()
+
+_bootId = []
+def bootId():
+    if not _bootId:
+        try:
+            _bootId.append(open('/proc/sys/kernel/random/boot_id').read().strip())
+        except EnvironmentError:
+            _bootId.append(None)
+    return _bootId[0]
+
+def processIdentity(pid, stat=None):
+    """Returns a dictionary identifying the given process beyond its (reusable) pid:
+    its start time (in clock ticks since boot), the boot it started in, and its
+    executable, each only if it can be determined."""
+    identity = {}
+    if stat is None:
+        stat = readStat(pid)
+    if stat:
+        identity['start'] = int(stat[19]) # Field 22 of /proc/<pid>/stat.
+        if bootId():
+            identity['boot'] = bootId()
+    try:
+        identity['exe'] = os.readlink('/proc/%s/exe' % pid)
+    except OSError:
+        pass
+    return identity
+
+def checkIdentity(pid, identity, stat=None):
+    """Returns False if the given process is known not to be the one the given
+    identity was recorded for.  A process's start time identifies it uniquely within
+    a boot, so the executable is only compared when start times aren't available;
+    that comparison is weaker, since the shell finitd starts commands with execs the
+    command itself."""
+    current = processIdentity(pid, stat)
+    if identity.get('boot') and current.get('boot') and \
+       identity['boot'] != current['boot']:
+        return False
+    if 'start' in identity and 'start' in current:
+        return identity['start'] == current['start']
+    if 'exe' in identity and 'exe' in current:
+        return identity['exe'] == current['exe']
+    return True
+
+def checkPidfiles(pidfiles):
+    """Returns a dictionary mapping each of the given pidfiles to the pid of its live
+    process, or 0.  Rather than signalling each pid, the process table is read once
+    from /proc, and only the stat files of pids found there are read."""
+    results = {}
+    candidates = {}
+    for pidfile in pidfiles:
+        (pid, identity) = readPidfile(pidfile)
+        results[pidfile] = 0
+        if pid:
+            candidates[pidfile] = (pid, identity)
+    try:
+        live = set([int(name) for name in os.listdir('/proc') if name.isdigit()])
+    except OSError:
+        live = None # No /proc; fall back to signalling each pid.
+    for (pidfile, (pid, identity)) in candidates.items():
+        if live is None:
+            results[pidfile] = checkProcessAlive(pid, identity)
+        elif pid in live:
+            stat = readStat(pid)
+            if stat and stat[0] != 'Z' and \
+               (not identity or checkIdentity(pid, identity, stat)):
+                results[pidfile] = pid
+    return results
+
+def daemonize(parent=None, keep=()):
+    """Forks into the background (exiting the parent, with the status returned by
+    calling parent if it's given), starts a new session and closes all open file
+    descriptors but those in keep."""
+    pid = os.fork()
+    if pid:
+        if parent is None:
+            os._exit(0)
+        os._exit(parent())
+
+    # Set a new session id.
+    sid = os.setsid()
+    if sid == -1:
+        error('setsid failed') # So apparently errno isn't available to Python...
+    closeFds(keep)
+
+def closeFds(keep=()):
+    """Closes every open file descriptor but those in keep.  Those open are found in
+    /proc/self/fd if it's available, rather than trying every possible one up to
+    SC_OPEN_MAX, which can be in the millions."""
+    try:
+        fds = [int(fd) for fd in os.listdir('/proc/self/fd')]
+    except OSError:
+        fds = None
+    if fds is not None:
+        for fd in fds:
+            if fd not in keep:
+                try:
+                    os.close(fd)
+                except OSError:
+                    pass # The descriptor listdir used, now closed.
+        return
+    try:
+        # "Borrowed" from the subprocess module ;)
+        MAXFD = os.sysconf('SC_OPEN_MAX')
+    except:
+        MAXFD = 256
+    import compat # For os.closerange on Python < 2.6.
+    fd = 0
+    for kept in sorted(keep):
+        os.closerange(fd, kept)
+        fd = kept + 1
+    os.closerange(fd, MAXFD)
+
+def setCloexec(fd):
+    flags = fcntl.fcntl(fd, fcntl.F_GETFD)
+    fcntl.fcntl(fd, fcntl.F_SETFD, flags | fcntl.FD_CLOEXEC)
+
+def clearCloexec(fd):
+    flags = fcntl.fcntl(fd, fcntl.F_GETFD)
+    fcntl.fcntl(fd, fcntl.F_SETFD, flags & ~fcntl.FD_CLOEXEC)
+
+def moveAbove(fd, minimum):
+    """Returns a close-on-exec duplicate of the given file descriptor numbered at
+    least minimum, closing the original."""
+    if fd >= minimum:
+        return fd
+    new = fcntl.fcntl(fd, fcntl.F_DUPFD, minimum)
+    os.close(fd)
+    setCloexec(new)
+    return new
+
+def setNonblocking(fd):
+    flags = fcntl.fcntl(fd, fcntl.F_GETFL)
+    fcntl.fcntl(fd, fcntl.F_SETFL, flags | os.O_NONBLOCK)
+
+def waitForExit(pid, timeout):
+    """Waits at most timeout seconds for the process with the given pid to exit,
+    returning as soon as it does.  Returns True if the process exited."""
+    import linux
+    until = time.time() + timeout
+    try:
+        fd = linux.pidfdOpen(pid)
+    except OSError, e:
+        if e.errno == errno.ESRCH: # No such process.
+            return True
+        fd = None
+    if fd is not None:
+        try:
+            poller = select.poll()
+            poller.register(fd, select.POLLIN)
+            while True:
+                remaining = until - time.time()
+                if remaining <= 0:
+                    return not checkProcessAlive(pid)
+                try:
+                    if poller.poll(int(remaining * 1000) + 1):
+                        return True
+                except select.error, e:
+                    if e.args[0] != errno.EINTR:
+                        raise
+        finally:
+            os.close(fd)
+    # No pidfds, so we poll, but starting with a short interval.
+    delay = 0.01
+    while checkProcessAlive(pid):
+        remaining = until - time.time()
+        if remaining <= 0:
+            return False
+        time.sleep(min(delay, remaining))
+        delay = min(delay * 2, 0.25)
+    return True
+
+def waitForRemoval(path, timeout):
+    """Waits at most timeout seconds for the given file to be removed.  Returns True if
+    it was."""
+    until = time.time() + timeout
+    delay = 0.01
+    while os.path.exists(path):
+        remaining = until - time.time()
+        if remaining <= 0:
+            return False
+        time.sleep(min(delay, remaining))
+        delay = min(delay * 2, 0.25)
+    return True
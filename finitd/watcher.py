@@ -0,0 +1,591 @@
+###
+# Copyright (c) 2009, Juju, Inc.
+# All rights reserved.
+# 
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are
+# met:
+# 
+#     * Redistributions of source code must retain the above copyright
+#       notice, this list of conditions and the following disclaimer. 
+#     * Redistributions in binary form must reproduce the above
+#       copyright notice, this list of conditions and the following
+#       disclaimer in the documentation and/or other materials provided
+#       with the distribution.
+#     * Neither the name of the author of this software nor the names of
+#       the contributors to the software may be used to endorse or
+#       promote products derived from this software without specific
+#       prior written permission. 
+# 
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS
+# "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT
+# LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR
+# A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT
+# HOLDER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL,
+# SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT
+# LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE,
+# DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY
+# THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+# OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE. 
+###
+
+import os
+import sys
+import time
+import signal
+import socket
+import util
+import metrics
+import logfile
+import sockets
+import readiness
+import table
+
+from health import HealthCheck
+from history import History
+from policy import RestartPolicy
+from control import ControlServer
+
+class Watcher(object):
+    """Spawns the child process configured for a start command and babysits it,
+    restarting it if so configured.  All the watcher's work is done from callbacks
+    on the given EventLoop.
+
+    A shared watcher is one of many in a single process (see finitd.supervisor), so
+    it leaves signal handling and the loop itself to its owner and sets up the
+    child's directory, root and stdio in the child rather than in the watcher."""
+    def __init__(self, command, environ, loop, name=None, shared=False):
+        self.command = command
+        self.config = command.config
+        self.environ = environ
+        self.loop = loop
+        self.name = name
+        self.shared = shared
+        self.pid = None
+        self.lastRestart = 0
+        self.restarts = -1 # spawn counts the first start, too.
+        self.lastStatus = None
+        self.stopping = False
+        self.restarting = False
+        self.restartCallbacks = []
+        self.restartTimer = None
+        self.candidate = None # A reload's new child, until it's ready.
+        self.reloadCallback = None
+        self.readyTimer = None
+        self.retiring = {} # {pid: Timer} of old children a reload is stopping.
+        self.checks = {} # {pid: readiness.Check} of children that aren't yet ready.
+        self.isReady = False
+        self.readyCallbacks = []
+        self.health = None
+        self.policy = RestartPolicy(self.config)
+        self.history = History(self.config, self.log)
+        self.tripped = None # When the tripped breaker lets the child be tried again.
+        self.exited = False
+        self.control = None
+        self.logPipes = None
+        self.listeners = []
+        self.metricsTimer = None
+        self.slot = None # Our table.Slot in finitd.watcher.table.
+        self.watcherPid = os.getpid()
+
+    def log(self, s):
+        if self.name:
+            print 'Watcher[%s %s]: %s' % (self.watcherPid, self.name, s)
+        else:
+            print 'Watcher[%s]: %s' % (self.watcherPid, s)
+
+    def start(self):
+        if not self.shared:
+            self.loop.handleSignal(signal.SIGUSR1, self.sigusr1)
+            self.loop.handleSignal(signal.SIGHUP, self.sighup)
+        else:
+            # A lone watcher's start command did this before it chrooted.
+            try:
+                self.command.createCgroup()
+            except EnvironmentError, e:
+                self.log('could not create cgroup %r: %s' %
+                         (self.config.limits.cgroup(), e))
+                self.exit()
+                return
+        if self.config.watcher.socket() and self.config.watcher.wait():
+            self.control = ControlServer(self, self.config.watcher.socket(), self.loop)
+            try:
+                self.control.listen()
+            except (socket.error, OSError), e:
+                self.log('could not listen on %r: %s' % (self.control.path, e))
+                self.control = None
+        try:
+            self.listeners = sockets.bindAll(self.config)
+        except (socket.error, OSError), e:
+            self.log('could not bind listening sockets: %s' % e)
+            self.exit()
+            return
+        if self.config.log.pipe():
+            self.logPipes = logfile.openPipes(self.config, self.loop, self.log)
+        if self.config.watcher.table():
+            try:
+                self.slot = table.claim(self.config.watcher.table())
+            except (EnvironmentError, ValueError), e:
+                self.log('could not open %r: %s' %
+                         (self.config.watcher.table(), e))
+            else:
+                if self.slot is None:
+                    self.log('%r is full' % self.config.watcher.table())
+        if self.config.watcher.health():
+            self.health = HealthCheck(self)
+        if self.history.tripped is not None:
+            self.log('restarts tripped at %s and have not been reset; starting the '
+                     'process once more' % time.ctime(self.history.tripped))
+        self.spawn()
+        if self.config.watcher.metrics.file() and not self.exited:
+            self.writeMetrics()
+
+    def state(self):
+        """Returns a dictionary describing the watcher and its child process."""
+        if self.pid is None:
+            uptime = None
+        else:
+            uptime = time.time() - self.lastRestart
+        return {
+            'name': self.name,
+            'pid': self.pid,
+            'watcher': self.watcherPid,
+            'uptime': uptime,
+            'restarts': max(self.restarts, 0),
+            'status': self.lastStatus,
+            'stopping': self.stopping,
+            'failures': self.policy.failures,
+            'reloading': self.candidate,
+            'ready': self.isReady,
+            'unhealthy': self.health and self.health.failures,
+            'crashes': self.history.recentCrashes(),
+            'tripped': self.tripped,
+        }
+
+    def publish(self):
+        """Publishes our state to finitd.watcher.table, if it's configured."""
+        if self.slot is not None:
+            self.slot.publish(self)
+
+    def writeMetrics(self):
+        filename = self.config.watcher.metrics.file()
+        try:
+            metrics.write(self, filename)
+        except EnvironmentError, e:
+            self.log('could not write metrics to %r: %s' % (filename, e))
+        self.metricsTimer = self.loop.callLater(self.config.watcher.metrics.interval(),
+                                                self.writeMetrics)
+
+    def prepareChild(self, check=None):
+        """Prepares this (child) process to execute the command, returning the
+        environment to execute it with."""
+        environ = self.environ
+        if self.listeners or check is not None:
+            environ = environ.copy()
+        output = None
+        if self.logPipes is not None:
+            output = [pipe.writer for pipe in self.logPipes]
+        if self.shared:
+            # Paths have already been made absolute, so the redirection files are
+            # opened from outside any chroot, just as a lone watcher would.
+            self.command.redirect(output)
+            self.command.chdir()
+            self.command.chroot()
+        elif output is not None:
+            self.command.redirect(output)
+        self.command.joinCgroup()
+        self.command.umask()
+        self.command.setrlimits()
+        self.command.schedule()
+        self.command.setgid()
+        self.command.setuid()
+        if self.listeners:
+            sockets.inherit(self.listeners, environ)
+        if check is not None:
+            check.prepare(environ)
+        return environ
+
+    def spawn(self):
+        self.cancelRestart()
+        self.tripped = None
+        self.lastRestart = time.time()
+        self.restarts += 1
+        self.history.started(self.lastRestart)
+        self.isReady = False
+        self.log('starting process')
+        pid = self.forkChild()
+        self.pid = pid
+        self.log('child process started at pid %s' % pid)
+        (callbacks, self.restartCallbacks) = (self.restartCallbacks, [])
+        for callback in callbacks:
+            callback()
+        self.command.writePidfile(pid)
+        if self.config.watcher.wait():
+            self.command.writePidfile(self.watcherPid, self.config.watcher.pidfile())
+            self.loop.watchChild(pid, self.childExited)
+            self.publish()
+        else:
+            if self.shared:
+                # We aren't babysitting, but we're still the child's parent, so
+                # something has to reap it.
+                self.loop.watchChild(pid, lambda pid, status: None)
+            self.exit()
+
+    def forkChild(self):
+        """Forks and executes a child process, returning its pid."""
+        # The write end of this pipe is closed by a successful exec, which is when
+        # the child's pidfile can record what it's running.
+        (execReader, execWriter) = os.pipe()
+        util.setCloexec(execReader)
+        util.setCloexec(execWriter)
+        if self.listeners:
+            # Keep it clear of the file descriptors the sockets are passed as.
+            execWriter = util.moveAbove(execWriter,
+                                        sockets.LISTEN_FDS_START + len(self.listeners))
+        check = readiness.check(self.config, self.loop, self.logPipes or ())
+        pid = os.fork() # This spawns what will become the actual child process.
+        if not pid:
+            # This is the child process, pre-exec.
+            try:
+                os.close(execReader)
+                environ = self.prepareChild(check)
+                # Now we're ready to actually spawn the process.
+                self.command.execute(environ)
+            except:
+                self.log('could not execute child process: %s' % sys.exc_info()[1])
+            try:
+                os.write(execWriter, '\0') # Tells the watcher the exec failed.
+            except OSError:
+                pass
+            os._exit(127)
+        os.close(execWriter)
+        self.loop.addReader(execReader, lambda fd: self.execed(fd, pid))
+        if check is not None:
+            self.checks[pid] = check
+            check.start(lambda: self.ready(pid))
+        return pid
+
+    def execed(self, fd, pid):
+        self.loop.removeReader(fd)
+        failed = os.read(fd, 1)
+        os.close(fd)
+        if failed or self.pid != pid:
+            return
+        if self.command.getPidFromFile() == pid:
+            # Rewrite the pidfile now that it can identify the command's executable
+            # rather than our own.
+            self.command.writePidfile(pid)
+        if pid not in self.checks:
+            self.becameReady()
+
+    def ready(self, pid):
+        """Called once the child process with the given pid is ready."""
+        self.cancelCheck(pid)
+        if pid == self.candidate:
+            self.log('new process at pid %s is ready' % pid)
+            self.promote()
+        elif pid == self.pid:
+            self.log('process at pid %s is ready' % pid)
+            self.becameReady()
+
+    def cancelCheck(self, pid):
+        check = self.checks.pop(pid, None)
+        if check is not None:
+            check.close()
+
+    def whenReady(self, callback):
+        """Calls callback with None once the child process is ready, or with an error
+        message if it exits (or the watcher does) before it's ready."""
+        if self.isReady:
+            callback(None)
+        else:
+            self.readyCallbacks.append(callback)
+
+    def becameReady(self):
+        self.isReady = True
+        if self.health is not None:
+            self.health.start()
+        self.publish()
+        self.notifyReady(None)
+
+    def notifyReady(self, error):
+        (callbacks, self.readyCallbacks) = (self.readyCallbacks, [])
+        for callback in callbacks:
+            callback(error)
+
+    def stopRequested(self):
+        """Returns whether `finitd stop` has asked us to stop babysitting, which it
+        does by removing our pidfile."""
+        watcherPidfile = self.config.watcher.pidfile()
+        if not (watcherPidfile and self.config.watcher.wait()):
+            return False
+        return self.command.getPidFromFile(watcherPidfile) != self.watcherPid
+
+    def childExited(self, pid, status):
+        self.cancelCheck(pid)
+        if pid in self.retiring:
+            self.retiring.pop(pid).cancel()
+            self.log('old process at pid %s exited with status %s' % (pid, status))
+            return
+        elif pid == self.candidate:
+            self.candidate = None
+            self.readyTimer.cancel()
+            self.log('new process at pid %s exited with status %s before it was '
+                     'ready' % (pid, status))
+            self.reloaded('New process exited with status %s before it was ready.' %
+                          status)
+            return
+        self.pid = None
+        self.lastStatus = status
+        self.log('process exited with status %s' % status)
+        self.history.exited(self.lastRestart)
+        if self.health is not None:
+            self.health.stop()
+        if not self.isReady:
+            self.notifyReady('Process exited with status %s before it was ready.' %
+                             status)
+        self.isReady = False
+        # Remove pidfile when child has exited.
+        self.command.removePidfile(pid=pid)
+        if self.candidate is not None and not (self.stopping or self.stopRequested()):
+            self.log('process exited during a reload, so the new process replaces '
+                     'it now')
+            self.promote()
+        elif self.restarting and not (self.stopping or self.stopRequested()):
+            self.restarting = False
+            self.spawn()
+        elif self.stopping or self.stopRequested():
+            self.exit()
+        elif not self.config.watcher.restart():
+            self.exit()
+        else:
+            delay = self.policy.restartDelay(status, self.lastRestart)
+            if delay is None:
+                self.log('%s, not restarting' % self.policy.reason)
+                self.exit()
+            elif self.history.crashed():
+                cooldown = self.history.cooldown()
+                self.tripped = time.time() + cooldown
+                self.log('process crashed %s times in the last %s seconds; restarts '
+                         'tripped, trying again in %.1f seconds' %
+                         (self.history.recentCrashes(),
+                          self.config.watcher.restart.breaker.window(), cooldown))
+                self.restartTimer = self.loop.callLater(cooldown, self.restartChild)
+            else:
+                self.log('restarting process in %.1f seconds' % delay)
+                self.restartTimer = self.loop.callLater(delay, self.restartChild)
+        self.publish()
+
+    def restartChild(self):
+        self.restartTimer = None
+        if self.stopping or self.stopRequested():
+            self.exit()
+        elif self.config.watcher.restart.command():
+            self.runRestartCommand(self.config.watcher.restart.command())
+        else:
+            self.spawn()
+
+    def cancelRestart(self):
+        if self.restartTimer is not None:
+            self.restartTimer.cancel()
+            self.restartTimer = None
+
+    def runRestartCommand(self, command):
+        self.log('running %r before restart' % command)
+        pid = os.fork()
+        if not pid:
+            try:
+                os.execl('/bin/sh', 'sh', '-c', command)
+            finally:
+                os._exit(127)
+        def restartCommandExited(pid, status):
+            if status:
+                self.log('%r exited with nonzero status %s, exiting' %
+                         (command, status))
+                self.exit()
+            elif self.stopping or self.stopRequested():
+                self.exit()
+            else:
+                self.spawn()
+        self.loop.watchChild(pid, restartCommandExited)
+
+    def stop(self):
+        """Stops the child process without restarting it; the watcher exits once the
+        child has."""
+        self.stopping = True
+        if self.candidate is not None:
+            # The reload won't be finishing, so its new process has to go, too.
+            self.readyTimer.cancel()
+            self.cancelCheck(self.candidate)
+            self.retire(self.candidate)
+            self.candidate = None
+            self.reloaded('The process was stopped.')
+        if self.pid is None:
+            self.exit() # There may be a restart pending; there's nothing else to stop.
+        else:
+            self.stopChild()
+            self.publish()
+
+    def restart(self, callback=None):
+        """Restarts the child process regardless of the restart configuration, calling
+        callback (if given) once the new child has been spawned."""
+        if callback is not None:
+            self.restartCallbacks.append(callback)
+        if self.pid is None:
+            self.spawn()
+        else:
+            self.restarting = True
+            self.stopChild()
+
+    def reload(self, callback):
+        """Starts a new child process alongside the current one and, once the new one
+        is ready, makes it the current child process and stops the old one.  Calls
+        callback with None once the new child process is current, or with an error
+        message if it couldn't be made so."""
+        if self.pid is None:
+            self.restart(lambda: callback(None))
+            return
+        elif self.candidate is not None:
+            callback('A reload is already in progress.')
+            return
+        self.log('reloading: starting a new process alongside pid %s' % self.pid)
+        self.candidate = self.forkChild()
+        self.reloadCallback = callback
+        self.log('new process started at pid %s' % self.candidate)
+        self.publish()
+        self.loop.watchChild(self.candidate, self.childExited)
+        if self.candidate in self.checks:
+            self.readyTimer = self.loop.callLater(self.config.options.startWaitTime(),
+                                                  self.reloadTimedOut)
+        else:
+            self.readyTimer = self.loop.callLater(self.config.watcher.reload.wait(),
+                                                  self.promote)
+
+    def reloadTimedOut(self):
+        (candidate, self.candidate) = (self.candidate, None)
+        timeout = self.config.options.startWaitTime()
+        self.log('new process at pid %s was not ready within %s seconds, stopping it' %
+                 (candidate, timeout))
+        self.cancelCheck(candidate)
+        self.retire(candidate)
+        self.reloaded('New process was not ready within %s seconds.' % timeout)
+
+    def promote(self):
+        """Makes the reload's new child process the current one, stopping the old one
+        if it's still running."""
+        self.readyTimer.cancel()
+        (old, self.pid, self.candidate) = (self.pid, self.candidate, None)
+        self.lastRestart = time.time()
+        self.command.writePidfile(self.pid)
+        if self.pid in self.checks:
+            self.isReady = False # It replaced an old process that exited first.
+            if self.health is not None:
+                self.health.stop()
+        else:
+            self.becameReady()
+        if old is not None:
+            self.log('new process at pid %s is ready, stopping old process at pid %s'
+                     % (self.pid, old))
+            self.retire(old)
+        self.reloaded(None)
+
+    def reloaded(self, error):
+        self.publish()
+        (callback, self.reloadCallback) = (self.reloadCallback, None)
+        if callback is not None:
+            callback(error)
+
+    def retire(self, pid):
+        try:
+            os.kill(pid, self.config.commands.stop.signal())
+        except OSError:
+            return # It's already exited; childExited hasn't been called yet.
+        self.retiring[pid] = self.loop.callLater(self.config.watcher.reload.timeout(),
+                                                 self.killRetiring, pid)
+
+    def killRetiring(self, pid):
+        if self.retiring.pop(pid, None) is not None:
+            self.log('old process at pid %s did not exit, killing it' % pid)
+            try:
+                os.kill(pid, signal.SIGKILL)
+            except OSError:
+                pass
+
+    def stopChild(self):
+        if self.pid is None:
+            return
+        self.log('stopping process at pid %s' % self.pid)
+        command = self.config.commands.stop.command()
+        if command:
+            pid = os.fork()
+            if not pid:
+                try:
+                    self.command.execute(self.environ, command)
+                finally:
+                    os._exit(127)
+            self.loop.watchChild(pid, lambda pid, status: None)
+        else:
+            os.kill(self.pid, self.config.commands.stop.signal())
+
+    def signal(self, signum):
+        if self.pid is None:
+            raise OSError('Process is not running.')
+        self.log('sending signal %s to process at pid %s' % (signum, self.pid))
+        os.kill(self.pid, signum)
+
+    def sighup(self, signum):
+        self.log('received SIGHUP, reloading')
+        def reloaded(error):
+            if error:
+                self.log('reload failed: %s' % error)
+        self.reload(reloaded)
+
+    def sigusr1(self, signum):
+        if self.logPipes is not None and self.pid is not None:
+            # The child is about to be stopped, and whatever it writes while it stops
+            # still has to be read from its pipes.
+            self.log('received SIGUSR1, exiting once the process exits')
+            self.stopping = True
+            return
+        self.log('received SIGUSR1, removing watcher pidfile and exiting')
+        # XXX All we really need to do is configure not to restart, right?
+        # Originally I removed both pidfiles here, but it's needed in order
+        # to kill the child process, which must necessarily happen after the
+        # watcher exits, if the watcher is configured to restart the child.
+        self.exit()
+
+    def exit(self):
+        if self.exited:
+            return
+        self.exited = True
+        self.cancelRestart()
+        for pid in self.checks.keys():
+            self.cancelCheck(pid)
+        if self.health is not None:
+            self.health.stop()
+        self.notifyReady('The watcher exited before the process was ready.')
+        if self.metricsTimer is not None:
+            self.metricsTimer.cancel()
+            self.metricsTimer = None
+            try:
+                os.remove(self.config.watcher.metrics.file())
+            except OSError:
+                pass
+        if self.control is not None:
+            self.control.close()
+        if self.logPipes is not None:
+            for pipe in set(self.logPipes):
+                pipe.close()
+            self.logPipes = None
+        sockets.close(self.listeners)
+        self.listeners = []
+        if self.slot is not None:
+            self.slot.release()
+            self.slot = None
+        watcherPidfile = self.config.watcher.pidfile()
+        if watcherPidfile:
+            self.command.removePidfile(watcherPidfile, pid=self.watcherPid)
+        self.log('exiting')
+        if not self.shared:
+            self.loop.stop()